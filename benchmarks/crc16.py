@@ -0,0 +1,91 @@
+"""Micro-benchmark: protocol.crc16 against the original bit-by-bit loop
+
+Run with `python -m benchmarks.crc16` from the repository root.
+
+The original loop never masked the register inside the loop, so it grows a
+Python integer by 8 bits per input byte and is quadratic in the input size.
+It is only timed on the 484 KiB input when --all is given (this takes many
+minutes); the masked variant shows the cost of the bitwise algorithm itself.
+"""
+import os
+import sys
+import timeit
+
+from dpload2.protocol import crc16, Crc16
+
+SIZES = {
+    "8 B": 8,
+    "4 KiB": 4096,
+    "484 KiB": 0x79000,
+}
+
+ORIGINAL_MAX_SIZE = 4096
+
+
+def crc16_original(data, start=0x0000):
+    crc = start
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            if (crc & 0x8000) > 0:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc = crc << 1
+    return crc & 0xFFFF
+
+
+def crc16_bitwise(data, start=0x0000):
+    crc = start
+    for b in data:
+        crc ^= b << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+def crc16_streaming(data, chunk=8):
+    c = Crc16()
+    for i in range(0, len(data), chunk):
+        c.update(data[i : i + chunk])
+    return c.digest()
+
+
+def measure(func, data, budget=0.5):
+    timer = timeit.Timer(lambda: func(data))
+    elapsed = timer.timeit(number=1)
+    if elapsed >= budget:
+        return elapsed
+    number = max(1, int(budget / 5 / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=5, number=number)) / number
+
+
+def main(argv):
+    run_all = "--all" in argv
+    print(
+        f"{'size':>8}  {'original':>12}  {'bitwise':>12}  {'crc16':>10}  "
+        f"{'Crc16/8B':>10}  {'speedup':>8}"
+    )
+    for label, size in SIZES.items():
+        data = os.urandom(size)
+        reference = crc16_bitwise(data)
+        assert crc16(data) == crc16_streaming(data) == reference
+
+        if size <= ORIGINAL_MAX_SIZE or run_all:
+            assert crc16_original(data) == reference
+            original = f"{measure(crc16_original, data) * 1e6:10.1f}us"
+        else:
+            original = f"{'n/a':>12}"
+        t_old = measure(crc16_bitwise, data)
+        t_new = measure(crc16, data)
+        t_stream = measure(crc16_streaming, data)
+        print(
+            f"{label:>8}  {original}  {t_old * 1e6:10.1f}us  {t_new * 1e6:8.2f}us  "
+            f"{t_stream * 1e6:8.1f}us  {t_old / t_new:7.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,238 @@
+"""End-to-end benchmark of the CLI against a simulated bootloader
+
+Runs the real `program`, `verify` and `crc` commands in-process on a virtual
+CAN bus, with a SimulatedBootloader answering on the same bus. Each case
+runs in a fresh interpreter so CPU time and peak RSS are its own.
+
+    python -m benchmarks.e2e                 # run and compare to the baseline
+    python -m benchmarks.e2e --save          # run and store a new baseline
+    python -m benchmarks.e2e --case program-32k --case verify-full
+
+The simulator runs in the same process, so CPU time includes its share.
+Baselines are machine specific. baseline.json holds the one from the
+reference machine; on any other, run with --save first (or point --baseline
+at a file of its own) before comparing.
+"""
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import can
+import click
+import intelhex
+
+from dpload2.__main__ import cli
+from dpload2.dpload import DPLoad
+from dpload2.simulator import SimulatedBootloader, APP_START
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+IMAGE_SIZES = {
+    "32k": 32 * 1024,
+    "256k": 256 * 1024,
+    "full": 0x79000,
+}
+
+CASES = {
+    **{f"program-{name}": ("program", name) for name in IMAGE_SIZES},
+    "verify-full": ("verify", "full"),
+    "crc-full": ("crc", "full"),
+}
+
+# A case regresses when throughput drops, or CPU time or memory grow, by
+# more than this fraction of the baseline
+TOLERANCE = 0.2
+# Round-trip times vary more from run to run, so the median and p90 get more
+# room, and only in cases with enough requests for them to mean something.
+# p99 is shown but not checked.
+LATENCY_TOLERANCE = 0.5
+LATENCY_CHECKED = ("p50", "p90")
+LATENCY_MIN_REQUESTS = 100
+
+
+def make_image(path, size, seed=0):
+    rng = random.Random(seed)
+    ih = intelhex.IntelHex()
+    ih.frombytes(rng.randbytes(size), offset=APP_START)
+    ih.tofile(path, format="hex")
+
+
+class RoundTripRecorder:
+    """Record request round-trip times by wrapping DPLoad's frame methods"""
+
+    def __init__(self):
+        self.sent = []
+        self.samples = []
+
+    def __enter__(self):
+        self._send_frame = DPLoad._send_frame
+        self._recv_frame = DPLoad._recv_frame
+        recorder = self
+
+        def send_frame(dpload, *args, **kwargs):
+            recorder.sent.append(time.perf_counter())
+            return recorder._send_frame(dpload, *args, **kwargs)
+
+        def recv_frame(dpload, *args, **kwargs):
+            payload = recorder._recv_frame(dpload, *args, **kwargs)
+            recorder.samples.append(time.perf_counter() - recorder.sent.pop(0))
+            return payload
+
+        DPLoad._send_frame = send_frame
+        DPLoad._recv_frame = recv_frame
+        return self
+
+    def __exit__(self, *exc_info):
+        DPLoad._send_frame = self._send_frame
+        DPLoad._recv_frame = self._recv_frame
+
+    def percentiles(self):
+        if not self.samples:
+            return {}
+        if len(self.samples) == 1:
+            return {f"p{p}": self.samples[0] * 1e3 for p in (50, 90, 99)}
+        cuts = statistics.quantiles(self.samples, n=100)
+        return {f"p{p}": cuts[p - 1] * 1e3 for p in (50, 90, 99)}
+
+
+def run_case(name, workdir):
+    command, image = CASES[name]
+    size = IMAGE_SIZES[image]
+    hexfile = os.path.join(workdir, f"{image}.hex")
+    make_image(hexfile, size)
+
+    channel = f"bench-{name}"
+    sim_bus = can.interface.Bus(interface="virtual", channel=channel)
+    simulator = SimulatedBootloader(sim_bus, sa=208).start()
+    if command != "program":
+        # verify and crc need the image in flash already
+        with open(hexfile) as f:
+            ih = intelhex.IntelHex(f)
+        simulator.flash.write(APP_START, ih.tobinstr(APP_START, APP_START + size - 1))
+
+    args = ["--interface", "virtual", "--bus", channel, command]
+    # The manifest cache would turn repeat runs into cache hits
+    if command == "program":
+        args += [hexfile, "--da", "208", "--yes", "--stay", "--no-cache"]
+    elif command == "verify":
+        args += [hexfile, "--da", "208", "--no-cache"]
+    else:
+        args += ["--da", "208", "--start", str(APP_START), "--size", str(size)]
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    try:
+        with RoundTripRecorder() as recorder:
+            cli.main(args, standalone_mode=False)
+    finally:
+        elapsed = time.perf_counter() - start
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+        simulator.stop()
+        sim_bus.shutdown()
+
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (
+        usage_after.ru_stime - usage_before.ru_stime
+    )
+    return {
+        "bytes": size,
+        "elapsed_s": elapsed,
+        "bytes_per_s": size / elapsed,
+        "cpu_s": cpu,
+        "peak_rss_kib": usage_after.ru_maxrss,
+        "requests": len(recorder.samples),
+        "rtt_ms": recorder.percentiles(),
+    }
+
+
+def run_isolated(name):
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.e2e", "--run-case", name],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def compare(name, result, baseline):
+    problems = []
+    if result["bytes_per_s"] < baseline["bytes_per_s"] * (1 - TOLERANCE):
+        problems.append(
+            f"throughput {result['bytes_per_s']:,.0f} B/s < baseline {baseline['bytes_per_s']:,.0f} B/s"
+        )
+    if result["cpu_s"] > baseline["cpu_s"] * (1 + TOLERANCE):
+        problems.append(
+            f"CPU {result['cpu_s']:.2f} s > baseline {baseline['cpu_s']:.2f} s"
+        )
+    if result["peak_rss_kib"] > baseline["peak_rss_kib"] * (1 + TOLERANCE):
+        problems.append(
+            f"peak RSS {result['peak_rss_kib']:,} KiB > baseline {baseline['peak_rss_kib']:,} KiB"
+        )
+    if min(result["requests"], baseline["requests"]) >= LATENCY_MIN_REQUESTS:
+        for cut in LATENCY_CHECKED:
+            rtt, base = result["rtt_ms"][cut], baseline["rtt_ms"][cut]
+            if rtt > base * (1 + LATENCY_TOLERANCE):
+                problems.append(
+                    f"{cut} round trip {rtt:.2f} ms > baseline {base:.2f} ms"
+                )
+    return [f"{name}: {problem}" for problem in problems]
+
+
+@click.command()
+@click.option("--case", "cases", multiple=True, type=click.Choice(list(CASES)))
+@click.option("--save", is_flag=True, help="Store the results as the new baseline")
+@click.option("--baseline", "baseline_path", default=BASELINE, show_default=True)
+@click.option("--run-case", "case_name", default=None, hidden=True)
+def benchmark(cases, save, baseline_path, case_name):
+    """Benchmark program/verify/crc against the simulator"""
+    if case_name is not None:
+        with tempfile.TemporaryDirectory() as workdir:
+            click.echo(json.dumps(run_case(case_name, workdir)))
+        return
+
+    results = {}
+    click.echo(
+        f"{'case':<14} {'bytes/s':>12} {'CPU s':>7} {'RSS KiB':>9} {'reqs':>6} "
+        f"{'p50 ms':>7} {'p90 ms':>7} {'p99 ms':>7}"
+    )
+    for name in cases or CASES:
+        result = run_isolated(name)
+        results[name] = result
+        rtt = result["rtt_ms"]
+        click.echo(
+            f"{name:<14} {result['bytes_per_s']:12,.0f} {result['cpu_s']:7.2f} "
+            f"{result['peak_rss_kib']:9,} {result['requests']:6} "
+            f"{rtt.get('p50', 0):7.2f} {rtt.get('p90', 0):7.2f} {rtt.get('p99', 0):7.2f}"
+        )
+
+    if save:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo(f"Baseline written to {baseline_path}")
+        return
+
+    if not os.path.exists(baseline_path):
+        click.echo("No baseline to compare against; run with --save to create one")
+        return
+
+    with open(baseline_path) as f:
+        baselines = json.load(f)
+    problems = []
+    for name, result in results.items():
+        if name in baselines:
+            problems += compare(name, result, baselines[name])
+    for problem in problems:
+        click.echo(f"REGRESSION {problem}", err=True)
+    if problems:
+        sys.exit(1)
+    click.echo("No regressions against baseline")
+
+
+if __name__ == "__main__":
+    benchmark()
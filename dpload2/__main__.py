@@ -1,4 +1,7 @@
+import concurrent.futures
 import errno
+import json
+import os
 import sys
 import time
 import logging
@@ -8,7 +11,6 @@ import io
 import can
 import rich
 import click
-import intelhex
 
 import rich.progress
 import rich.traceback
@@ -16,15 +18,34 @@ from rich.console import Console
 from rich.table import Table
 from rich.logging import RichHandler
 
-from dpload2.dpload import DPLoad
-from dpload2.protocol import crc16
+from dpload2.cache import (
+    ManifestCache,
+    default_cache_path,
+    forget_nodes,
+    node_identity,
+)
+from dpload2.dpload import (
+    DPLoad,
+    CrcTimeoutError,
+    image_crcs,
+    CRC_WINDOW,
+    DEFAULT_WINDOW,
+    APP_START,
+    APP_SIZE,
+    PAGE_SIZE,
+    RTT_LIMITS,
+)
+from dpload2.protocol import crc16_combine
+from dpload2.image import read_hex_records, compact_records, data_segments
+from dpload2.fleet import FleetJob, run_fleet
+from dpload2.rtt import RttTable
 
 VERSION = "2.0"
 
 console = Console()
 error_console = Console(stderr=True)
 
-PAGE_SIZE = 4096
+STANDALONE_COMMANDS = {"fleet"}
 
 
 class BasedIntParamType(click.ParamType):
@@ -81,13 +102,21 @@ SA_TYPE.name = "NODE"
 SA_OR_GLOBAL_TYPE = MultiRangeBasedIntParamType([(0, 253), (255, 255)])
 SA_OR_GLOBAL_TYPE.name = "NODE-OR-GLOBAL"
 
-APP_ADDRESS_TYPE = RangedBasedIntParamType(min=0xC000, max=0xC000 + 0x32000)
+APP_END = APP_START + APP_SIZE
+
+APP_ADDRESS_TYPE = RangedBasedIntParamType(min=APP_START, max=APP_END - 1)
 
 
 @click.group()
 @click.option(
     "--bus", default="can0", help="SocketCAN network interface", show_default=True
 )
+@click.option(
+    "--interface",
+    default="socketcan",
+    help="python-can interface type",
+    show_default=True,
+)
 @click.option("--verbose", default=False, is_flag=True, help="Output extra information")
 @click.option(
     "--bitrate",
@@ -102,54 +131,260 @@ APP_ADDRESS_TYPE = RangedBasedIntParamType(min=0xC000, max=0xC000 + 0x32000)
     show_default=True,
     type=SA_TYPE,
 )
+@click.option(
+    "--kernel-j1939",
+    default=False,
+    is_flag=True,
+    help="Use the kernel's CAN_J1939 sockets for J1939 requests, if available",
+)
 @click.pass_context
-def cli(ctx, bus, verbose, bitrate, sa):
+def cli(ctx, bus, interface, verbose, bitrate, sa, kernel_j1939):
     logging.getLogger("can.interfaces").setLevel(logging.WARN)
     log_level = logging.DEBUG if verbose else logging.WARN
     logging.basicConfig(level=log_level, handlers=[RichHandler()])
     rich.traceback.install(show_locals=True)
-    ctx.obj = DPLoad(bus=bus, bitrate=bitrate, sa=sa)
+    if ctx.invoked_subcommand in STANDALONE_COMMANDS:
+        # These commands open their own buses
+        return
+    can_bus = can.interface.Bus(interface=interface, channel=bus, bitrate=bitrate)
+    rtt = RttTable(default_cache_path("rtt.json"), limits=RTT_LIMITS)
+    ctx.obj = DPLoad(bus=can_bus, sa=sa, rtt=rtt, kernel_j1939=kernel_j1939)
+    ctx.call_on_close(can_bus.shutdown)
+    ctx.call_on_close(ctx.obj.close)
+
+
+def load_manifest(hexfile, cache=None, records=None):
+    """(image hash, (pages, segments)) reference CRCs for hexfile
+
+    The CRCs come from the cache when it has them; otherwise they are
+    computed from records, reading hexfile if none are given. Without a
+    cache the image hash is None.
+    """
+    image_hash = None
+    if cache is not None:
+        image_hash = cache.image_hash(hexfile)
+        manifest = cache.get_manifest(image_hash, PAGE_SIZE)
+        if manifest is not None:
+            return image_hash, manifest
+
+    if records is None:
+        with open(hexfile, "r") as f:
+            records = read_hex_records(f)
+    manifest = image_crcs(records)
+    if cache is not None:
+        cache.put_manifest(image_hash, PAGE_SIZE, *manifest)
+    return image_hash, manifest
+
+
+def holds_image(dpload, da, pages):
+    """True if the application CRC of node da matches the image's page CRCs
+
+    A single CRC request, to confirm that a node the cache has as verified
+    was not reprogrammed since by something that does not update the cache.
+    """
+    expected = 0x0000
+    for address in sorted(pages):
+        expected = crc16_combine(expected, pages[address], PAGE_SIZE)
+    try:
+        return dpload.get_crc(da=da, start=APP_START, size=APP_SIZE) == expected
+    except (TimeoutError, ValueError):
+        return False
+
+
+def page_ranges(start, size):
+    """(address, PAGE_SIZE) for every page that [start, start + size) touches"""
+    first = start - start % PAGE_SIZE
+    return [(address, PAGE_SIZE) for address in range(first, start + size, PAGE_SIZE)]
 
 
 @cli.command()
 @click.argument("hexfile", type=click.Path(exists=True))
 @click.option("--da", default=None, help="Address of node to program", type=SA_TYPE)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    show_default=True,
+    help="Use cached image CRCs and skip nodes already verified with this image",
+)
+@click.option(
+    "--pages",
+    "by_page",
+    default=False,
+    is_flag=True,
+    help="Check every flash page a segment touches, to locate a mismatch",
+)
+@click.option(
+    "--window",
+    default=CRC_WINDOW,
+    show_default=True,
+    help="Number of CRC requests to keep in flight",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--report",
+    "report_path",
+    default=None,
+    type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+    help="Write a JSON report to this file; - writes it to stdout instead of the table",
+)
 @click.pass_obj
-def verify(dpload, hexfile, da):
+def verify(dpload, hexfile, da, use_cache, by_page, window, report_path):
     """Verify programming"""
-    ih = intelhex.IntelHex()
-    ih.fromfile(hexfile, format="hex")
+    if da is None:
+        da = dpload.da
+    quiet = report_path == "-"
+    started = time.time()
+    cache = ManifestCache() if use_cache else None
+    image_hash = None if cache is None else cache.image_hash(hexfile)
+    manifest = None if cache is None else cache.get_manifest(image_hash, PAGE_SIZE)
+
+    report = {
+        "file": hexfile,
+        "node": da,
+        "image_hash": image_hash,
+        "by_page": by_page,
+        "cached": False,
+        "segments": [],
+    }
+
+    def finish(verified):
+        report["ok"] = verified
+        report["elapsed_s"] = time.time() - started
+        if cache is not None:
+            cache.save()
+        if report_path is not None:
+            with click.open_file(report_path, "w") as f:
+                json.dump(report, f, indent=2)
+                f.write("\n")
+        if not verified:
+            sys.exit(1)
 
-    segments = ih.segments()
-    for start, stop in segments:
-        size = stop - start + 1
-        console.print(
-            f"Verify [bold white]0x{start:08x}...0x{stop:08x}[/bold white] [dim white]{size:8d} bytes[/dim white] ",
-            end="",
-        )
-        if not (0x1D007000 <= start < 0x1D080000):
-            console.print("[bold blue]⏭ SKIP[/bold blue]")
-            continue
-        data = ih.tobinstr(start, stop)
-        reference_crc = crc16(data)
-        try:
-            target_crc = dpload.get_crc(da=da, timeout=5, start=start, size=size)
-        except TimeoutError:
-            console.print("[bold red]:cross_mark:ERROR:[/bold red] Could not get CRC")
-        else:
-            if reference_crc != target_crc:
+    identity = None
+    if cache is not None:
+        identity = node_identity(dpload, da)
+        if (
+            identity is not None
+            and manifest is not None
+            and cache.is_verified(identity, image_hash)
+            and holds_image(dpload, da, manifest[0])
+        ):
+            if not quiet:
                 console.print(
-                    f"[bold red]:cross_mark:ERROR:[/bold red] Bad CRC. Expected {reference_crc:04X}, but got {target_crc:04X}"
+                    f"[bold green]:white_heavy_check_mark:OK[/bold green] Node {da} already verified with this image (cached)"
                 )
-            else:
+            report["cached"] = True
+            finish(True)
+            return
+
+    dpload.identify(da)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        if manifest is None:
+            with open(hexfile, "r") as f:
+                records = read_hex_records(f)
+            segments = [(start, len(data)) for start, data in data_segments(records)]
+            # The reference CRCs are worked out while the device answers
+            reference = executor.submit(image_crcs, records)
+        else:
+            segments = [(start, size) for start, size, _ in manifest[1]]
+            reference = None
+
+        checked = [
+            (start, size)
+            for start, size in segments
+            if APP_START <= start < APP_END
+        ]
+        ranges = []
+        for start, size in checked:
+            ranges += page_ranges(start, size) if by_page else [(start, size)]
+
+        device_start = time.time()
+        error = None
+        try:
+            answers = dpload.get_crcs(ranges, da=da, window=window)
+        except CrcTimeoutError as e:
+            answers, error = e.results, str(e)
+        report["device_s"] = time.time() - device_start
+
+        if reference is not None:
+            manifest = reference.result()
+            if cache is not None:
+                cache.put_manifest(image_hash, PAGE_SIZE, *manifest)
+
+    pages, segment_crcs = manifest
+    expected = {(start, size): crc for start, size, crc in segment_crcs}
+    actual = dict(zip(ranges, answers))
+
+    def check(start, size, reference_crc):
+        answer = actual.get((start, size))
+        entry = {
+            "start": start,
+            "size": size,
+            "expected": reference_crc,
+            "actual": None if answer is None else answer[0],
+            "elapsed_s": None if answer is None else answer[1],
+        }
+        entry["ok"] = entry["actual"] == reference_crc
+        if answer is None:
+            entry["error"] = error or "No answer"
+        return entry
+
+    verified = True
+    for start, size in segments:
+        if not quiet:
+            console.print(
+                f"Verify [bold white]0x{start:08x}...0x{start + size - 1:08x}[/bold white] [dim white]{size:8d} bytes[/dim white] ",
+                end="",
+            )
+        if (start, size) not in checked:
+            report["segments"].append({"start": start, "size": size, "skipped": True})
+            if not quiet:
+                console.print("[bold blue]⏭ SKIP[/bold blue]")
+            continue
+
+        if by_page:
+            entry = {
+                "start": start,
+                "size": size,
+                "pages": [
+                    check(address, page_size, pages.get(address))
+                    for address, page_size in page_ranges(start, size)
+                ],
+            }
+            entry["ok"] = all(page["ok"] for page in entry["pages"])
+            bad = [page for page in entry["pages"] if not page["ok"]]
+        else:
+            entry = check(start, size, expected[(start, size)])
+            bad = [] if entry["ok"] else [entry]
+        report["segments"].append(entry)
+        verified = verified and entry["ok"]
+
+        if quiet:
+            continue
+        if entry["ok"]:
+            console.print("[bold green]:white_heavy_check_mark:OK[/bold green]")
+        elif bad[0]["actual"] is None:
+            console.print("[bold red]:cross_mark:ERROR:[/bold red] Could not get CRC")
+        for item in bad:
+            if item["actual"] is not None:
                 console.print(
-                    f"[bold green]:white_heavy_check_mark:OK[/bold green] {reference_crc:04X}"
+                    f"[bold red]:cross_mark:ERROR:[/bold red] Bad CRC at 0x{item['start']:08x}+{item['size']:#x}. Expected {item['expected']:04X}, but got {item['actual']:04X}"
                 )
 
+    if identity is not None:
+        cache.set_node(identity, image_hash, verified=verified)
+    finish(verified)
+
 
 @cli.command()
 @click.argument("hexfile", type=click.Path(exists=True))
-@click.option("--da", default=None, help="Address of node to program", type=SA_TYPE)
+@click.option(
+    "--da",
+    "das",
+    multiple=True,
+    help="Address of node to program; repeat to program several nodes at once",
+    type=SA_TYPE,
+)
 @click.option(
     "--stay",
     default=False,
@@ -162,76 +397,298 @@ def verify(dpload, hexfile, da):
     is_flag=True,
     help="Ignore part number information in the hexfile [DANGEROUS]",
 )
+@click.option(
+    "--window",
+    default=DEFAULT_WINDOW,
+    show_default=True,
+    help="Number of programming requests to keep in flight; 1 waits for each answer",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--skip-blank/--no-skip-blank",
+    default=False,
+    show_default=True,
+    help="Leave out data that is already erased (0xFF) and repack the rest",
+)
+@click.option(
+    "--record-size",
+    default=16,
+    show_default=True,
+    help="Data bytes per repacked hex record",
+    type=click.IntRange(min=4, max=252),
+)
+@click.option(
+    "--delta",
+    default=False,
+    is_flag=True,
+    help="Compare page CRCs and only erase and program the pages that changed",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=True,
+    show_default=True,
+    help="Use cached image CRCs, and skip nodes already verified with this image in delta mode",
+)
 @click.confirmation_option(
     prompt="Are you sure you want to erase and re-program the node?"
 )
 @click.pass_obj
-def program(dpload, hexfile, da, stay, unsafe):
+def program(
+    dpload,
+    hexfile,
+    das,
+    stay,
+    unsafe,
+    window,
+    skip_blank,
+    record_size,
+    delta,
+    use_cache,
+):
     """Load a hexfile onto the controller"""
-    records = []
     with rich.progress.open(hexfile, "r", description="Reading hex file") as f:
-        for line in f.readlines():
-            try:
-                record = bytes.fromhex(line[1:].strip())
-            except ValueError:
-                raise ValueError(f"Bad record format: {line}")
-            records.append(record)
+        records = read_hex_records(f)
+
+    cache = ManifestCache() if use_cache else None
+    page_crcs = None
+    if delta:
+        image_hash, (page_crcs, _) = load_manifest(hexfile, cache, records)
+    elif cache is not None:
+        image_hash = cache.image_hash(hexfile)
+
+    skipped = 0
+    if skip_blank:
+        # Every node is erased before programming, so blank data is a no-op
+        try:
+            records, skipped = compact_records(records, record_size=record_size)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--record-size")
+
+    das = das or (dpload.da,)
 
     # dpload.boot_can(da=da)
     time.sleep(0.500)
 
-    try:
-        base, pn, appmajor, appminor = dpload.get_oem_info(da=da)
-    except TimeoutError:
-        error_console.print(
-            f"[bold red]:cross_mark: ERROR:[/bold red] Timeout waiting for OEM info"
-        )
-        sys.exit(1)
-    except can.exceptions.CanOperationError as e:
-        if e.error_code == errno.ENETDOWN:
+    for da in das:
+        try:
+            dpload.identify(da)
+            base, pn, appmajor, appminor = dpload.get_oem_info(da=da)
+        except TimeoutError:
             error_console.print(
-                f"[bold red]:cross_mark: ERROR:[/bold red] CAN interface {dpload.busname} is down"
+                f"[bold red]:cross_mark: ERROR:[/bold red] Timeout waiting for OEM info from node {da}"
             )
-        else:
-            error_console.print(f"CAN error {e.error_code}: {e}")
-        sys.exit(1)
+            sys.exit(1)
+        except can.exceptions.CanOperationError as e:
+            if e.error_code == errno.ENETDOWN:
+                error_console.print(
+                    f"[bold red]:cross_mark: ERROR:[/bold red] CAN interface {dpload.busname} is down"
+                )
+            else:
+                error_console.print(f"CAN error {e.error_code}: {e}")
+            sys.exit(1)
 
-    console.print("Erasing flash")
-    try:
-        dpload.erase(da=da, timeout=5.0)
-    except TimeoutError:
-        error_console.print(
-            f"[bold red]:cross_mark:[/bold red] Timeout waiting for response"
-        )
-        sys.exit(1)
+    identities = {}
+    if cache is None:
+        forget_nodes(dpload, das)
+    else:
+        identities = {da: node_identity(dpload, da) for da in das}
+        if delta:
+            current = [
+                da
+                for da in das
+                if identities[da] is not None
+                and cache.is_verified(identities[da], image_hash)
+                and holds_image(dpload, da, page_crcs)
+            ]
+            for da in current:
+                console.print(
+                    f"[bold green]:white_heavy_check_mark:[/bold green] Node {da} already verified with this image (cached); skipping"
+                )
+            das = [da for da in das if da not in current]
 
     start = time.time()
-    chunk = b""
-    n = 0
+    total = sum(len(record) for record in records)
     dpload.dm13_control(True)
-    for record in rich.progress.track(records, description="Writing flash..."):
-        n += 1
-        chunk += record
-        if n == 8:
-            dpload.program_flash(chunk, da=da, timeout=5.0)
-            time.sleep(0.005)
-            chunk = b""
-            n = 0
-    if n:
-        dpload.program_flash(chunk, da=da, timeout=5.0)
-
-    dpload.dm13_control(False)
+    try:
+        with rich.progress.Progress(console=console) as progress:
+            tasks = {
+                da: progress.add_task(f"Node {da}: erase", total=total) for da in das
+            }
+
+            def report(da, stage, confirmed):
+                progress.update(
+                    tasks[da], description=f"Node {da}: {stage}", completed=confirmed
+                )
+
+            results = dpload.program_many(
+                records,
+                das,
+                window=window,
+                jump=not stay,
+                delta=delta,
+                page_crcs=page_crcs,
+                progress=report,
+            )
+    finally:
+        dpload.dm13_control(False)
     elapsed = time.time() - start
+
+    if cache is not None:
+        for result in results.values():
+            identity = identities.get(result.da)
+            if identity is None:
+                continue
+            if result.ok:
+                # A delta run that changed nothing has compared every page
+                unchanged = not result.full_erase and (
+                    result.pages_skipped == result.pages_total
+                )
+                cache.set_node(identity, image_hash, verified=delta and unchanged)
+            else:
+                cache.forget_node(identity)
+        cache.save()
+
+    failed = [result for result in results.values() if not result.ok]
+    for result in results.values():
+        if result.ok:
+            console.print(
+                f"[bold green]:white_heavy_check_mark:[/bold green] Node {result.da} programmed in {result.elapsed:0.3f} seconds"
+            )
+            if delta:
+                print_delta_summary(result, total)
+        else:
+            error_console.print(
+                f"[bold red]:cross_mark:[/bold red] Node {result.da} failed during {result.stage} after {result.confirmed} bytes: {result.error}"
+            )
     console.print(f"Programming completed in {elapsed:0.3f} seconds")
+    tx = dpload.pacer.metrics()
+    if tx["stalls"]:
+        console.print(
+            f"Transmit queue was full {tx['stalls']} times ({tx['stalled_s']:0.3f} seconds waiting)"
+        )
+    if skip_blank:
+        console.print(f"{skipped} bytes skipped")
 
-    if not stay:
-        console.print("[bold blue]:play_button:[/bold blue] Starting application")
-        try:
-            dpload.jump(da=da)
-        except TimeoutError:
-            pass
-    else:
+    if stay:
         console.print("[bold blue]:pause_button:[/bold blue] Staying in bootloader")
+    if failed:
+        sys.exit(1)
+
+
+def print_delta_summary(result, total):
+    """Report the pages a delta update skipped and the time that saved"""
+    if result.full_erase:
+        console.print(
+            f"  Node {result.da} has no range erase; erased and programmed everything"
+        )
+        return
+    console.print(
+        f"  {result.pages_skipped} of {result.pages_total} pages unchanged and skipped"
+    )
+    if result.confirmed and result.program_time:
+        # Programming everything at the rate just measured, without comparing
+        full = total / (result.confirmed / result.program_time)
+        if full > result.elapsed:
+            console.print(
+                f"  About {full - result.elapsed:0.1f} seconds saved over a full flash ({full:0.1f} seconds)"
+            )
+        else:
+            console.print(f"  No time saved over a full flash ({full:0.1f} seconds)")
+
+
+class FleetJobParamType(click.ParamType):
+    name = "CHANNEL:NODE:IMAGE"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, FleetJob):
+            return value
+        try:
+            return FleetJob.parse(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
+@cli.command()
+@click.option(
+    "--job",
+    "jobs",
+    multiple=True,
+    required=True,
+    type=FleetJobParamType(),
+    help="Program IMAGE onto NODE on CAN interface CHANNEL; may be repeated",
+)
+@click.option(
+    "--window",
+    default=DEFAULT_WINDOW,
+    show_default=True,
+    help="Number of programming requests to keep in flight; 1 waits for each answer",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--skip-blank/--no-skip-blank",
+    default=False,
+    show_default=True,
+    help="Leave out data that is already erased (0xFF) and repack the rest",
+)
+@click.confirmation_option(
+    prompt="Are you sure you want to erase and re-program every node?"
+)
+@click.pass_context
+def fleet(ctx, jobs, window, skip_blank):
+    """Program nodes on several CAN interfaces in parallel"""
+    params = ctx.parent.params
+    start = time.time()
+    with rich.progress.Progress(console=console) as progress:
+        tasks = {
+            (job.channel, job.da): progress.add_task(
+                f"{job.channel}/{job.da}: waiting", total=None
+            )
+            for job in jobs
+        }
+
+        def report(channel, da, stage, confirmed):
+            progress.update(
+                tasks[(channel, da)],
+                description=f"{channel}/{da}: {stage}",
+                completed=confirmed,
+            )
+
+        results = run_fleet(
+            jobs,
+            interface=params["interface"],
+            bitrate=params["bitrate"],
+            sa=params["sa"],
+            window=window,
+            skip_blank=skip_blank,
+            progress=report,
+        )
+    elapsed = time.time() - start
+
+    table = Table(title=f"Fleet results ({elapsed:0.1f} seconds)")
+    table.add_column("Interface", style="cyan")
+    table.add_column("Node", justify="right", style="cyan")
+    table.add_column("Image")
+    table.add_column("Result")
+    table.add_column("Bytes", justify="right")
+    table.add_column("Time", justify="right")
+    for result in results:
+        if result.ok:
+            outcome = "[bold green]OK[/bold green]"
+        else:
+            outcome = f"[bold red]FAILED[/bold red] ({result.stage}: {result.error})"
+        table.add_row(
+            result.job.channel,
+            f"{result.job.da} ({result.job.da:#02x})",
+            os.path.basename(result.job.path),
+            outcome,
+            f"{result.confirmed:,}",
+            f"{result.elapsed:0.1f} s",
+        )
+    console.print(table)
+
+    if not all(result.ok for result in results):
+        sys.exit(1)
 
 
 @cli.command()
@@ -266,7 +723,7 @@ def info(dpload, da):
     """Retrieve information about a node"""
     try:
         base, pn, pnmajor, pnminor = dpload.get_oem_info(da=da)
-        appmajor, appminor = dpload.get_app_info(da=da, timeout=0.5)
+        appmajor, appminor = dpload.get_app_info(da=da)
     except TimeoutError:
         error_console.print("[bold red]:cross_mark:[/bold red] Node did not respond")
         sys.exit(1)
@@ -336,32 +793,27 @@ def crc(dpload, da, start, size, pagewise):
     """
     if not pagewise:
         try:
-            crc = dpload.get_crc(da=da, timeout=5, start=start, size=size)
+            crc = dpload.get_crc(da=da, start=start, size=size)
         except TimeoutError:
             error_console.print(f"[bold red]:cross_mark:[/bold red] Could not get CRC")
             sys.exit(1)
     else:
         page_crcs = []
-        BLANK_PAGE = b"\x00" * PAGE_SIZE
         try:
             for address in rich.progress.track(
                 range(start, start + size, PAGE_SIZE),
                 description="Calculating CRC",
                 console=console,
             ):
-                page_crc = dpload.get_crc(
-                    da=da, timeout=3, start=address, size=PAGE_SIZE
-                )
+                page_crc = dpload.get_crc(da=da, start=address, size=PAGE_SIZE)
                 console.print(f"Page {address:#08x}: {page_crc:04X}")
                 page_crcs.append(page_crc)
         except TimeoutError:
             error_console.print(f"[bold red]:cross_mark:[/bold red] Could not get CRC")
             sys.exit(1)
         crc = 0x0000
-        for page, page_crc in enumerate(page_crcs):
-            crc = crc16(BLANK_PAGE, start=crc)
-            crc ^= page_crc
-            address = 0x1D007000 + page * PAGE_SIZE
+        for page_crc in page_crcs:
+            crc = crc16_combine(crc, page_crc, PAGE_SIZE)
 
     console.print(f"CRC-16 (CCITT): {crc:04X}")
 
@@ -373,28 +825,22 @@ def crc(dpload, da, start, size, pagewise):
 @click.option(
     "--end", default=253, help="Last node to scan", show_default=True, type=SA_TYPE
 )
+@click.option(
+    "--timeout",
+    default=None,
+    help="Seconds to wait for nodes to answer  [default: learned]",
+    type=click.FloatRange(min=0),
+)
 @click.pass_obj
-def scan(dpload, start, end):
+def scan(dpload, start, end, timeout):
     """Scan CAN bus for nodes"""
-    nodes = []
-    for da in rich.progress.track(
-        range(start, end + 1),
-        description="Scanning CAN bus",
-        console=console,
-        auto_refresh=False,
-    ):
-        if da == dpload.sa:
-            continue
-        try:
-            major, minor = dpload.get_boot_info(da=da, timeout=0.1)
-        except TimeoutError:
-            continue
-        except ValueError:
-            continue
-        except can.exceptions.CanOperationError:
-            error_console.print("\n[bold red]ERROR:[/bold red] Cannot complete scan")
-            break
-        nodes.append((da, major, minor))
+    try:
+        with console.status("Scanning CAN bus"):
+            nodes = dpload.probe(range(start, end + 1), timeout=timeout)
+            info = dpload.get_info_many(sorted(nodes))
+    except can.exceptions.CanOperationError:
+        error_console.print("[bold red]ERROR:[/bold red] Cannot complete scan")
+        sys.exit(1)
 
     table = Table(title="Active nodes")
     table.add_column("Node Address", justify="right", style="cyan")
@@ -402,23 +848,68 @@ def scan(dpload, start, end):
     table.add_column("Bootloader", justify="center", style="green")
     table.add_column("Application", justify="right", style="green")
 
-    for da, major, minor in nodes:
-        base, pn, pnmajor, pnminor = dpload.get_oem_info(da=da, timeout=0.5)
-        try:
-            appmajor, appminor = dpload.get_app_info(da=da, timeout=0.5)
-        except TimeoutError:
-            app_info = "?"
+    for da, (major, minor) in sorted(nodes.items()):
+        oem_info, app_info = info[da]
+        if oem_info is None:
+            part_number = "?"
         else:
-            app_info = f"{appmajor:x}.{appminor:x}"
+            base, pn, pnmajor, pnminor = oem_info
+            part_number = f"{pn} {pnmajor:x}.{pnminor:x}"
+        if app_info is None:
+            app_version = "?"
+        else:
+            appmajor, appminor = app_info
+            app_version = f"{appmajor:x}.{appminor:x}"
 
         table.add_row(
             f"{da} ({da:#02x})",
-            f"{pn} {pnmajor:x}.{pnminor:x}",
+            part_number,
             f"{major:x}.{minor:x}",
-            app_info,
+            app_version,
         )
     console.print(table)
 
 
+@cli.command()
+@click.option(
+    "--da",
+    default=None,
+    help="Only show this node",
+    type=SA_TYPE,
+)
+@click.pass_obj
+def rtt(dpload, da):
+    """Show the measured round-trip times behind adaptive timeouts"""
+    if da is not None:
+        name = dpload.identify(da)
+        stats = {f"{da}" if name is None else name.hex(): dpload.rtt.stats(da)}
+    else:
+        stats = dpload.rtt.stats()
+
+    table = Table(title="Round-trip times")
+    table.add_column("Node", style="cyan")
+    table.add_column("Command")
+    table.add_column("Samples", justify="right")
+    table.add_column("Timeouts", justify="right")
+    table.add_column("SRTT ms", justify="right")
+    table.add_column("RTTVAR ms", justify="right")
+    table.add_column("Timeout ms", justify="right", style="green")
+    for node, commands in sorted(stats.items()):
+        for command, entry in sorted(commands.items()):
+            if not entry["samples"]:
+                table.add_row(node, command, "0", str(entry["timeouts"]), "", "", "")
+                continue
+            table.add_row(
+                node,
+                command,
+                str(entry["samples"]),
+                str(entry["timeouts"]),
+                f"{entry['srtt'] * 1e3:0.1f}",
+                f"{entry['rttvar'] * 1e3:0.1f}",
+                f"{entry['timeout'] * 1e3:0.1f}",
+            )
+    console.print(table)
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,379 @@
+import asyncio
+import binascii
+import collections
+import logging
+import struct
+import time
+
+import can
+
+from dpload2.dispatch import Dispatcher, Subscription
+from dpload2.dpload import (
+    PF_BOOTLOADER,
+    DEFAULT_WINDOW,
+    RECORDS_PER_REQUEST,
+    BOOT_INFO_FORMAT,
+    OEM_INFO_FORMAT,
+    APP_INFO_FORMAT,
+    CRC_REQUEST_FORMAT,
+    CRC_RESPONSE_FORMAT,
+    ERASE_ALL,
+    REQUEST_ADDRESS_CLAIMED,
+    ProgrammingError,
+    response_payload,
+    chunked,
+)
+from dpload2.j1939 import (
+    build_id,
+    is_pdu1,
+    pgn_text,
+    TransportProtocol,
+    J1939_PF_REQUEST,
+    J1939_PF_ADDRESS_CLAIMED,
+    J1939_TP_WINDOW,
+    J1939_ADDR_GLOBAL,
+    J1939_DEFAULT_PRIORITY,
+    J1939_PGN_ECUID,
+    J1939_PGN_SOFT,
+)
+from dpload2.pacing import TxPacer
+from dpload2.protocol import (
+    encode,
+    FrameDecoder,
+    CMD_READ_BOOT_INFO,
+    CMD_ERASE_FLASH,
+    CMD_PROGRAM_FLASH,
+    CMD_READ_CRC,
+    CMD_JUMP_TO_APP,
+    CMD_READ_OEM_INFO,
+    CMD_READ_APP_INFO,
+    InvalidFrameError,
+    CrcMismatchError,
+)
+
+
+class AsyncSubscription(Subscription):
+    """Subscription whose messages are awaited on the dispatcher's event loop"""
+
+    def __init__(self, dispatcher, keys):
+        Subscription.__init__(self, dispatcher, keys)
+        self.queue = asyncio.Queue()
+
+    def put(self, msg):
+        self.queue.put_nowait(msg)
+
+    async def get(self, timeout=None):
+        try:
+            # wait_for gives up on a zero timeout before get() has run
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class AsyncDispatcher(Dispatcher):
+    """Dispatcher that delivers messages on an asyncio event loop
+
+    The notifier hands every message to the loop with call_soon_threadsafe,
+    so routing and queueing happen in the loop's thread.
+    """
+
+    subscription_class = AsyncSubscription
+
+    def __init__(self, bus, timeout=0.5, loop=None):
+        Dispatcher.__init__(
+            self, bus, timeout=timeout, loop=loop or asyncio.get_running_loop()
+        )
+
+
+class QueuedSender:
+    """Sends frames handed over on the event loop thread without blocking it
+
+    TransportProtocol answers TP frames from the receive callback, which for
+    an AsyncDispatcher runs on the event loop. The frames it sends are
+    queued here and go out in order from a task, through the pacer's
+    send_async.
+    """
+
+    def __init__(self, pacer):
+        self.log = logging.getLogger("dpload.j1939")
+        self.pacer = pacer
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def send(self, msg):
+        self._queue.put_nowait(msg)
+
+    async def _run(self):
+        while True:
+            msg = await self._queue.get()
+            try:
+                await self.pacer.send_async(msg)
+            except can.CanError as e:
+                self.log.warning("TP frame not sent: %s", e)
+
+    def close(self):
+        self._task.cancel()
+
+
+class AsyncJ1939:
+    def __init__(
+        self, bus, sa=0x27, dispatcher=None, pacer=None, tp_window=J1939_TP_WINDOW
+    ):
+        self.bus = bus
+        self.sa = sa
+        self.dispatcher = dispatcher or AsyncDispatcher(bus)
+        self.pacer = pacer or TxPacer(bus)
+        # Reassembles multi-packet answers on the event loop
+        self.tp_sender = QueuedSender(self.pacer)
+        self.tp = TransportProtocol(
+            self.dispatcher, self.tp_sender, sa, window=tp_window
+        )
+
+    def close(self):
+        self.tp.close()
+        self.tp_sender.close()
+
+    async def send_pf_to(
+        self, pf, data, da=J1939_ADDR_GLOBAL, sa=None, pri=J1939_DEFAULT_PRIORITY
+    ):
+        pgn = (pf << 8) + da
+        await self.send_pgn(pgn, data, sa=sa, pri=pri)
+
+    async def send_pgn(self, pgn, data, sa=None, pri=J1939_DEFAULT_PRIORITY):
+        msg = can.Message(
+            arbitration_id=build_id(pgn, sa or self.sa, pri=pri),
+            data=data,
+            is_extended_id=True,
+        )
+        await self.pacer.send_async(msg)
+
+    async def request_pgn(
+        self, pgn, da=J1939_ADDR_GLOBAL, pri=J1939_DEFAULT_PRIORITY, timeout=1.0
+    ):
+        """Request a PGN, receiving the response directly or over TP.CM/TP.DT"""
+        pgn_bytes = pgn.to_bytes(length=3, byteorder="little", signed=False)
+        src = None if da == J1939_ADDR_GLOBAL else da
+        if is_pdu1(pgn):
+            keys = [
+                (src, (pgn & 0x3FF00) | address)
+                for address in (self.sa, J1939_ADDR_GLOBAL)
+            ]
+        else:
+            keys = [(src, pgn)]
+        with self.dispatcher.subscribe(*keys) as subscription:
+            await self.send_pf_to(J1939_PF_REQUEST, data=pgn_bytes, da=da, pri=pri)
+
+            expiry = time.monotonic() + timeout
+            while expiry is not None:
+                msg = await subscription.get(max(0, expiry - time.monotonic()))
+                if msg is not None:
+                    return pgn_text(msg.data)
+                if time.monotonic() >= expiry:
+                    self.tp.expire()
+                    expiry = self.tp.pending(pgn, src)
+            # A session may have finished just before it was looked for
+            msg = await subscription.get(0)
+        if msg is None:
+            raise TimeoutError("Timeout waiting for data")
+        return pgn_text(msg.data)
+
+
+class AsyncDPLoad:
+    """asyncio counterpart of DPLoad
+
+    Must be created inside a running event loop. It owns the receive side of
+    the bus, so it cannot share a bus with a DPLoad. Any number of
+    operations on different nodes may run concurrently as tasks; requests to
+    the same node are serialised. Timeouts raise TimeoutError. Cancelling a
+    task abandons its request and unsubscribes from the response.
+    """
+
+    def __init__(self, bus, sa=39, da=208):
+        self.log = logging.getLogger("dpload")
+        self.bus = bus
+        self.busname = bus.channel
+
+        self.sa = sa
+        self.da = da
+
+        self.dispatcher = AsyncDispatcher(self.bus)
+        self.pacer = TxPacer(self.bus)
+        self.j1939 = AsyncJ1939(
+            self.bus, sa=self.sa, dispatcher=self.dispatcher, pacer=self.pacer
+        )
+        self._node_locks = collections.defaultdict(asyncio.Lock)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the background receiver"""
+        self.j1939.close()
+        self.dispatcher.shutdown()
+
+    async def _send_frame(self, cmd, payload, da):
+        tx_id = 0x18D60000 + (da << 8) + self.sa
+        txframe = encode(cmd, payload)
+        self.log.debug(
+            "TX [%#02x]=>[%#02x] %s",
+            self.sa,
+            da,
+            binascii.hexlify(txframe).decode("utf-8"),
+        )
+        for offset in range(0, len(txframe), 8):
+            msg = can.Message(arbitration_id=tx_id, data=txframe[offset : offset + 8])
+            await self.pacer.send_async(msg)
+
+    async def _recv_frame(self, subscription, decoder, cmd, da, expiry):
+        while True:
+            response = decoder.feed()
+            if response is None:
+                remaining = expiry - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("Timeout waiting for response")
+                msg = await subscription.get(remaining)
+                if msg is None:
+                    continue
+                response = decoder.feed(msg.data)
+                if response is None:
+                    continue
+
+            self.log.debug(
+                "RX [%#02x]=>[%#02x] %s",
+                da,
+                self.sa,
+                binascii.hexlify(response).decode("utf-8"),
+            )
+            return response_payload(response, cmd)
+
+    async def _request(self, cmd, payload=None, timeout=1.0, da=None):
+        if da is None:
+            da = self.da
+
+        async with self._node_locks[da]:
+            key = (da, (PF_BOOTLOADER << 8) | self.sa)
+            with self.dispatcher.subscribe(key) as subscription:
+                await self._send_frame(cmd, payload, da)
+                return await self._recv_frame(
+                    subscription, FrameDecoder(), cmd, da, time.time() + timeout
+                )
+
+    async def ecu_info(self, da=255):
+        ecu_info = await self.j1939.request_pgn(J1939_PGN_ECUID, da=da, timeout=0.1)
+        self.log.info("Got ECU Info for %d: %s", da, ecu_info)
+        return ecu_info
+
+    async def soft_info(self, da=255):
+        soft_info = await self.j1939.request_pgn(J1939_PGN_SOFT, da=da, timeout=0.1)
+        self.log.info("Got software version information for %d: %s", da, soft_info)
+        return soft_info
+
+    async def scan(self, timeout=2.0):
+        claims = self.dispatcher.subscribe(
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | J1939_ADDR_GLOBAL)
+        )
+        with claims:
+            await self.j1939.send_pf_to(J1939_PF_REQUEST, data=REQUEST_ADDRESS_CLAIMED)
+            expiry = time.time() + timeout
+            cas = []
+            while (remaining := expiry - time.time()) > 0:
+                msg = await claims.get(remaining)
+                if msg is not None:
+                    cas.append((msg.arbitration_id & 0xFF, msg.data))
+        return cas
+
+    async def program_flash(self, record, da=None, timeout=2.0):
+        """write a raw intel hex record to flash"""
+        await self._request(CMD_PROGRAM_FLASH, record, da=da, timeout=timeout)
+        return None
+
+    async def program_stream(
+        self,
+        records,
+        da=None,
+        window=DEFAULT_WINDOW,
+        records_per_request=RECORDS_PER_REQUEST,
+        timeout=2.0,
+        progress=None,
+    ):
+        """Async version of DPLoad.program_stream"""
+        if da is None:
+            da = self.da
+
+        chunks = chunked(records, records_per_request)
+        in_flight = collections.deque()
+        confirmed = 0
+        decoder = FrameDecoder()
+        key = (da, (PF_BOOTLOADER << 8) | self.sa)
+        async with self._node_locks[da]:
+            with self.dispatcher.subscribe(key) as subscription:
+                try:
+                    while True:
+                        while len(in_flight) < window:
+                            chunk = next(chunks, None)
+                            if chunk is None:
+                                break
+                            await self._send_frame(CMD_PROGRAM_FLASH, chunk, da)
+                            in_flight.append((len(chunk), time.time() + timeout))
+
+                        if not in_flight:
+                            return confirmed
+
+                        size, expiry = in_flight[0]
+                        await self._recv_frame(
+                            subscription, decoder, CMD_PROGRAM_FLASH, da, expiry
+                        )
+                        in_flight.popleft()
+                        confirmed += size
+                        if progress is not None:
+                            progress(confirmed)
+                except (
+                    TimeoutError,
+                    ValueError,
+                    InvalidFrameError,
+                    CrcMismatchError,
+                    can.CanError,
+                ) as e:
+                    raise ProgrammingError(
+                        f"Programming stopped after {confirmed} bytes: {e}", confirmed
+                    ) from e
+
+    async def get_boot_info(self, da=None, timeout=0.1):
+        payload = await self._request(CMD_READ_BOOT_INFO, da=da, timeout=timeout)
+        major, minor = struct.unpack(BOOT_INFO_FORMAT, payload)
+        return major, minor
+
+    async def get_oem_info(self, da=None, timeout=0.1):
+        payload = await self._request(CMD_READ_OEM_INFO, da=da, timeout=timeout)
+        sa, pn, vmajor, vminor = struct.unpack(OEM_INFO_FORMAT, payload)
+        return sa, pn.decode("utf-8"), vmajor, vminor
+
+    async def get_app_info(self, da=None, timeout=0.1):
+        payload = await self._request(CMD_READ_APP_INFO, da=da, timeout=timeout)
+        vmajor, vminor = struct.unpack(APP_INFO_FORMAT, payload)
+        return vmajor, vminor
+
+    async def get_crc(self, da=None, timeout=0.1, start=0x9D007000, size=0x79000):
+        self.log.debug("Getting CRC for %d bytes starting at %#08x", size, start)
+        data = struct.pack(CRC_REQUEST_FORMAT, start, size, 0x00000000, 0x00000000)
+        payload = await self._request(CMD_READ_CRC, data, da=da, timeout=timeout)
+        return struct.unpack(CRC_RESPONSE_FORMAT, payload)[0]
+
+    async def erase(self, da=None, timeout=1.0, start=None, size=None):
+        """Erase the application, or only [start, start + size)"""
+        if start is None:
+            request = ERASE_ALL
+        else:
+            request = struct.pack("<LL", start, size)
+        await self._request(CMD_ERASE_FLASH, request, da=da, timeout=timeout)
+        return None
+
+    async def jump(self, da=None, timeout=2.0):
+        return await self._request(CMD_JUMP_TO_APP, da=da, timeout=timeout)
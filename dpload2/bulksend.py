@@ -0,0 +1,143 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import socket
+
+import can
+
+CAN_EFF_FLAG = 0x80000000
+CAN_FRAME_SIZE = 16
+MAX_FRAMES = 64
+
+
+class _CanFrame(ctypes.Structure):
+    _fields_ = [
+        ("can_id", ctypes.c_uint32),
+        ("len", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+        ("res0", ctypes.c_uint8),
+        ("len8_dlc", ctypes.c_uint8),
+        ("data", ctypes.c_uint8 * 8),
+    ]
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IoVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [
+        ctypes.c_int,
+        ctypes.POINTER(_MMsgHdr),
+        ctypes.c_uint,
+        ctypes.c_int,
+    ]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def _socketcan_socket(bus):
+    """The raw CAN socket of a python-can socketcan bus, or None"""
+    try:
+        from can.interfaces.socketcan import SocketcanBus
+    except ImportError:
+        return None
+    if not isinstance(bus, SocketcanBus):
+        return None
+    return bus.socket
+
+
+class BulkSender:
+    """Send the 8-byte slices of a buffer as CAN frames in few syscalls
+
+    On a socketcan bus all frames are handed to the kernel with one
+    sendmmsg() call per MAX_FRAMES frames, from a preallocated frame array.
+    Other interfaces, or systems without sendmmsg, fall back to one
+    bus.send per frame. When sendmmsg() finds the socket buffer full
+    (EAGAIN), the first frame goes through bus.send instead. Either way
+    send() reports how many frames went out and raises CanOperationError
+    with ENOBUFS only when none did, so the caller can back off and resend
+    the rest.
+    """
+
+    def __init__(self, bus, sock=None):
+        self.log = logging.getLogger("dpload.bulksend")
+        self.bus = bus
+        self.socket = sock if sock is not None else _socketcan_socket(bus)
+        if _sendmmsg is None:
+            self.socket = None
+        if self.socket is not None:
+            self._frames = (_CanFrame * MAX_FRAMES)()
+            self._iovecs = (_IoVec * MAX_FRAMES)()
+            self._headers = (_MMsgHdr * MAX_FRAMES)()
+            for frame, iovec, header in zip(self._frames, self._iovecs, self._headers):
+                iovec.iov_base = ctypes.addressof(frame)
+                iovec.iov_len = CAN_FRAME_SIZE
+                header.msg_hdr.msg_iov = ctypes.pointer(iovec)
+                header.msg_hdr.msg_iovlen = 1
+
+    @property
+    def bulk(self):
+        """True if frames go out through sendmmsg"""
+        return self.socket is not None
+
+    def send(self, arbitration_id, data, is_extended_id=True):
+        """Send data as consecutive frames, returning the number sent"""
+        if self.socket is None:
+            return self._send_one(arbitration_id, data, is_extended_id)
+
+        can_id = arbitration_id | (CAN_EFF_FLAG if is_extended_id else 0)
+        count = min(MAX_FRAMES, (len(data) + 7) // 8)
+        for i in range(count):
+            part = data[i * 8 : i * 8 + 8]
+            frame = self._frames[i]
+            frame.can_id = can_id
+            frame.len = len(part)
+            ctypes.memmove(frame.data, bytes(part), len(part))
+
+        sent = _sendmmsg(
+            self.socket.fileno(), self._headers, count, socket.MSG_DONTWAIT
+        )
+        if sent < 0:
+            error = ctypes.get_errno()
+            if error == errno.EAGAIN:
+                return self._send_one(arbitration_id, data, is_extended_id)
+            raise can.CanOperationError(
+                f"sendmmsg failed: {os.strerror(error)}", error_code=error
+            )
+        return sent
+
+    def _send_one(self, arbitration_id, data, is_extended_id):
+        msg = can.Message(
+            arbitration_id=arbitration_id,
+            data=data[:8],
+            is_extended_id=is_extended_id,
+        )
+        self.bus.send(msg)
+        return 1
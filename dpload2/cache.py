@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+def default_cache_path(filename="manifests.json"):
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "dpload2", filename)
+
+
+def node_identity(dpload, da):
+    """ECU identification of node da, or None if it does not answer"""
+    try:
+        identity = dpload.ecu_info(da=da)
+    except (TimeoutError, ValueError):
+        return None
+    if not identity.strip("\x00 "):
+        return None
+    return identity
+
+
+def forget_nodes(dpload, das, path=None):
+    """Drop the cached verification state of nodes das
+
+    For programming that does not otherwise keep the cache up to date, so a
+    later cached verify does not trust what was there before. The cache is
+    read and written back straight away, to keep other processes' changes.
+    """
+    cache = ManifestCache(path)
+    for da in das:
+        identity = node_identity(dpload, da)
+        if identity is not None:
+            cache.forget_node(identity)
+    cache.save()
+
+
+class ManifestCache:
+    """On-disk cache of image CRC manifests and node verification state
+
+    Three tables are kept in one JSON file:
+
+    files   path -> (mtime, size, hash) so unchanged files are not re-hashed
+    images  (image hash, page size) -> per-page and per-segment CRC-16
+    nodes   node identity -> image hash last programmed and whether verified
+
+    Images are identified by the SHA256 of the hex file. Each table is
+    limited in size and the least recently used entries are dropped first.
+    Call save() to write changes back.
+    """
+
+    def __init__(self, path=None, max_files=64, max_images=32, max_nodes=1024):
+        self.log = logging.getLogger("dpload.cache")
+        self.path = path or default_cache_path()
+        self.limits = {"files": max_files, "images": max_images, "nodes": max_nodes}
+        self.tables = {name: {} for name in self.limits}
+        self.dirty = False
+        try:
+            with open(self.path, "r") as f:
+                tables = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            self.log.warning("Ignoring unreadable cache %s: %s", self.path, e)
+        else:
+            for name in self.limits:
+                self.tables[name] = tables.get(name, {})
+
+    def _get(self, table, key):
+        entry = self.tables[table].get(key)
+        if entry is not None:
+            entry["used"] = time.time()
+            self.dirty = True
+        return entry
+
+    def _put(self, table, key, entry):
+        entry["used"] = time.time()
+        self.tables[table][key] = entry
+        self.dirty = True
+
+    def image_hash(self, path):
+        """SHA256 of the file at path, re-hashed only if its mtime or size changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._get("files", path)
+        if (
+            entry is not None
+            and entry["mtime"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return entry["hash"]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                digest.update(block)
+        image_hash = digest.hexdigest()
+        self._put(
+            "files",
+            path,
+            {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": image_hash},
+        )
+        return image_hash
+
+    def get_manifest(self, image_hash, page_size):
+        """(pages, segments) for an image, or None if not cached
+
+        pages is {page_address: crc}; segments is a list of
+        (start, size, crc) tuples.
+        """
+        entry = self._get("images", f"{image_hash}:{page_size}")
+        if entry is None:
+            return None
+        pages = {int(address): crc for address, crc in entry["pages"].items()}
+        segments = [tuple(segment) for segment in entry["segments"]]
+        return pages, segments
+
+    def put_manifest(self, image_hash, page_size, pages, segments):
+        self._put(
+            "images",
+            f"{image_hash}:{page_size}",
+            {
+                "pages": {str(address): crc for address, crc in pages.items()},
+                "segments": [list(segment) for segment in segments],
+            },
+        )
+
+    def is_verified(self, node, image_hash):
+        """True if node was last verified to hold this image"""
+        entry = self._get("nodes", node)
+        return entry is not None and entry["image"] == image_hash and entry["verified"]
+
+    def set_node(self, node, image_hash, verified=False):
+        """Record the image just programmed onto, or verified on, node"""
+        self._put("nodes", node, {"image": image_hash, "verified": verified})
+
+    def forget_node(self, node):
+        if self.tables["nodes"].pop(node, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        """Write the cache back, dropping least recently used entries over the limits"""
+        if not self.dirty:
+            return
+        for name, limit in self.limits.items():
+            table = self.tables[name]
+            if len(table) > limit:
+                keep = sorted(table, key=lambda key: table[key]["used"])[-limit:]
+                self.tables[name] = {key: table[key] for key in keep}
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # Write a temporary file and rename it so readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".manifests-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.tables, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.dirty = False
@@ -0,0 +1,122 @@
+import logging
+import queue
+import threading
+
+import can
+
+
+def key_from_id(can_id):
+    """(source address, PGN) of a J1939 identifier
+
+    The PGN keeps the data page bit, as in the PGNs built by build_id. For
+    PDU1 PGNs the low byte of the PGN is the destination address, so a key
+    also selects who a message was sent to.
+    """
+    return can_id & 0xFF, (can_id & 0x03FFFF00) >> 8
+
+
+class Subscription:
+    """Queue of received messages matching one or more (sa, pgn) keys"""
+
+    def __init__(self, dispatcher, keys):
+        self.dispatcher = dispatcher
+        self.keys = keys
+        self.queue = queue.SimpleQueue()
+
+    def put(self, msg):
+        self.queue.put(msg)
+
+    def get(self, timeout=None):
+        """Next matching message, or None if none arrives within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.dispatcher.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CallbackSubscription(Subscription):
+    """Subscription that hands each message straight to a callback
+
+    The callback runs on the receive thread, so it must be quick and must not
+    wait for other messages.
+    """
+
+    def __init__(self, dispatcher, keys, callback):
+        super().__init__(dispatcher, keys)
+        self.callback = callback
+
+    def put(self, msg):
+        self.callback(msg)
+
+
+class Dispatcher(can.Listener):
+    """Long-lived receiver that routes frames to subscribers by (sa, pgn)
+
+    A single can.Notifier thread reads the bus. Every received extended frame
+    is delivered to each subscription whose key matches its source address
+    and PGN; None in a key matches anything. Frames nobody subscribed to are
+    dropped. Subscribe before sending a request so the response cannot be
+    missed. Without a bus, messages are fed in through on_message_received.
+    """
+
+    subscription_class = Subscription
+
+    def __init__(self, bus, timeout=0.5, loop=None):
+        self.log = logging.getLogger("dpload.dispatch")
+        self.bus = bus
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+        self.notifier = None
+        if bus is not None:
+            self.notifier = can.Notifier(bus, [self], timeout=timeout, loop=loop)
+
+    def subscribe(self, *keys):
+        """Subscribe to messages matching any of the (sa, pgn) keys"""
+        return self._add(self.subscription_class(self, keys))
+
+    def subscribe_callback(self, callback, *keys):
+        """Call callback(msg) on the receive thread for every matching message"""
+        return self._add(CallbackSubscription(self, keys, callback))
+
+    def _add(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                self._subscriptions.setdefault(key, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                subscribers = self._subscriptions.get(key, [])
+                if subscription in subscribers:
+                    subscribers.remove(subscription)
+                if not subscribers:
+                    self._subscriptions.pop(key, None)
+
+    def on_message_received(self, msg):
+        if not msg.is_extended_id or msg.is_error_frame or not msg.is_rx:
+            return
+
+        sa, pgn = key_from_id(msg.arbitration_id)
+        with self._lock:
+            matches = set()
+            for key in ((sa, pgn), (None, pgn), (sa, None), (None, None)):
+                matches.update(self._subscriptions.get(key, ()))
+        for subscription in matches:
+            subscription.put(msg)
+
+    def on_error(self, exc):
+        self.log.error("Receive thread stopped: %s", exc)
+
+    def shutdown(self):
+        if self.notifier is not None:
+            self.notifier.stop()
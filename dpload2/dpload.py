@@ -1,13 +1,18 @@
 import binascii
+import collections
 import struct
 import logging
+import threading
 import time
 
 import can
 
 from dpload2.protocol import (
+    crc16,
     encode,
-    decode,
+    encode_into,
+    max_encoded_size,
+    FrameDecoder,
     CMD_READ_BOOT_INFO,
     CMD_ERASE_FLASH,
     CMD_PROGRAM_FLASH,
@@ -15,18 +20,174 @@ from dpload2.protocol import (
     CMD_JUMP_TO_APP,
     CMD_READ_OEM_INFO,
     CMD_READ_APP_INFO,
-    IncompleteFrameError,
+    InvalidFrameError,
+    CrcMismatchError,
 )
 
+from dpload2.bulksend import BulkSender
+from dpload2.dispatch import Dispatcher
+from dpload2.image import ERASED, data_segments, page_map, select_pages
 from dpload2.j1939 import (
     J1939,
+    J1939_PF_ADDRESS_CLAIMED,
+    J1939_PF_DM13,
+    J1939_PF_REQUEST,
+    J1939_ADDR_GLOBAL,
     J1939_PGN_ECUID,
     J1939_PGN_SOFT,
 )
+from dpload2.j1939_kernel import open_kernel_j1939
+from dpload2.network import NetworkMonitor
+from dpload2.pacing import TxPacer
+from dpload2.rtt import RttTable
+
+PF_BOOTLOADER = 0xD6
+
+APP_START = 0x1D007000
+APP_SIZE = 0x79000
+PAGE_SIZE = 4096
+
+# Programming requests in flight: wait for each answer, as the bootloader has
+# only been run pipelined against the simulator
+DEFAULT_WINDOW = 1
+CRC_WINDOW = 4
+RECORDS_PER_REQUEST = 8
+
+BOOT_INFO_FORMAT = "BB"
+OEM_INFO_FORMAT = "B11sxxBB16x"
+APP_INFO_FORMAT = "BB30x"
+CRC_REQUEST_FORMAT = "<LL2xLL"
+CRC_RESPONSE_FORMAT = "<H"
+ERASE_ALL = struct.pack("<LL", 0xFFFFFFFF, 0xFFFFFFFF)
+ENTER_BOOTLOADER = bytes.fromhex("0301040105090206")
+REQUEST_ADDRESS_CLAIMED = bytes.fromhex("ffee00")
+
+COMMAND_NAMES = {
+    CMD_READ_BOOT_INFO: "boot_info",
+    CMD_ERASE_FLASH: "erase",
+    CMD_PROGRAM_FLASH: "program",
+    CMD_READ_CRC: "crc",
+    CMD_JUMP_TO_APP: "jump",
+    CMD_READ_OEM_INFO: "oem_info",
+    CMD_READ_APP_INFO: "app_info",
+}
+
+# Timeouts used until a command's round-trip time has been measured
+DEFAULT_TIMEOUTS = {
+    "boot_info": 0.1,
+    "oem_info": 0.1,
+    "app_info": 0.1,
+    "program": 5.0,
+    "crc": 5.0,
+    "erase": 5.0,
+    "jump": 2.0,
+    "claim": 0.5,
+}
+
+# (floor, ceiling) of adaptive timeouts where the default ones are too tight:
+# a spurious timeout while erasing or programming abandons the node
+RTT_LIMITS = {
+    "erase": (1.0, 60.0),
+    "program": (0.5, 30.0),
+}
+
+
+class ProgrammingError(Exception):
+    def __init__(self, message, confirmed=0):
+        super().__init__(message)
+        self.confirmed = confirmed
+
+
+class CrcTimeoutError(TimeoutError):
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
+
+class NodeResult:
+    """Outcome of programming one node with DPLoad.program_many"""
+
+    def __init__(self, da):
+        self.da = da
+        self.stage = "pending"
+        self.confirmed = 0
+        self.error = None
+        self.elapsed = 0.0
+        # Filled in by delta programming
+        self.pages_total = 0
+        self.pages_skipped = 0
+        self.full_erase = True
+        self.program_time = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None and self.stage == "done"
+
+
+def response_payload(response, cmd):
+    """Payload of a decoded response frame, checking that it answers cmd"""
+    response_cmd, payload = response[1], response[2:-3]
+    if response_cmd != cmd:
+        raise ValueError(
+            f"Expected command {cmd:#02x}, but received {response_cmd:#02x}"
+        )
+    return payload
+
+
+def image_crcs(records, start=APP_START, size=APP_SIZE, page_size=PAGE_SIZE):
+    """Reference CRCs of an image, as (pages, segments)
+
+    pages maps the address of every page of [start, start + size) to the CRC
+    it should read back after programming. segments is a list of
+    (start, size, crc) tuples, one for each contiguous run of data.
+    """
+    pages = {
+        address: crc16(data)
+        for address, data in page_map(records, start, size, page_size).items()
+    }
+    segments = [
+        (address, len(data), crc16(data)) for address, data in data_segments(records)
+    ]
+    return pages, segments
+
+
+def rtt_key(cmd, size=None):
+    """Name that round-trip times of cmd are kept under
+
+    CRC and erase take longer the more flash they cover, so for those the
+    size is rounded up to a power of two and made part of the name.
+    """
+    name = COMMAND_NAMES[cmd]
+    if size is None:
+        return name
+    return f"{name}/{1 << max(0, size - 1).bit_length()}"
+
+
+def chunked(records, n):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == n:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
+
+
+def encode_requests(records, records_per_request=RECORDS_PER_REQUEST):
+    """Program requests for records, encoded ahead of time
+
+    Returns a list of (frame, size) with size the record bytes each frame
+    carries, for program_stream and program_many to send as they are.
+    """
+    return [
+        (encode(CMD_PROGRAM_FLASH, chunk), len(chunk))
+        for chunk in chunked(records, records_per_request)
+    ]
 
 
 class DPLoad:
-    def __init__(self, bus, sa=39, da=208):
+    def __init__(self, bus, sa=39, da=208, rtt=None, kernel_j1939=False):
         self.log = logging.getLogger("dpload")
         self.bus = bus
         self.busname = bus.channel
@@ -36,171 +197,755 @@ class DPLoad:
 
         self.dm13_task = None
 
-        self.j1939 = J1939(self.bus, sa=self.sa)
+        self.dispatcher = Dispatcher(self.bus)
+        self.pacer = TxPacer(self.bus)
+        self.sender = BulkSender(self.bus)
+        # With kernel_j1939, requests for PGNs, scans and DM13 go through the
+        # kernel's J1939 stack on socketcan if it has one; bootloader frames
+        # always use bus. Off by default until tried on real interfaces
+        self.j1939 = None
+        if kernel_j1939:
+            self.j1939 = open_kernel_j1939(self.bus, self.sa, self.dispatcher)
+        if self.j1939 is None:
+            self.j1939 = J1939(
+                self.bus, sa=self.sa, dispatcher=self.dispatcher, pacer=self.pacer
+            )
+        # Called on the main thread at most every callback_interval seconds
+        # while waiting, to keep a user interface responsive
         self.callback = None
-
-    def _flush_rx(self):
-        while True:
-            msg = self.bus.recv(0)
-            if msg is None:
-                return
+        self.callback_interval = 0.05
+        self._callback_due = 0.0
+        # Called as callback(da) after a node is erased, started or reset
+        self.node_changed = []
+        self.txbuf = bytearray(max_encoded_size(256))
+        self._tx_lock = threading.Lock()
+        # Timeouts left as None are derived from the round-trip times in
+        # here, which learns the NAME of each node from its address claims
+        self.rtt = RttTable(limits=RTT_LIMITS) if rtt is None else rtt
+        self._claims = self.dispatcher.subscribe_callback(
+            self._on_address_claimed,
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | J1939_ADDR_GLOBAL),
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | self.sa),
+        )
+        # Which node is at which address, from the address claims going by
+        self.network = NetworkMonitor(self.dispatcher, self.sa)
+
+    def close(self):
+        """Stop the background receiver and save the round-trip times"""
+        self.dm13_control(False)
+        self.j1939.close()
+        self.network.close()
+        self._claims.close()
+        self.dispatcher.shutdown()
+        self.rtt.save()
+
+    def _on_address_claimed(self, msg):
+        self.rtt.bind(msg.arbitration_id & 0xFF, msg.data)
+
+    def _timeout(self, da, key, timeout=None):
+        """timeout, or the adaptive timeout for key on node da if it is None"""
+        if timeout is not None:
+            return timeout
+        return self.rtt.timeout(da, key, DEFAULT_TIMEOUTS[key.split("/")[0]])
 
     def ecu_info(self, da=255):
-        self.bus.set_filters([])
         ecu_info = self.j1939.request_pgn(J1939_PGN_ECUID, da=da, timeout=0.1)
         self.log.info("Got ECU Info for %d: %s", da, ecu_info)
         return ecu_info
 
     def soft_info(self, da=255):
-        self.bus.set_filters([])
         soft_info = self.j1939.request_pgn(J1939_PGN_SOFT, da=da, timeout=0.1)
         self.log.info("Got software version information for %d: %s", da, soft_info)
         return soft_info
 
+    def ecu_info_all(self, timeout=0.5):
+        """{sa: ECU identification} of every node, from one global request"""
+        ecu_info = self.j1939.request_pgn_all(J1939_PGN_ECUID, timeout=timeout)
+        self.log.info("Got ECU Info from %d nodes", len(ecu_info))
+        return ecu_info
+
+    def soft_info_all(self, timeout=0.5):
+        """{sa: software versions} of every node, from one global request"""
+        soft_info = self.j1939.request_pgn_all(J1939_PGN_SOFT, timeout=timeout)
+        self.log.info("Got software version information from %d nodes", len(soft_info))
+        return soft_info
+
     def enter(self, timeout=1.0, da=None):
-        data = bytes.fromhex("0301040105090206")
+        data = ENTER_BOOTLOADER
         da = da or self.da
         tx_id = 0x18D60000 + (self.da << 8) + self.sa
         msg = can.Message(arbitration_id=tx_id, data=data)
-        self.bus.send(msg)
+        self.pacer.send(msg)
+        self._node_changed(da)
+
+    def _node_changed(self, da):
+        """Tell the node_changed callbacks that node da may now report differently"""
+        for callback in self.node_changed:
+            callback(da)
 
     def scan(self, timeout=2.0):
-        self.bus.set_filters(
-            [{"can_id": 0x18EEFF00, "can_mask": 0x3FFFF00, "extended": True}]
+        """Ask every node for its address claim, returning [(sa, NAME)]
+
+        Nodes that do not answer are dropped from the network map.
+        """
+        claims = self.j1939.dispatcher.subscribe(
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | J1939_ADDR_GLOBAL)
         )
+        with claims:
+            sent = time.monotonic()
+            self.j1939.send_pf_to(J1939_PF_REQUEST, REQUEST_ADDRESS_CLAIMED)
+            expiry = time.time() + timeout
+            cas = []
+            while (msg := self._wait(claims, expiry)) is not None:
+                sa = msg.arbitration_id & 0xFF
+                name = msg.data
+                cas.append((sa, name))
+
+        self.network.prune(claimed=sent)
+        return cas
 
-        data = bytes.fromhex("ffee00")
-        tx_id = 0x18EAFF00 + self.sa
-        msg = can.Message(arbitration_id=tx_id, data=data)
-        self.bus.send(msg)
-        self._flush_rx()
-        expiry = time.time() + timeout
-        cas = []
-        while time.time() < expiry:
-            msg = self.bus.recv(0.05)
-            if msg is None or not msg.is_rx:
-                if self.callback is not None:
-                    self.callback()
-                continue
-
-            sa = msg.arbitration_id & 0xFF
-            name = msg.data
-            cas.append((sa, name))
+    def wait_for_claim(self, da, timeout=60.0, since=None):
+        """Wait for node da to claim its address, returning its NAME or None
 
-        return cas
+        Claims seen from `since` on, on the monotonic clock, count; take it
+        before starting or resetting the node so a quick claim is not missed.
+        """
+        return self.network.wait_for_claim(da, timeout, since=since, tick=self._tick)
+
+    def identify(self, da=None, timeout=None):
+        """Ask node da for its address claim, returning its NAME or None
 
-    def _request(self, cmd, payload=None, timeout=1.0, da=None):
+        Round-trip times measured from then on are kept under the NAME.
+        """
         if da is None:
             da = self.da
-
-        tx_id = 0x18D60000 + (da << 8) + self.sa
-        rx_id = 0x18D60000 + (self.sa << 8) + da
-        self.bus.set_filters(
-            [{"can_id": rx_id, "can_mask": 0x1FFFFFFF, "extended": True}]
+        timeout = self._timeout(da, "claim", timeout)
+        claims = self.dispatcher.subscribe(
+            (da, (J1939_PF_ADDRESS_CLAIMED << 8) | J1939_ADDR_GLOBAL),
+            (da, (J1939_PF_ADDRESS_CLAIMED << 8) | self.sa),
         )
-        self._flush_rx()
-        txframe = encode(cmd, payload)
-
+        with claims:
+            tx_id = 0x18EA0000 + (da << 8) + self.sa
+            msg = can.Message(arbitration_id=tx_id, data=REQUEST_ADDRESS_CLAIMED)
+            self.pacer.send(msg)
+            sent = time.time()
+            msg = self._wait(claims, sent + timeout)
+        if msg is None:
+            self.rtt.timed_out(da, "claim")
+            return None
+        self.rtt.sample(da, "claim", time.time() - sent)
+        self.rtt.bind(da, msg.data)
+        return bytes(msg.data)
+
+    def _tick(self):
+        """Run the callback if it is due and this is the main thread"""
+        if self.callback is None or (
+            threading.current_thread() is not threading.main_thread()
+        ):
+            return None
+        now = time.monotonic()
+        if now >= self._callback_due:
+            self._callback_due = now + self.callback_interval
+            self.callback()
+        return self._callback_due - time.monotonic()
+
+    def _wait(self, subscription, expiry):
+        """Next message from subscription, or None once expiry has passed
+
+        Blocks for the whole remaining time, or until the callback is next
+        due when there is one.
+        """
+        while True:
+            until_tick = self._tick()
+            remaining = expiry - time.time()
+            if remaining <= 0:
+                return None
+            if until_tick is not None:
+                remaining = min(remaining, max(0, until_tick))
+            msg = subscription.get(remaining)
+            if msg is not None:
+                return msg
+
+    def _open(self, da):
+        """Subscribe to bootloader responses from node da"""
+        return self.dispatcher.subscribe((da, (PF_BOOTLOADER << 8) | self.sa))
+
+    def _send_frame(self, cmd, payload, da):
+        with self._tx_lock:
+            self._send_frame_locked(cmd, payload, da)
+
+    def _send_frame_locked(self, cmd, payload, da):
+        size = max_encoded_size(0 if payload is None else len(payload))
+        if len(self.txbuf) < size:
+            self.txbuf = bytearray(size)
+        length = encode_into(self.txbuf, cmd, payload)
+        self._send_encoded_locked(memoryview(self.txbuf)[:length], da)
+
+    def _send_encoded(self, txframe, da):
+        with self._tx_lock:
+            self._send_encoded_locked(txframe, da)
+
+    def _send_encoded_locked(self, txframe, da):
+        tx_id = 0x18D60000 + (da << 8) + self.sa
         self.log.debug(
             "TX [%#02x]=>[%#02x] %s",
             self.sa,
             da,
             binascii.hexlify(txframe).decode("utf-8"),
         )
-        err_count = 0
-        while len(txframe):
-            part = txframe[:8]
-            msg = can.Message(arbitration_id=tx_id, data=part)
-            try:
-                self.bus.send(msg)
-            except can.CanOperationError as e:
-                if err_count < 10 and e.error_code == 105:
-                    time.sleep(0.002)
-                    err_count += 1
-                    continue
-                else:
-                    raise
-            txframe = txframe[8:]
-
-        rxframe = b""
-        expiry = time.time() + timeout
-        while time.time() < expiry:
-            msg = self.bus.recv(0.001)
-            if msg is None or not msg.is_rx:
-                if self.callback is not None:
-                    self.callback()
-                continue
+        self.pacer.send_frames(self.sender, tx_id, txframe)
 
-            rxframe += msg.data
-
-            try:
-                response = decode(rxframe)
-            except IncompleteFrameError:
-                continue
-            except ValueError as e:
-                raise e
+    def _recv_frame(self, subscription, decoder, cmd, da, expiry):
+        """Wait until expiry for the response to cmd, returning its payload"""
+        while True:
+            response = decoder.feed()
+            if response is None:
+                msg = self._wait(subscription, expiry)
+                if msg is None:
+                    break
+
+                response = decoder.feed(msg.data)
+                if response is None:
+                    continue
 
             self.log.debug(
                 "RX [%#02x]=>[%#02x] %s",
                 da,
                 self.sa,
-                binascii.hexlify(rxframe).decode("utf-8"),
+                binascii.hexlify(response).decode("utf-8"),
             )
-            response_cmd, payload = response[1], response[2:-3]
+            return response_payload(response, cmd)
+        raise TimeoutError("Timeout waiting for response")
 
-            if response_cmd != cmd:
-                raise ValueError(
-                    f"Expected command {cmd:#02x}, but received {response_cmd:#02x}"
-                )
+    def _request(self, cmd, payload=None, timeout=None, da=None, key=None):
+        """Send cmd to node da and return the payload of its answer
 
-            return payload
-        raise TimeoutError("Timeout waiting for response")
+        Without a timeout, waits as long as the round-trip times measured
+        under key, which defaults to the name of cmd, suggest.
+        """
+        if da is None:
+            da = self.da
+        if key is None:
+            key = rtt_key(cmd)
+        timeout = self._timeout(da, key, timeout)
+
+        with self._open(da) as subscription:
+            self._send_frame(cmd, payload, da)
+            sent = time.time()
+            try:
+                payload = self._recv_frame(
+                    subscription, FrameDecoder(), cmd, da, sent + timeout
+                )
+            except TimeoutError:
+                self.rtt.timed_out(da, key)
+                raise
+        self.rtt.sample(da, key, time.time() - sent)
+        return payload
+
+    def request_many(self, das, requests, timeout=None):
+        """Send requests to many nodes back to back and collect the answers
+
+        Every (cmd, payload) in requests is sent to every node in das before
+        anything is read. All responses arrive on one wildcard subscription
+        and share a single deadline, `timeout` after the last request went
+        out; without a timeout, the longest adaptive timeout of any of them.
+        Returns {da: [payload, ...]} with the payloads each node returned in
+        time, in request order; nodes that did not answer at all are left
+        out.
+        """
+        das = [da for da in das if da != self.sa]
+        decoders = {da: FrameDecoder() for da in das}
+        answers = {da: [] for da in das}
+        sent = {}
+        pending = len(das) * len(requests)
+        if timeout is None:
+            timeout = max(
+                (self._timeout(da, rtt_key(cmd)) for cmd, _ in requests for da in das),
+                default=0.0,
+            )
+        with self.dispatcher.subscribe(
+            (None, (PF_BOOTLOADER << 8) | self.sa)
+        ) as subscription:
+            for i, (cmd, payload) in enumerate(requests):
+                for da in das:
+                    self._send_frame(cmd, payload, da)
+                    sent[da, i] = time.time()
+
+            expiry = time.time() + timeout
+            while pending and (msg := self._wait(subscription, expiry)) is not None:
+                da = msg.arbitration_id & 0xFF
+                if da not in decoders or len(answers[da]) == len(requests):
+                    continue
+                data = msg.data
+                try:
+                    # A CAN frame may finish one response and start the next
+                    while (response := decoders[da].feed(data)) is not None:
+                        data = b""
+                        i = len(answers[da])
+                        cmd = requests[i][0]
+                        answers[da].append(response_payload(response, cmd))
+                        self.rtt.sample(da, rtt_key(cmd), time.time() - sent[da, i])
+                        pending -= 1
+                        if len(answers[da]) == len(requests):
+                            break
+                except (InvalidFrameError, CrcMismatchError, ValueError) as e:
+                    self.log.debug("Dropping response from %d: %s", da, e)
+                    decoders[da].reset()
+
+        return {da: payloads for da, payloads in answers.items() if payloads}
+
+    def probe(self, das=range(0, 254), timeout=None):
+        """Find bootloaders by asking every node in das for its boot info
+
+        Returns {da: (major, minor)} for the nodes that answered in time.
+        """
+        nodes = {}
+        for da, (payload,) in self.request_many(
+            das, [(CMD_READ_BOOT_INFO, None)], timeout=timeout
+        ).items():
+            try:
+                nodes[da] = struct.unpack(BOOT_INFO_FORMAT, payload)
+            except struct.error:
+                self.log.debug("Bad boot info from %d: %s", da, payload.hex())
+        return nodes
+
+    def get_info_many(self, das, timeout=None):
+        """OEM and application info of several nodes at once
+
+        Returns {da: (oem_info, app_info)}, each as returned by get_oem_info
+        and get_app_info, or None if that node did not answer it.
+        """
+        answers = self.request_many(
+            das, [(CMD_READ_OEM_INFO, None), (CMD_READ_APP_INFO, None)], timeout
+        )
+        info = {}
+        for da in das:
+            payloads = answers.get(da, []) + [None, None]
+            oem_info = app_info = None
+            try:
+                if payloads[0] is not None:
+                    sa, pn, vmajor, vminor = struct.unpack(OEM_INFO_FORMAT, payloads[0])
+                    oem_info = sa, pn.decode("utf-8"), vmajor, vminor
+                if payloads[1] is not None:
+                    app_info = struct.unpack(APP_INFO_FORMAT, payloads[1])
+            except (struct.error, UnicodeDecodeError):
+                self.log.debug("Bad info from %d", da)
+            info[da] = oem_info, app_info
+        return info
 
     def dm13_control(self, state, period=2.0):
         """Enable or disable DM13 broadcast"""
         if state and self.dm13_task is None:
-            msg = can.Message(
-                arbitration_id=0x18DFFF00 + self.sa,
-                data=bytes.fromhex("00ffff0fffffffff"),
-                is_extended_id=True,
+            self.dm13_task = self.j1939.send_periodic(
+                (J1939_PF_DM13 << 8) | J1939_ADDR_GLOBAL,
+                bytes.fromhex("00ffff0fffffffff"),
+                period,
             )
-
-            self.dm13_task = self.bus.send_periodic(msg, period)
         if not state and self.dm13_task is not None:
             self.dm13_task.stop()
             self.dm13_task = None
 
-    def program_flash(self, record, da=None, timeout=2.0):
+    def program_flash(self, record, da=None, timeout=None):
         """write a raw intel hex record to flash"""
         self._request(CMD_PROGRAM_FLASH, record, da=da, timeout=timeout)
         return None
 
-    def get_boot_info(self, da=None, timeout=0.1):
+    def program_stream(
+        self,
+        records,
+        da=None,
+        window=DEFAULT_WINDOW,
+        records_per_request=RECORDS_PER_REQUEST,
+        timeout=None,
+        progress=None,
+        requests=None,
+    ):
+        """Write raw intel hex records with up to `window` requests in flight
+
+        Records are sent `records_per_request` at a time, or as the
+        encode_requests() frames in requests if given. Responses are taken
+        to confirm the oldest outstanding request, so with a window over 1 a
+        response lost in the middle of the window is counted for the next
+        request. Each request must be answered within `timeout` of the node
+        finishing the one before it; without a timeout, the adaptive one.
+        progress, if given, is called with the number of bytes confirmed so
+        far. Returns the total number of bytes confirmed; on the
+        first error nothing more is sent and ProgrammingError is raised.
+        """
+        if da is None:
+            da = self.da
+
+        encoded = requests is not None
+        if not encoded:
+            requests = (
+                (chunk, len(chunk)) for chunk in chunked(records, records_per_request)
+            )
+        requests = iter(requests)
+        in_flight = collections.deque()
+        confirmed = 0
+        decoder = FrameDecoder()
+        ready = time.time()
+        subscription = self._open(da)
+        try:
+            while True:
+                while len(in_flight) < window:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    data, size = request
+                    if encoded:
+                        self._send_encoded(data, da)
+                    else:
+                        self._send_frame(CMD_PROGRAM_FLASH, data, da)
+                    in_flight.append((size, time.time()))
+
+                if not in_flight:
+                    return confirmed
+
+                size, sent = in_flight[0]
+                started = max(sent, ready)
+                try:
+                    self._recv_frame(
+                        subscription,
+                        decoder,
+                        CMD_PROGRAM_FLASH,
+                        da,
+                        started + self._timeout(da, "program", timeout),
+                    )
+                except TimeoutError:
+                    self.rtt.timed_out(da, "program")
+                    raise
+                ready = time.time()
+                self.rtt.sample(da, "program", ready - started)
+                in_flight.popleft()
+                confirmed += size
+                if progress is not None:
+                    progress(confirmed)
+        except (
+            TimeoutError,
+            ValueError,
+            InvalidFrameError,
+            CrcMismatchError,
+            can.CanError,
+        ) as e:
+            raise ProgrammingError(
+                f"Programming stopped after {confirmed} bytes: {e}", confirmed
+            ) from e
+        finally:
+            subscription.close()
+
+    def program_many(
+        self,
+        records,
+        das,
+        window=DEFAULT_WINDOW,
+        timeout=None,
+        erase_timeout=None,
+        verify=(),
+        jump=True,
+        delta=False,
+        page_crcs=None,
+        progress=None,
+        requests=None,
+    ):
+        """Erase, program, verify and start several nodes concurrently
+
+        Each node runs in its own thread. Frames are sent one request at a
+        time under the transmit lock, so the nodes take turns on the bus.
+        verify is a list of (start, size, crc) tuples to check with get_crc
+        after programming. With delta, only the application pages whose CRC
+        differs from the image are erased and programmed (see
+        erase_changed); page_crcs, if given, are the image's page CRCs as
+        returned by image_crcs. progress, if given, is called from the worker
+        threads as progress(da, stage, confirmed_bytes); in delta mode the
+        bytes of unchanged pages count as confirmed. requests, if given, are
+        records already encoded with encode_requests(), sent wherever all of
+        records is programmed. A failure on one node does not stop the
+        others. Returns {da: NodeResult}.
+        """
+        records = list(records)
+        results = {da: NodeResult(da) for da in das}
+        threads = [
+            threading.Thread(
+                target=self._program_node,
+                args=(result, records, window, timeout, erase_timeout, verify, jump),
+                kwargs={
+                    "delta": delta,
+                    "page_crcs": page_crcs,
+                    "progress": progress,
+                    "requests": requests,
+                },
+                name=f"program-{da}",
+                daemon=True,
+            )
+            for da, result in results.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _program_node(
+        self,
+        result,
+        records,
+        window,
+        timeout,
+        erase_timeout,
+        verify,
+        jump,
+        delta,
+        page_crcs,
+        progress,
+        requests,
+    ):
+        da = result.da
+        start = time.time()
+        unchanged = 0
+
+        def report(stage, confirmed=None):
+            result.stage = stage
+            if confirmed is not None:
+                result.confirmed = confirmed
+            if progress is not None:
+                progress(da, stage, unchanged + result.confirmed)
+
+        try:
+            if delta:
+                report("compare")
+                result.pages_total = APP_SIZE // PAGE_SIZE
+                changed = self.erase_changed(
+                    records, da=da, erase_timeout=erase_timeout, expected=page_crcs
+                )
+                if changed is not None:
+                    result.full_erase = False
+                    result.pages_skipped = result.pages_total - len(changed)
+                    selected = select_pages(records, changed, PAGE_SIZE)
+                    unchanged = sum(map(len, records)) - sum(map(len, selected))
+                    records = selected
+                    requests = None
+            else:
+                report("erase")
+                self.erase(da=da, timeout=erase_timeout)
+
+            report("program")
+            program_start = time.time()
+            self.program_stream(
+                records,
+                da=da,
+                window=window,
+                timeout=timeout,
+                progress=lambda confirmed: report("program", confirmed),
+                requests=requests,
+            )
+            result.program_time = time.time() - program_start
+
+            report("verify")
+            for address, size, expected in verify:
+                actual = self.get_crc(da=da, start=address, size=size)
+                if actual != expected:
+                    raise ValueError(
+                        f"Bad CRC at {address:#010x}: expected {expected:04X}, got {actual:04X}"
+                    )
+
+            if jump:
+                report("jump")
+                try:
+                    self.jump(da=da)
+                except TimeoutError:
+                    pass
+            report("done")
+        except ProgrammingError as e:
+            result.confirmed = e.confirmed
+            result.error = e
+        except (
+            TimeoutError,
+            ValueError,
+            InvalidFrameError,
+            CrcMismatchError,
+            can.CanError,
+        ) as e:
+            result.error = e
+        finally:
+            result.elapsed = time.time() - start
+
+    def get_boot_info(self, da=None, timeout=None):
         payload = self._request(CMD_READ_BOOT_INFO, da=da, timeout=timeout)
-        major, minor = struct.unpack("BB", payload)
+        major, minor = struct.unpack(BOOT_INFO_FORMAT, payload)
         return major, minor
 
-    def get_oem_info(self, da=None, timeout=0.1):
+    def get_oem_info(self, da=None, timeout=None):
         payload = self._request(CMD_READ_OEM_INFO, da=da, timeout=timeout)
-        sa, pn, vmajor, vminor = struct.unpack("B11sxxBB16x", payload)
+        sa, pn, vmajor, vminor = struct.unpack(OEM_INFO_FORMAT, payload)
         return sa, pn.decode("utf-8"), vmajor, vminor
 
-    def get_app_info(self, da=None, timeout=0.1):
+    def get_app_info(self, da=None, timeout=None):
         payload = self._request(CMD_READ_APP_INFO, da=da, timeout=timeout)
-        vmajor, vminor = struct.unpack("BB30x", payload)
+        vmajor, vminor = struct.unpack(APP_INFO_FORMAT, payload)
         return vmajor, vminor
 
-    def get_crc(self, da=None, timeout=0.1, start=0x9D007000, size=0x79000):
+    def get_crc(self, da=None, timeout=None, start=0x9D007000, size=0x79000):
         self.log.debug("Getting CRC for %d bytes starting at %#08x", size, start)
-        data = struct.pack("<LL2xLL", start, size, 0x00000000, 0x00000000)
-        payload = self._request(CMD_READ_CRC, data, da=da, timeout=timeout)
-        crc = struct.unpack("<H", payload)[0]
+        data = struct.pack(CRC_REQUEST_FORMAT, start, size, 0x00000000, 0x00000000)
+        payload = self._request(
+            CMD_READ_CRC, data, da=da, timeout=timeout, key=rtt_key(CMD_READ_CRC, size)
+        )
+        crc = struct.unpack(CRC_RESPONSE_FORMAT, payload)[0]
         return crc
 
-    def erase(self, da=None, timeout=1.0):
-        payload = struct.pack("<LL", 0xFFFFFFFF, 0xFFFFFFFF)
-        payload = self._request(CMD_ERASE_FLASH, payload, da=da, timeout=timeout)
+    def get_crcs(self, ranges, da=None, window=CRC_WINDOW, timeout=None):
+        """CRCs of several (start, size) ranges with up to `window` requests in flight
+
+        The bootloader answers in order, so each response belongs to the
+        oldest outstanding request. A request must be answered within
+        `timeout`, or else the adaptive timeout for its size, of the device
+        finishing the one before it. Returns a list
+        of (crc, seconds) in the order of ranges, where seconds runs from the
+        request being sent to its answer. Raises CrcTimeoutError, holding
+        the results so far, if an answer is late; nothing more is sent after
+        that.
+        """
+        if da is None:
+            da = self.da
+
+        ranges = iter(ranges)
+        in_flight = collections.deque()
+        results = []
+        decoder = FrameDecoder()
+        ready = time.time()
+        with self._open(da) as subscription:
+            while True:
+                while len(in_flight) < window:
+                    span = next(ranges, None)
+                    if span is None:
+                        break
+                    start, size = span
+                    self.log.debug(
+                        "Getting CRC for %d bytes starting at %#08x", size, start
+                    )
+                    data = struct.pack(CRC_REQUEST_FORMAT, start, size, 0, 0)
+                    self._send_frame(CMD_READ_CRC, data, da)
+                    in_flight.append((time.time(), rtt_key(CMD_READ_CRC, size)))
+
+                if not in_flight:
+                    return results
+
+                sent, key = in_flight[0]
+                started = max(sent, ready)
+                wait = self._timeout(da, key, timeout)
+                try:
+                    payload = self._recv_frame(
+                        subscription, decoder, CMD_READ_CRC, da, started + wait
+                    )
+                except TimeoutError:
+                    self.rtt.timed_out(da, key)
+                    raise CrcTimeoutError(
+                        f"No CRC for range {len(results)} within {wait:.3f} seconds",
+                        results,
+                    )
+                ready = time.time()
+                self.rtt.sample(da, key, ready - started)
+                in_flight.popleft()
+                crc = struct.unpack(CRC_RESPONSE_FORMAT, payload)[0]
+                results.append((crc, ready - sent))
+
+    def erase(self, da=None, timeout=None, start=None, size=None):
+        """Erase the application, or only [start, start + size)
+
+        Older bootloaders ignore the range and erase the whole application.
+        """
+        if start is None:
+            request = ERASE_ALL
+            key = rtt_key(CMD_ERASE_FLASH)
+        else:
+            request = struct.pack("<LL", start, size)
+            key = rtt_key(CMD_ERASE_FLASH, size)
+        try:
+            payload = self._request(
+                CMD_ERASE_FLASH, request, da=da, timeout=timeout, key=key
+            )
+        finally:
+            self._node_changed(self.da if da is None else da)
         return None
 
-    def jump(self, da=None, timeout=2.0):
-        return self._request(CMD_JUMP_TO_APP, da=da, timeout=timeout)
+    def erase_changed(
+        self,
+        records,
+        da=None,
+        timeout=None,
+        erase_timeout=None,
+        start=APP_START,
+        size=APP_SIZE,
+        page_size=PAGE_SIZE,
+        expected=None,
+    ):
+        """Erase only the pages that differ from what records would program
+
+        Every page of [start, start + size) is compared by CRC, with bytes the
+        records leave out expected to be erased. expected, if given, is the
+        {page_address: crc} map image_crcs returns for records. Runs of changed pages are
+        erased by range. The first range erase is checked: its first page must
+        read back blank and an unchanged page holding data must still match.
+        If not, or if no unchanged page holds data, the bootloader is taken
+        not to support range erase, so the whole application is erased
+        instead. Returns the sorted addresses of the changed pages,
+        which are now blank, or None after a full erase.
+        """
+        if expected is None:
+            expected, _ = image_crcs(records, start, size, page_size)
+        actual = self.get_crcs(
+            [(address, page_size) for address in expected], da=da, timeout=timeout
+        )
+        changed = [
+            address
+            for address, (crc, _) in zip(expected, actual)
+            if crc != expected[address]
+        ]
+        if not changed:
+            return changed
+
+        ranges = []
+        for address in changed:
+            if ranges and ranges[-1][0] + ranges[-1][1] == address:
+                ranges[-1][1] += page_size
+            else:
+                ranges.append([address, page_size])
+
+        blank = crc16(bytes([ERASED]) * page_size)
+        changed_pages = set(changed)
+        # A blank page reads back the same after a full erase, so only a page
+        # with data shows whether the erase kept to its range
+        unchanged = next(
+            (a for a in expected if a not in changed_pages and expected[a] != blank),
+            None,
+        )
+        supported = False
+        try:
+            if unchanged is not None:
+                first, first_size = ranges[0]
+                self.erase(da=da, timeout=erase_timeout, start=first, size=first_size)
+                erased = self.get_crc(
+                    da=da, timeout=timeout, start=first, size=page_size
+                )
+                kept = self.get_crc(
+                    da=da, timeout=timeout, start=unchanged, size=page_size
+                )
+                supported = erased == blank and kept == expected[unchanged]
+        except TimeoutError:
+            supported = False
+
+        if not supported:
+            self.log.info("Node %s has no range erase; erasing everything", da)
+            self.erase(da=da, timeout=erase_timeout)
+            return None
+
+        for address, range_size in ranges[1:]:
+            self.erase(da=da, timeout=erase_timeout, start=address, size=range_size)
+        return changed
+
+    def jump(self, da=None, timeout=None):
+        try:
+            return self._request(CMD_JUMP_TO_APP, da=da, timeout=timeout)
+        finally:
+            self._node_changed(self.da if da is None else da)
@@ -0,0 +1,173 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import threading
+
+import can
+
+from dpload2.cache import forget_nodes
+from dpload2.dpload import DPLoad, DEFAULT_WINDOW, encode_requests
+from dpload2.image import read_hex_records, compact_records
+
+
+class FleetJob:
+    """Program the image at `path` onto node `da` on CAN interface `channel`"""
+
+    def __init__(self, channel, da, path):
+        self.channel = channel
+        self.da = da
+        self.path = path
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a CHANNEL:NODE:IMAGE job specification"""
+        try:
+            channel, da, path = text.split(":", 2)
+            return cls(channel, int(da, 0), path)
+        except ValueError:
+            raise ValueError(f"Job {text!r} is not of the form CHANNEL:NODE:IMAGE")
+
+
+class FleetResult:
+    """Outcome of one FleetJob, as returned by a worker process"""
+
+    def __init__(self, job, ok, stage, confirmed, elapsed, error=None):
+        self.job = job
+        self.ok = ok
+        self.stage = stage
+        self.confirmed = confirmed
+        self.elapsed = elapsed
+        self.error = error
+
+
+# Set in each worker process by _init_worker
+_images = None
+_events = None
+
+
+def _init_worker(images, events):
+    global _images, _events
+    _images = images
+    _events = events
+
+
+def _run_channel(interface, channel, bitrate, sa, jobs, window):
+    """Worker process: program every job on one CAN interface"""
+    bus = can.interface.Bus(interface=interface, channel=channel, bitrate=bitrate)
+    dpload = DPLoad(bus, sa=sa)
+
+    def progress(da, stage, confirmed):
+        _events.put((channel, da, stage, confirmed))
+
+    results = []
+    try:
+        by_image = collections.defaultdict(list)
+        for job in jobs:
+            by_image[job.path].append(job)
+
+        # The CLI's cached verify must not trust what the nodes held before
+        forget_nodes(dpload, [job.da for job in jobs])
+        dpload.dm13_control(True)
+        for path, image_jobs in by_image.items():
+            records, requests = _images[path]
+            node_results = dpload.program_many(
+                records,
+                [job.da for job in image_jobs],
+                window=window,
+                progress=progress,
+                requests=requests,
+            )
+            for job in image_jobs:
+                result = node_results[job.da]
+                results.append(
+                    FleetResult(
+                        job,
+                        result.ok,
+                        result.stage,
+                        result.confirmed,
+                        result.elapsed,
+                        None if result.error is None else str(result.error),
+                    )
+                )
+    finally:
+        dpload.close()
+        bus.shutdown()
+    return results
+
+
+def run_fleet(
+    jobs,
+    interface="socketcan",
+    bitrate=250000,
+    sa=39,
+    window=DEFAULT_WINDOW,
+    skip_blank=False,
+    progress=None,
+):
+    """Run jobs with one worker process per CAN interface
+
+    Each distinct image is read and encoded into program requests once in
+    the parent and handed to every worker when it starts. With skip_blank,
+    erased data is left out of the images (see compact_records), which is
+    safe as the workers erase first. progress, if given, is called in the
+    parent as progress(channel, da, stage, confirmed_bytes). Returns a list
+    of FleetResult, in the order of jobs.
+    """
+    images = {}
+    for job in jobs:
+        if job.path not in images:
+            with open(job.path, "r") as f:
+                records = read_hex_records(f)
+            if skip_blank:
+                records, _ = compact_records(records)
+            images[job.path] = records, encode_requests(records)
+
+    by_channel = collections.defaultdict(list)
+    for job in jobs:
+        by_channel[job.channel].append(job)
+
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
+
+    def forward_events():
+        while (event := events.get()) is not None:
+            if progress is not None:
+                progress(*event)
+
+    forwarder = threading.Thread(target=forward_events, daemon=True)
+    forwarder.start()
+
+    results = {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=len(by_channel),
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(images, events),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _run_channel, interface, channel, bitrate, sa, channel_jobs, window
+                ): channel_jobs
+                for channel, channel_jobs in by_channel.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    channel_results = future.result()
+                except Exception as e:
+                    channel_results = [
+                        FleetResult(job, False, "connect", 0, 0.0, str(e))
+                        for job in futures[future]
+                    ]
+                for result in channel_results:
+                    results[_job_key(result.job)] = result
+    finally:
+        events.put(None)
+        forwarder.join()
+
+    return [results[_job_key(job)] for job in jobs]
+
+
+def _job_key(job):
+    # Workers return copies of the jobs, so match them by value
+    return job.channel, job.da, job.path
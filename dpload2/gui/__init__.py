@@ -10,12 +10,18 @@ import intelhex
 import wx
 import wx.propgrid
 
-from dpload2.dpload import DPLoad
+from dpload2.cache import default_cache_path, forget_nodes
+from dpload2.dpload import DPLoad, ProgrammingError, RTT_LIMITS
+from dpload2.registry import NodeRegistry
+from dpload2.rtt import RttTable
 from dpload2.image import Image, ImageTlvType
 from dpload2.gui.gui import MainWindow, SettingsDialog, AboutDialog
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Attempts to reach the bootloader after asking the node to enter it
+CONNECT_ATTEMPTS = 5
+
 HEX_BIN_WILDCARD = "All supported images (*.hex;*.bin)|*.bin;*.hex|Intel HEX files (*.hex)|*.hex|Binary files (*.bin)|*.bin"
 
 
@@ -180,8 +186,10 @@ class GUI(MainWindow):
             channel=self.can_channel,
             bitrate=self.can_bitrate,
         )
-        self.dpload = DPLoad(bus=self.bus, sa=self.sa)
+        rtt = RttTable(default_cache_path("rtt.json"), limits=RTT_LIMITS)
+        self.dpload = DPLoad(bus=self.bus, sa=self.sa, rtt=rtt)
         self.dpload.callback = wx.Yield
+        self.registry = NodeRegistry(self.dpload)
         wx.CallLater(500, self.UpdateBusStatus)
 
     def _load_config(self):
@@ -220,6 +228,8 @@ class GUI(MainWindow):
 
     def fileExitClicked(self, event):
         self.disconnect()
+        self.registry.close()
+        self.dpload.close()
         self.dpload.bus.shutdown()
         sys.exit(0)
 
@@ -276,8 +286,10 @@ class GUI(MainWindow):
         wx.CallLater(0, pulse)
         wx.Yield()
 
+        # The CLI's cached verify must not trust what the node held before
+        forget_nodes(self.dpload, [self.da])
         try:
-            self.dpload.erase(da=self.da, timeout=5.0)
+            self.dpload.erase(da=self.da)
         except ValueError:
             self.m_statusBar.SetStatusText("Unexpected response", 0)
             self.m_toolBar1.EnableTool(self.m_toolDownload.GetId(), True)
@@ -291,42 +303,32 @@ class GUI(MainWindow):
 
         self.dpload.dm13_control(True)
         start = time.time()
-        total_bytes = 0
-        chunk = b""
-        n = 0
-        lines = self.image.hexdata.splitlines()
-        self.m_progressBar.SetRange(len(lines))
-        self.m_statusBar.SetStatusText(f"Programming {len(lines)} records")
-        for lineNum, lineText in enumerate(lines):
-            self.m_progressBar.SetValue(lineNum)
-            record = bytes.fromhex(lineText[1:].strip())
-            n += 1
-            chunk += record
-            if n == 8:
-                total_bytes += len(chunk)
-                try:
-                    self.dpload.program_flash(chunk, da=self.da, timeout=2.0)
-                except TimeoutError:
-                    self.m_statusBar.SetStatusText(
-                        "Timeout waiting for response. Programming failed"
-                    )
-                    self.dpload.dm13_control(False)
-                    return
-                speed_kb_per_sec = (total_bytes / 1024) / (time.time() - start)
-                self.m_statusBar.SetStatusText(f"{speed_kb_per_sec:0.1f} kByte/sec", 1)
-                chunk = b""
-                n = 0
-            wx.Yield()
-        if n:
-            try:
-                self.dpload.program_flash(chunk, da=self.da, timeout=2.0)
-            except TimeoutError:
-                self.m_statusBar.SetStatusText(
-                    "Timeout waiting for response. Programming failed"
-                )
-                self.dpload.dm13_control(False)
-                self.m_toolBar1.EnableTool(self.m_toolDownload.GetId(), True)
+        records = [
+            bytes.fromhex(line[1:].strip()) for line in self.image.hexdata.splitlines()
+        ]
+        self.m_progressBar.SetRange(sum(len(record) for record in records))
+        self.m_statusBar.SetStatusText(f"Programming {len(records)} records")
+
+        shown = [0.0]
+
+        def progress(confirmed):
+            # Responses arrive hundreds of times a second; redraw at 20 Hz
+            now = time.time()
+            if now - shown[0] < 0.05:
                 return
+            shown[0] = now
+            self.m_progressBar.SetValue(confirmed)
+            speed_kb_per_sec = (confirmed / 1024) / (now - start)
+            self.m_statusBar.SetStatusText(f"{speed_kb_per_sec:0.1f} kByte/sec", 1)
+
+        try:
+            self.dpload.program_stream(records, da=self.da, progress=progress)
+        except ProgrammingError as e:
+            self.m_statusBar.SetStatusText(f"Programming failed: {e}")
+            self.dpload.dm13_control(False)
+            self.m_toolBar1.EnableTool(self.m_toolDownload.GetId(), True)
+            return
+        self.m_progressBar.SetValue(self.m_progressBar.GetRange())
         wx.Yield()
         elapsed = time.time() - start
         self.m_statusBar.SetStatusText(
@@ -334,6 +336,7 @@ class GUI(MainWindow):
         )
         wx.Yield()
 
+        since = time.monotonic()
         self.dpload.jump(da=self.da)
         self.dpload.dm13_control(False)
 
@@ -342,31 +345,27 @@ class GUI(MainWindow):
         self.m_progressBar.Pulse()
         wx.CallLater(0, pulse)
 
-        expiry = time.time() + 60.0
         new_info = None
-        self.dpload._flush_rx()
-        self.dpload.bus.set_filters([])
-        while time.time() < expiry:
-            msg = self.dpload.bus.recv(0.1)
-            if msg is None or not msg.is_rx:
-                continue
-            if (msg.arbitration_id & 0x0FFFFFF) == (0x00EEFF00 + self.da):
-                break
-            self.m_progressBar.Pulse()
-            wx.Yield()
+        # pulse() keeps the bar moving while the callback yields to wx
+        claimed = self.dpload.wait_for_claim(self.da, timeout=60.0, since=since)
 
         self.disconnect()
         self.m_progressBar.SetRange(100)
         wx.CallAfter(self.m_progressBar.SetValue, 100)
-        if time.time() > expiry:
+        if claimed is None:
             self.m_statusBar.SetStatusText("Programming failed!", 0)
         else:
             wx.MilliSleep(2000)
 
-            new_info = self.dpload.soft_info(da=self.da)
+            try:
+                new_info = self.registry.soft_info(self.da)
+            except TimeoutError:
+                new_info = ""
             file_version = self.m_propertyGridFileInfo.GetProperty("Version").GetValue()
             device_version = new_info[4:].split("*", 1)[0]
-            if file_version != device_version:
+            if not new_info:
+                self.m_statusBar.SetStatusText("No software version reported", 0)
+            elif file_version != device_version:
                 self.m_statusBar.SetStatusText("Wrong version detected", 0)
 
             else:
@@ -392,7 +391,11 @@ class GUI(MainWindow):
 
         self.m_statusBar.SetStatusText("Scanning for devices...")
         wx.Yield()
-        nodes = self.dpload.scan()
+        nodes = self.registry.scan()
+        # One global request each for ECU identification and software
+        # versions, unless every node's are still cached; nodes that miss
+        # it are asked again one by one below
+        self.registry.inventory(das=[addr for addr, _ in nodes])
         wx.CallAfter(self.m_progressBar.SetValue, 100)
 
         self.m_nameList.DeleteAllItems()
@@ -415,7 +418,11 @@ class GUI(MainWindow):
             for label, value in decoded_name.items():
                 self.m_nameList.AppendItem(name_node, f"{label}: {value}")
 
-            ecu_info = self.dpload.ecu_info(addr)
+            try:
+                ecu_info = self.registry.ecu_info(addr)
+                soft_info = self.registry.soft_info(addr)
+            except TimeoutError:
+                continue
 
             # The last field is empty, or contains fields we can't interpret
             pn, sn, location, type, mfg_name, hw_id, _ = ecu_info.split("*", 6)
@@ -431,7 +438,6 @@ class GUI(MainWindow):
                 self.m_nameList.AppendItem(node, f"Manufacturer: {mfg_name}")
 
             software_node = self.m_nameList.AppendItem(node, f"Software Versions")
-            soft_info = self.dpload.soft_info(addr)
             components = soft_info.split("*")[:-1]
             for component in components:
                 name, version = component.split(" ", 1)
@@ -470,8 +476,9 @@ class GUI(MainWindow):
     def connect(self):
         self.dpload.enter(da=self.da)
         wx.Yield()
-        expiry = time.time() + 1.0
-        while time.time() < expiry:
+        # Each timeout doubles the next one, starting from what this node
+        # usually takes to answer
+        for attempt in range(CONNECT_ATTEMPTS):
             try:
                 major, minor = self.dpload.get_boot_info(da=self.da)
                 self.m_statusBar.SetStatusText(f"BL version {major}.{minor}")
@@ -479,8 +486,7 @@ class GUI(MainWindow):
             except TimeoutError:
                 pass
             wx.Yield()
-
-        if time.time() > expiry:
+        else:
             self.m_statusBar.SetStatusText(f"Bootloader did not respond")
             self.disconnect()
 
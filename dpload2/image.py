@@ -1,3 +1,4 @@
+import bisect
 import hashlib
 from enum import Enum
 import struct
@@ -18,6 +19,13 @@ HEADER_FORMAT = "IIHHIIBBHI"
 BOOT_MAGIC = bytes.fromhex("77c295f360d2ef7f3552500f2cb67980")
 BOOT_MAGIC_SIZE = len(BOOT_MAGIC)
 
+HEX_DATA = 0x00
+HEX_EOF = 0x01
+HEX_EXTENDED_SEGMENT_ADDRESS = 0x02
+HEX_EXTENDED_LINEAR_ADDRESS = 0x04
+
+ERASED = 0xFF
+
 
 class ImageTlvType(Enum):
     KEYHASH = 0x01
@@ -50,6 +58,184 @@ TLV_PROCESSORS = {
 }
 
 
+def read_hex_records(f):
+    """Raw records of an Intel HEX file, as sent with CMD_PROGRAM_FLASH"""
+    records = []
+    for line in f:
+        if not line.strip():
+            continue
+        try:
+            record = bytes.fromhex(line[1:].strip())
+        except ValueError:
+            raise ValueError(f"Bad record format: {line}")
+        records.append(record)
+    return records
+
+
+def make_record(record_type, address, data=b""):
+    """Raw Intel HEX record with its checksum"""
+    record = bytes([len(data), (address >> 8) & 0xFF, address & 0xFF, record_type])
+    record += data
+    return record + bytes([-sum(record) & 0xFF])
+
+
+def data_blocks(records):
+    """Split raw records into (address, data) blocks and all other records
+
+    Addresses are absolute. The second list holds the records that are
+    neither data, address nor EOF, such as start addresses, in order.
+    """
+    blocks = []
+    other = []
+    base = 0
+    for record in records:
+        count, record_type = record[0], record[3]
+        data = record[4 : 4 + count]
+        if record_type == HEX_DATA:
+            blocks.append((base + int.from_bytes(record[1:3], "big"), data))
+        elif record_type == HEX_EXTENDED_LINEAR_ADDRESS:
+            base = int.from_bytes(data, "big") << 16
+        elif record_type == HEX_EXTENDED_SEGMENT_ADDRESS:
+            base = int.from_bytes(data, "big") << 4
+        elif record_type != HEX_EOF:
+            other.append(record)
+    return blocks, other
+
+
+def _append_data(records, upper, address, data):
+    # Emit an extended linear address record when the upper half changes
+    if address >> 16 != upper:
+        upper = address >> 16
+        records.append(
+            make_record(HEX_EXTENDED_LINEAR_ADDRESS, 0, upper.to_bytes(2, "big"))
+        )
+    records.append(make_record(HEX_DATA, address & 0xFFFF, data))
+    return upper
+
+
+def _merge_blocks(blocks, align=1, blank=ERASED):
+    # Merge data blocks into contiguous spans widened to whole `align`-byte
+    # words. Returns the [start, end) spans, their contents with gaps set to
+    # blank, and a mask of the bytes the blocks actually cover.
+    spans = []
+    for address, data in sorted(blocks, key=lambda block: block[0]):
+        start = address - address % align
+        end = address + len(data)
+        end += -end % align
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+    starts = [start for start, _ in spans]
+    memory = [bytearray([blank]) * (end - start) for start, end in spans]
+    present = [bytearray(end - start) for start, end in spans]
+    for address, data in blocks:
+        i = bisect.bisect_right(starts, address) - 1
+        offset = address - starts[i]
+        memory[i][offset : offset + len(data)] = data
+        present[i][offset : offset + len(data)] = b"\x01" * len(data)
+    return spans, memory, present
+
+
+def data_segments(records):
+    """Contiguous runs of data in records, as a list of (start, bytes)"""
+    blocks, _ = data_blocks(records)
+    spans, memory, _ = _merge_blocks(blocks)
+    return [(start, bytes(data)) for (start, _), data in zip(spans, memory)]
+
+
+def page_map(records, start, size, page_size, blank=ERASED):
+    """Contents of each page of [start, start + size) after programming
+
+    Returns {page_address: bytes}, with bytes the records do not cover set to
+    `blank`. Data outside the range is ignored.
+    """
+    memory = bytearray([blank]) * size
+    blocks, _ = data_blocks(records)
+    for address, data in blocks:
+        first = max(address, start)
+        last = min(address + len(data), start + size)
+        if first < last:
+            memory[first - start : last - start] = data[first - address : last - address]
+    return {
+        address: bytes(memory[address - start : address - start + page_size])
+        for address in range(start, start + size, page_size)
+    }
+
+
+def select_pages(records, pages, page_size):
+    """Records holding only the data that falls in the given pages
+
+    Records that straddle a page boundary are split. Records other than
+    data, address and EOF are kept, followed by a new EOF.
+    """
+    pages = set(pages)
+    blocks, other = data_blocks(records)
+    selected = []
+    upper = None
+    for address, data in blocks:
+        offset = 0
+        while offset < len(data):
+            page = (address + offset) - (address + offset) % page_size
+            stop = min(len(data), page + page_size - address)
+            if page in pages:
+                upper = _append_data(
+                    selected, upper, address + offset, bytes(data[offset:stop])
+                )
+            offset = stop
+    selected += other
+    selected.append(make_record(HEX_EOF, 0))
+    return selected
+
+
+def compact_records(records, blank=ERASED, record_size=16, align=4):
+    """Drop erased-value data and repack the rest into dense records
+
+    Only valid for flash that has just been erased. The data is split into
+    chunks of up to `record_size` bytes on `record_size` boundaries. Chunks
+    that hold nothing but `blank` are left out, blank words are trimmed from
+    the ends of the rest, and each remaining chunk becomes one record. Gaps
+    inside a kept chunk are filled with `blank`, and every record starts on
+    an `align`-byte word boundary. Records other than data, address and EOF
+    are kept, in order, before the final EOF. Returns
+    (records, bytes_skipped).
+    """
+    if record_size % align:
+        raise ValueError(f"Record size {record_size} is not a multiple of {align}")
+
+    blocks, other = data_blocks(records)
+    spans, memory, present = _merge_blocks(blocks, align, blank)
+
+    empty = bytes([blank]) * record_size
+    skipped = 0
+    compacted = []
+    upper = None
+    for (start, end), data, mask in zip(spans, memory, present):
+        address = start
+        while address < end:
+            stop = min(
+                end,
+                address + record_size - address % record_size,
+                (address | 0xFFFF) + 1,
+            )
+            first, last = address - start, stop - start
+            while first < last and data[first : first + align] == empty[:align]:
+                first += align
+            while last > first and data[last - align : last] == empty[:align]:
+                last -= align
+            skipped += mask.count(1, address - start, first)
+            skipped += mask.count(1, last, stop - start)
+            if first < last:
+                upper = _append_data(
+                    compacted, upper, start + first, bytes(data[first:last])
+                )
+            address = stop
+
+    compacted += other
+    compacted.append(make_record(HEX_EOF, 0))
+    return compacted, skipped
+
+
 class Image:
     def __init__(self, path=None):
         self.ver_major = None
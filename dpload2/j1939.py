@@ -1,15 +1,34 @@
+import logging
+import threading
 import time
 import sys
 import struct
 
 import can
 
+from dpload2.dispatch import Dispatcher
+from dpload2.pacing import TxPacer
+
 J1939_TP_CM_RTS = 16
 J1939_TP_CM_CTS = 17
 J1939_TP_CM_EOM_ACK = 19
 J1939_TP_CM_BAM = 32
 J1939_TP_CM_ABORT = 255
 
+J1939_TP_ABORT_BUSY = 1
+J1939_TP_ABORT_RESOURCES = 2
+J1939_TP_ABORT_TIMEOUT = 3
+J1939_TP_ABORT_BAD_SEQUENCE = 7
+
+# Transport protocol timeouts of J1939-21, in seconds
+J1939_TP_T1 = 0.75  # receiver: between data packets
+J1939_TP_T2 = 1.25  # receiver: from a CTS to its first data packet
+J1939_TP_T3 = 1.25  # sender: from the last data packet to a CTS or EOM ACK
+J1939_TP_T4 = 1.05  # sender: from a CTS holding the session to the next CTS
+J1939_TP_BAM_GAP = 0.05  # sender: between BAM data packets
+J1939_TP_WINDOW = 16
+J1939_TP_PRIORITY = 7
+
 J1939_PF_TP_CM = 236
 J1939_PF_TP_DT = 235
 J1939_PF_ACKNOWLEDGE = 232
@@ -50,69 +69,392 @@ def pf_from_id(can_id):
 def build_id(pgn, sa, pri=J1939_DEFAULT_PRIORITY):
     return ((pri & 0x7) << 26) | ((pgn & 0xFFFFFF) << 8) | (sa & 0xFF)
 
+def is_pdu1(pgn):
+    """True if the low byte of pgn is a destination address"""
+    return ((pgn >> 8) & 0xFF) < 240
+
+def pgn_text(data):
+    """Payload of a PGN as text, or as hex if it is not UTF-8"""
+    try:
+        return bytes(data).decode("utf-8")
+    except UnicodeDecodeError:
+        return bytes(data).hex(sep=" ")
+
+
+class TpAbortError(Exception):
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+class TpSession:
+    """A multi-packet message being received from sa"""
+
+    def __init__(self, sa, da, pgn, size, packets, bam, window):
+        self.sa = sa
+        self.da = da
+        self.pgn = pgn
+        self.size = size
+        self.packets = packets
+        self.bam = bam
+        self.window = window
+        self.data = bytearray(packets * 7)
+        self.next = 1
+        # Last sequence number the current CTS allows
+        self.window_end = packets if bam else 0
+        self.deadline = 0.0
+
+
+class TransportProtocol:
+    """J1939-21 transport protocol for messages of 9 to 1785 bytes
+
+    Every TP.CM and TP.DT frame sent to sa, or to everyone, is handled on the
+    receive thread. Sessions are keyed by (source, destination), as TP.DT
+    frames do not carry the PGN, so RTS/CTS sessions from any number of nodes
+    and their BAM broadcasts are reassembled side by side. RTS/CTS senders
+    are granted `window` packets per CTS, or fewer if they ask for fewer. A
+    completed message goes to the dispatcher as if it had arrived in a
+    single frame carrying its PGN, so subscribers see short and multi-packet
+    messages alike. Sessions that stall for T1 between packets, or T2 after
+    a CTS, are dropped, and an RTS/CTS sender is sent an abort. Timeouts are
+    checked as TP frames arrive and whenever expire() is called.
+    """
+
+    def __init__(
+        self,
+        dispatcher,
+        pacer,
+        sa,
+        window=J1939_TP_WINDOW,
+        t1=J1939_TP_T1,
+        t2=J1939_TP_T2,
+        t3=J1939_TP_T3,
+        t4=J1939_TP_T4,
+        bam_gap=J1939_TP_BAM_GAP,
+    ):
+        self.log = logging.getLogger("dpload.j1939")
+        self.dispatcher = dispatcher
+        self.pacer = pacer
+        self.sa = sa
+        self.window = window
+        self.t1 = t1
+        self.t2 = t2
+        self.t3 = t3
+        self.t4 = t4
+        self.bam_gap = bam_gap
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._subscription = dispatcher.subscribe_callback(
+            self._on_message,
+            (None, (J1939_PF_TP_CM << 8) | sa),
+            (None, (J1939_PF_TP_CM << 8) | J1939_ADDR_GLOBAL),
+            (None, (J1939_PF_TP_DT << 8) | sa),
+            (None, (J1939_PF_TP_DT << 8) | J1939_ADDR_GLOBAL),
+        )
+
+    def close(self):
+        self._subscription.close()
+
+    def _send(self, pf, da, data):
+        msg = can.Message(
+            arbitration_id=build_id((pf << 8) | da, self.sa, pri=J1939_TP_PRIORITY),
+            data=data,
+            is_extended_id=True,
+        )
+        self.pacer.send(msg)
+
+    def _abort(self, da, pgn, reason):
+        pgn_bytes = pgn.to_bytes(3, "little")
+        data = struct.pack("<BB3s3s", J1939_TP_CM_ABORT, reason, b"\xff" * 3, pgn_bytes)
+        self._send(J1939_PF_TP_CM, da, data)
+
+    def _on_message(self, msg):
+        sa = msg.arbitration_id & 0xFF
+        da = (msg.arbitration_id >> 8) & 0xFF
+        now = time.monotonic()
+        self.expire(now)
+        if len(msg.data) < 8:
+            return
+        if pf_from_id(msg.arbitration_id) == J1939_PF_TP_CM:
+            self._on_connection(sa, da, msg.data, now)
+        else:
+            self._on_data(sa, da, msg.data, now)
+
+    def _on_connection(self, sa, da, data, now):
+        control = data[0]
+        pgn = int.from_bytes(data[5:8], "little")
+        if control == J1939_TP_CM_ABORT:
+            with self._lock:
+                session = self._sessions.get((sa, da))
+                if session is not None and session.pgn == pgn:
+                    del self._sessions[sa, da]
+            return
+        if control not in (J1939_TP_CM_RTS, J1939_TP_CM_BAM):
+            # CTS and EOM ACK are for send()
+            return
+
+        bam = control == J1939_TP_CM_BAM
+        if bam != (da == J1939_ADDR_GLOBAL):
+            return
+        size, packets, max_packets = struct.unpack_from("<HBB", data, 1)
+        if not 8 < size <= J1939_TP_MAX_BYTES or packets != (size + 6) // 7:
+            self.log.debug("Bad TP.CM from %d: %s", sa, bytes(data).hex())
+            if not bam:
+                self._abort(sa, pgn, J1939_TP_ABORT_RESOURCES)
+            return
+
+        # A new session from the same sender replaces one it has given up on
+        session = TpSession(
+            sa, da, pgn, size, packets, bam, min(self.window, max_packets)
+        )
+        session.deadline = now + self.t1
+        with self._lock:
+            self._sessions[sa, da] = session
+        if not bam:
+            self._clear_to_send(session, now)
+
+    def _clear_to_send(self, session, now):
+        count = min(session.window, session.packets - session.next + 1)
+        session.window_end = session.next + count - 1
+        session.deadline = now + self.t2
+        pgn_bytes = session.pgn.to_bytes(3, "little")
+        cts = struct.pack(
+            "<BBBH3s", J1939_TP_CM_CTS, count, session.next, 0xFFFF, pgn_bytes
+        )
+        self._send(J1939_PF_TP_CM, session.sa, cts)
+
+    def _on_data(self, sa, da, data, now):
+        seq = data[0]
+        with self._lock:
+            session = self._sessions.get((sa, da))
+            if session is None or seq < session.next:
+                # Not for a session of ours, or a packet sent again
+                return
+            bad = seq != session.next or seq > session.window_end
+            complete = False
+            if bad:
+                del self._sessions[sa, da]
+            else:
+                session.data[(seq - 1) * 7 : seq * 7] = data[1:8]
+                session.next += 1
+                session.deadline = now + self.t1
+                complete = session.next > session.packets
+
+        if bad:
+            self.log.debug("Node %d skipped to TP.DT %d; dropping its session", sa, seq)
+            if not session.bam:
+                self._abort(sa, session.pgn, J1939_TP_ABORT_BAD_SEQUENCE)
+        elif complete:
+            # Only forget the session once its message is queued, so that
+            # pending() never misses a message on its way
+            self._deliver(session)
+            with self._lock:
+                if self._sessions.get((sa, da)) is session:
+                    del self._sessions[sa, da]
+            if not session.bam:
+                pgn_bytes = session.pgn.to_bytes(3, "little")
+                eom_ack = struct.pack(
+                    "<BHBB3s",
+                    J1939_TP_CM_EOM_ACK,
+                    session.size,
+                    session.packets,
+                    0xFF,
+                    pgn_bytes,
+                )
+                self._send(J1939_PF_TP_CM, sa, eom_ack)
+        elif seq == session.window_end:
+            self._clear_to_send(session, now)
+
+    def _deliver(self, session):
+        pgn = session.pgn
+        if is_pdu1(pgn):
+            pgn = (pgn & 0x3FF00) | session.da
+        msg = can.Message(
+            timestamp=time.time(),
+            arbitration_id=build_id(pgn, session.sa),
+            data=bytes(session.data[: session.size]),
+            is_extended_id=True,
+        )
+        self.dispatcher.on_message_received(msg)
+
+    def expire(self, now=None):
+        """Drop the sessions that have timed out"""
+        if not self._sessions:
+            return
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            expired = [key for key, s in self._sessions.items() if s.deadline < now]
+            sessions = [self._sessions.pop(key) for key in expired]
+        for session in sessions:
+            self.log.debug(
+                "TP session from %d for PGN %d timed out", session.sa, session.pgn
+            )
+            if not session.bam:
+                self._abort(session.sa, session.pgn, J1939_TP_ABORT_TIMEOUT)
+
+    def pending(self, pgn, sa=None):
+        """Latest deadline, on the monotonic clock, of sessions bringing pgn
+
+        Only sessions from sa count, or from anyone if sa is None. Returns
+        None if no such message is being received.
+        """
+        if is_pdu1(pgn):
+            pgn &= 0x3FF00
+        with self._lock:
+            deadlines = [
+                session.deadline
+                for session in self._sessions.values()
+                if session.pgn == pgn and sa in (None, session.sa)
+            ]
+        return max(deadlines, default=None)
+
+    def send(self, pgn, data, da=J1939_ADDR_GLOBAL):
+        """Send 9 to 1785 bytes of pgn to da, or broadcast them with BAM
+
+        Returns once da has acknowledged the whole message. Raises
+        TimeoutError if da stops answering for T3, or T4 while it holds the
+        session, and TpAbortError if it aborts.
+        """
+        size = len(data)
+        if not 8 < size <= J1939_TP_MAX_BYTES:
+            raise ValueError(f"Cannot send {size} bytes with the transport protocol")
+        if is_pdu1(pgn):
+            pgn &= 0x3FF00
+        pgn_bytes = pgn.to_bytes(3, "little")
+        packets = [
+            bytes([seq]) + bytes(data[(seq - 1) * 7 : seq * 7]).ljust(7, b"\xff")
+            for seq in range(1, (size + 6) // 7 + 1)
+        ]
+
+        if da == J1939_ADDR_GLOBAL:
+            bam = struct.pack(
+                "<BHBB3s", J1939_TP_CM_BAM, size, len(packets), 0xFF, pgn_bytes
+            )
+            self._send(J1939_PF_TP_CM, da, bam)
+            for packet in packets:
+                time.sleep(self.bam_gap)
+                self._send(J1939_PF_TP_DT, da, packet)
+            return
+
+        replies = self.dispatcher.subscribe((da, (J1939_PF_TP_CM << 8) | self.sa))
+        with replies:
+            rts = struct.pack(
+                "<BHBB3s", J1939_TP_CM_RTS, size, len(packets), 0xFF, pgn_bytes
+            )
+            self._send(J1939_PF_TP_CM, da, rts)
+            deadline = time.monotonic() + self.t3
+            while True:
+                msg = replies.get(max(0, deadline - time.monotonic()))
+                if msg is None:
+                    self._abort(da, pgn, J1939_TP_ABORT_TIMEOUT)
+                    raise TimeoutError(f"Node {da} stopped answering the transfer")
+                if len(msg.data) < 8 or msg.data[5:8] != pgn_bytes:
+                    continue
+                control = msg.data[0]
+                if control == J1939_TP_CM_CTS:
+                    count, first = msg.data[1], msg.data[2]
+                    if count == 0:
+                        deadline = time.monotonic() + self.t4
+                        continue
+                    for packet in packets[first - 1 : first - 1 + count]:
+                        self._send(J1939_PF_TP_DT, da, packet)
+                    deadline = time.monotonic() + self.t3
+                elif control == J1939_TP_CM_EOM_ACK:
+                    return
+                elif control == J1939_TP_CM_ABORT:
+                    raise TpAbortError(
+                        f"Node {da} aborted the transfer (reason {msg.data[1]})",
+                        msg.data[1],
+                    )
+
 
 class J1939:
-    def __init__(self, bus, sa=0x27):
+    def __init__(self, bus, sa=0x27, dispatcher=None, pacer=None, tp_window=J1939_TP_WINDOW):
         self.bus = bus
         self.sa = sa
+        self.dispatcher = dispatcher or Dispatcher(bus)
+        self.pacer = pacer or TxPacer(bus)
+        self.tp = TransportProtocol(self.dispatcher, self.pacer, sa, window=tp_window)
+
+    def close(self):
+        self.tp.close()
 
     def send_pf_to(self, pf, data, da=J1939_ADDR_GLOBAL, sa=None, pri=J1939_DEFAULT_PRIORITY):
         pgn = (pf << 8) + da
         return self.send_pgn(pgn, data, sa=sa, pri=pri)
 
     def send_pgn(self, pgn, data, sa=None, pri=J1939_DEFAULT_PRIORITY):
+        """Send pgn, with the transport protocol if data is over 8 bytes
+
+        Multi-packet messages always come from our own address.
+        """
+        if len(data) > 8:
+            da = pgn & 0xFF if is_pdu1(pgn) else J1939_ADDR_GLOBAL
+            self.tp.send(pgn, data, da=da)
+            return
         msg = can.Message(arbitration_id=build_id(pgn, sa or self.sa, pri=pri), data=data, is_extended_id=True)
-        self.bus.send(msg)
+        self.pacer.send(msg)
+
+    def send_periodic(self, pgn, data, period, pri=J1939_DEFAULT_PRIORITY):
+        """Send pgn every period seconds until stop() is called on the result"""
+        msg = can.Message(arbitration_id=build_id(pgn, self.sa, pri=pri), data=data, is_extended_id=True)
+        return self.bus.send_periodic(msg, period)
+
+    def _answer_keys(self, pgn, src=None):
+        """Dispatcher keys of answers to a request for pgn from src"""
+        if is_pdu1(pgn):
+            # Sent either to us or to everyone
+            return [(src, (pgn & 0x3FF00) | address) for address in (self.sa, J1939_ADDR_GLOBAL)]
+        return [(src, pgn)]
 
     def request_pgn(self, pgn, da=J1939_ADDR_GLOBAL, pri=J1939_DEFAULT_PRIORITY, timeout=1.0):
-        buffer = bytearray(J1939_TP_MAX_BYTES)
-        packets_remaining = set()
-        total_bytes = 0
-        total_packets = 0
+        """Request pgn from da and return the first answer as text
+
+        Answers over 8 bytes come through the transport protocol, and the
+        wait is extended while one is still arriving. Raises TimeoutError if
+        nothing answers.
+        """
         pgn_bytes = pgn.to_bytes(length=3, byteorder='little', signed=False)
-        self.send_pf_to(J1939_PF_REQUEST, data=pgn_bytes, da=da, pri=pri)
-
-        expiry = time.time() + timeout
-        while time.time() < expiry:
-            msg = self.bus.recv(0.05)
-            if msg is None:
-                continue
-            if pgn_from_id(msg.arbitration_id) == pgn:
-                total_bytes = len(msg.data)
-                buffer = msg.data
-                break
-            elif pf_from_id(msg.arbitration_id) == J1939_PF_TP_CM:
-                expiry += 1.25
-                if msg.data[0] == J1939_TP_CM_RTS:
-                    total_bytes, total_packets, max_chunk, rts_pgn_bytes  = struct.unpack_from('<HBB3s', msg.data, 1)
-                    if rts_pgn_bytes != pgn_bytes:
-                        raise ValueError()
-
-                    packets_remaining = set(range(1, total_packets+1))
-                    cts = struct.pack('<BBBH3s', J1939_TP_CM_CTS, 16, 1, 0xFFFF, pgn_bytes)
-                    self.send_pf_to(J1939_PF_TP_CM, da=da, data=cts)
-            elif pf_from_id(msg.arbitration_id) == J1939_PF_TP_DT:
-                seq = msg.data[0]
-                offset = (seq - 1) * 7
-                struct.pack_into('<7s', buffer, offset, msg.data[1:])
-                packets_remaining.remove(seq)
-
-                expiry += 0.2
-
-                if len(packets_remaining) == 0:
-                    buffer = buffer[:total_bytes]
-
-                    # Send EOM ACK
-                    eom_ack = struct.pack('<BHBB3s', J1939_TP_CM_EOM_ACK, total_bytes, total_packets, 0xFF, pgn_bytes )
-                    self.send_pf_to(J1939_PF_TP_CM, da=da, data=eom_ack)
-                    break
-
-        if len(packets_remaining) != 0:
+        src = None if da == J1939_ADDR_GLOBAL else da
+        with self.dispatcher.subscribe(*self._answer_keys(pgn, src)) as subscription:
+            self.send_pf_to(J1939_PF_REQUEST, data=pgn_bytes, da=da, pri=pri)
+
+            expiry = time.monotonic() + timeout
+            while expiry is not None:
+                msg = subscription.get(max(0, expiry - time.monotonic()))
+                if msg is not None:
+                    return pgn_text(msg.data)
+                if time.monotonic() >= expiry:
+                    self.tp.expire()
+                    expiry = self.tp.pending(pgn, src)
+            # A session may have finished just before it was looked for
+            msg = subscription.get(0)
+        if msg is None:
             raise TimeoutError("Timeout waiting for data")
+        return pgn_text(msg.data)
 
-        try:
-            text = buffer.decode('utf-8')
-        except UnicodeDecodeError:
-            text = buffer.hex(sep=' ')
+    def request_pgn_all(self, pgn, timeout=1.0, pri=J1939_DEFAULT_PRIORITY):
+        """Request pgn from every node and return {sa: answer as text}
+
+        Collects the answers of all nodes, direct or through the transport
+        protocol, until `timeout` has passed and no transfer of pgn is still
+        arriving. A node answering more than once is represented by its
+        first answer.
+        """
+        pgn_bytes = pgn.to_bytes(length=3, byteorder='little', signed=False)
+        answers = {}
+        with self.dispatcher.subscribe(*self._answer_keys(pgn)) as subscription:
+            self.send_pf_to(J1939_PF_REQUEST, data=pgn_bytes, da=J1939_ADDR_GLOBAL, pri=pri)
 
-        return text
\ No newline at end of file
+            expiry = time.monotonic() + timeout
+            while expiry is not None:
+                msg = subscription.get(max(0, expiry - time.monotonic()))
+                if msg is not None:
+                    answers.setdefault(msg.arbitration_id & 0xFF, pgn_text(msg.data))
+                elif time.monotonic() >= expiry:
+                    self.tp.expire()
+                    expiry = self.tp.pending(pgn)
+            while (msg := subscription.get(0)) is not None:
+                answers.setdefault(msg.arbitration_id & 0xFF, pgn_text(msg.data))
+        return answers
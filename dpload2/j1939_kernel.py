@@ -0,0 +1,300 @@
+"""J1939 over the Linux kernel's CAN_J1939 sockets
+
+The kernel does transport protocol sessions (and filtering by PGN and
+address) itself, so the J1939 socket only hands over whole messages that
+someone is waiting for, and several processes can use J1939 on one interface
+at the same time. The raw socket DPLoad keeps for bootloader frames still
+sees every frame, TP packets included. It needs a socketcan bus and the
+can-j1939 module (`modprobe can-j1939`).
+"""
+import logging
+import socket
+import struct
+import threading
+import time
+
+from dpload2.dispatch import Dispatcher, key_from_id
+from dpload2.j1939 import (
+    build_id,
+    is_pdu1,
+    J1939,
+    J1939_ADDR_GLOBAL,
+    J1939_DEFAULT_PRIORITY,
+    J1939_PF_TP_CM,
+    J1939_PF_TP_DT,
+    J1939_TP_CM_ABORT,
+    J1939_TP_CM_BAM,
+    J1939_TP_CM_RTS,
+    J1939_TP_T1,
+    J1939_TP_T2,
+)
+
+import can
+
+SOL_CAN_J1939 = getattr(socket, "SOL_CAN_BASE", 100) + 7  # + CAN_J1939
+# struct j1939_filter: name, name_mask, pgn, pgn_mask, addr, addr_mask
+FILTER_FORMAT = "=QQIIBB6x"
+RECV_SIZE = 1 << 16
+# Left for the kernel to hand over a message after its last packet
+DELIVERY_GRACE = 0.05
+
+
+def _socketcan_channel(bus):
+    """Interface name of a python-can socketcan bus, or None"""
+    try:
+        from can.interfaces.socketcan import SocketcanBus
+    except ImportError:
+        return None
+    if not isinstance(bus, SocketcanBus):
+        return None
+    return bus.channel
+
+
+class KernelDispatcher(Dispatcher):
+    """Dispatcher fed by a J1939 socket instead of a bus
+
+    The socket's filters follow the subscriptions, so the kernel drops
+    messages nobody is waiting for.
+    """
+
+    def __init__(self, sock):
+        Dispatcher.__init__(self, None)
+        self.sock = sock
+        self._filter_lock = threading.Lock()
+        self._update_filters()
+
+    def _add(self, subscription):
+        Dispatcher._add(self, subscription)
+        self._update_filters()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        Dispatcher.unsubscribe(self, subscription)
+        self._update_filters()
+
+    def _update_filters(self):
+        with self._filter_lock:
+            with self._lock:
+                keys = list(self._subscriptions)
+            self._set_filters(keys)
+
+    def _set_filters(self, keys):
+        filters = set()
+        for sa, pgn in keys:
+            if pgn is None:
+                # Something wants everything: no filters at all
+                filters = None
+                break
+            if is_pdu1(pgn):
+                pgn &= socket.J1939_PGN_PDU1_MAX
+            filters.add((pgn, 0 if sa is None else sa, 0 if sa is None else 0xFF))
+        if filters is not None and len(filters) > socket.J1939_FILTER_MAX:
+            filters = None
+        if filters is None:
+            data = b""
+        elif not filters:
+            # Nothing is ever sent from J1939_NO_ADDR, so nothing gets through
+            data = struct.pack(FILTER_FORMAT, 0, 0, 0, 0, socket.J1939_NO_ADDR, 0xFF)
+        else:
+            data = b"".join(
+                struct.pack(FILTER_FORMAT, 0, 0, pgn, socket.J1939_PGN_MAX, sa, sa_mask)
+                for pgn, sa, sa_mask in sorted(filters)
+            )
+        try:
+            self.sock.setsockopt(SOL_CAN_J1939, socket.SO_J1939_FILTER, data)
+        except OSError as e:
+            self.log.debug("Could not set J1939 filters: %s", e)
+
+
+class TpMonitor:
+    """Watches the transfers the kernel receives, to know when to keep waiting
+
+    The kernel only hands over a multi-packet message once it is complete.
+    The raw TP.CM and TP.DT frames seen on `dispatcher` tell how long that
+    may still take, with the same pending() and expire() as
+    TransportProtocol. Without a dispatcher nothing is ever pending.
+    """
+
+    def __init__(self, dispatcher, sa):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._subscription = None
+        if dispatcher is None:
+            return
+        self._subscription = dispatcher.subscribe_callback(
+            self._on_message,
+            (None, (J1939_PF_TP_CM << 8) | sa),
+            (None, (J1939_PF_TP_CM << 8) | J1939_ADDR_GLOBAL),
+            (None, (J1939_PF_TP_DT << 8) | sa),
+            (None, (J1939_PF_TP_DT << 8) | J1939_ADDR_GLOBAL),
+        )
+
+    def close(self):
+        if self._subscription is not None:
+            self._subscription.close()
+
+    def _on_message(self, msg):
+        if len(msg.data) < 8:
+            return
+        sa, pgn = key_from_id(msg.arbitration_id)
+        key = sa, pgn & 0xFF
+        now = time.monotonic()
+        with self._lock:
+            if (pgn >> 8) == J1939_PF_TP_CM:
+                control = msg.data[0]
+                if control in (J1939_TP_CM_RTS, J1939_TP_CM_BAM):
+                    packets = msg.data[3]
+                    tp_pgn = int.from_bytes(msg.data[5:8], "little")
+                    self._sessions[key] = [tp_pgn, packets, now + J1939_TP_T2]
+                elif control == J1939_TP_CM_ABORT:
+                    self._sessions.pop(key, None)
+            elif key in self._sessions:
+                session = self._sessions[key]
+                if msg.data[0] >= session[1]:
+                    session[2] = now + DELIVERY_GRACE
+                else:
+                    session[2] = now + J1939_TP_T1
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            for key in [k for k, s in self._sessions.items() if s[2] < now]:
+                del self._sessions[key]
+
+    def pending(self, pgn, sa=None):
+        if is_pdu1(pgn):
+            pgn &= 0x3FF00
+        with self._lock:
+            deadlines = [
+                deadline
+                for (source, _), (tp_pgn, _, deadline) in self._sessions.items()
+                if tp_pgn == pgn and sa in (None, source)
+            ]
+        return max(deadlines, default=None)
+
+
+class _PeriodicSend(threading.Thread):
+    def __init__(self, j1939, pgn, data, period):
+        super().__init__(daemon=True, name=f"j1939-periodic-{pgn:#x}")
+        self.j1939 = j1939
+        self.pgn = pgn
+        self.data = data
+        self.period = period
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.j1939.send_pgn(self.pgn, self.data)
+            except OSError as e:
+                self.j1939.log.warning("PGN %#x not sent: %s", self.pgn, e)
+            self._stopped.wait(self.period)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class KernelJ1939(J1939):
+    """J1939 on a CAN_J1939 socket bound to sa on interface channel
+
+    Works like J1939, but the kernel does the transport protocol in both
+    directions. Raw TP frames from `raw_dispatcher`, if given, let requests
+    wait for a transfer still in progress, as J1939 does. Raises OSError if
+    the kernel has no J1939 support or the address cannot be bound.
+    """
+
+    def __init__(self, channel, sa=0x27, raw_dispatcher=None):
+        self.log = logging.getLogger("dpload.j1939")
+        self.channel = channel
+        self.sa = sa
+        self.bus = None
+        self.sock = socket.socket(
+            socket.PF_CAN, socket.SOCK_DGRAM, socket.CAN_J1939
+        )
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.sock.bind((channel, socket.J1939_NO_NAME, socket.J1939_NO_PGN, sa))
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.settimeout(0.5)
+        self._priority = None
+        self._send_lock = threading.Lock()
+        self.dispatcher = KernelDispatcher(self.sock)
+        self.tp = TpMonitor(raw_dispatcher, sa)
+        self._running = True
+        self._reader = threading.Thread(
+            target=self._receive, name="j1939-kernel", daemon=True
+        )
+        self._reader.start()
+
+    def close(self):
+        self._running = False
+        self._reader.join()
+        self.tp.close()
+        self.sock.close()
+
+    def _receive(self):
+        cmsg_size = socket.CMSG_SPACE(1) * 2 + socket.CMSG_SPACE(8)
+        while self._running:
+            try:
+                data, ancdata, _, address = self.sock.recvmsg(RECV_SIZE, cmsg_size)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self._running:
+                    self.log.error("J1939 socket receive failed: %s", e)
+                return
+            _, _, pgn, sa = address
+            da, priority = J1939_ADDR_GLOBAL, J1939_DEFAULT_PRIORITY
+            for level, kind, value in ancdata:
+                if level != SOL_CAN_J1939:
+                    continue
+                if kind == socket.SCM_J1939_DEST_ADDR:
+                    da = value[0]
+                elif kind == socket.SCM_J1939_PRIO:
+                    priority = value[0]
+            if is_pdu1(pgn):
+                pgn = (pgn & 0x3FF00) | da
+            msg = can.Message(
+                timestamp=time.time(),
+                arbitration_id=build_id(pgn, sa, pri=priority),
+                data=data,
+                is_extended_id=True,
+            )
+            self.dispatcher.on_message_received(msg)
+
+    def send_pgn(self, pgn, data, sa=None, pri=J1939_DEFAULT_PRIORITY):
+        """Send pgn; the kernel uses the transport protocol if data is over 8 bytes
+
+        Messages always come from the address the socket is bound to.
+        """
+        da = J1939_ADDR_GLOBAL
+        if is_pdu1(pgn):
+            pgn, da = pgn & 0x3FF00, pgn & 0xFF
+        with self._send_lock:
+            if pri != self._priority:
+                self.sock.setsockopt(SOL_CAN_J1939, socket.SO_J1939_SEND_PRIO, pri)
+                self._priority = pri
+            self.sock.sendto(bytes(data), (self.channel, socket.J1939_NO_NAME, pgn, da))
+
+    def send_periodic(self, pgn, data, period):
+        task = _PeriodicSend(self, pgn, data, period)
+        task.start()
+        return task
+
+
+def open_kernel_j1939(bus, sa, raw_dispatcher=None):
+    """KernelJ1939 on the interface of bus, or None if it cannot be used"""
+    channel = _socketcan_channel(bus)
+    if channel is None or not hasattr(socket, "CAN_J1939"):
+        return None
+    try:
+        return KernelJ1939(channel, sa=sa, raw_dispatcher=raw_dispatcher)
+    except OSError as e:
+        logging.getLogger("dpload.j1939").debug(
+            "No kernel J1939 on %s, using python-can: %s", channel, e
+        )
+        return None
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+
+from dpload2.j1939 import J1939_PF_ADDRESS_CLAIMED, J1939_ADDR_GLOBAL
+
+# Source address of a "cannot claim address" message
+J1939_ADDR_NULL = 254
+
+
+class Node:
+    """What the monitor knows about the node at one address
+
+    claimed and seen are monotonic times of its last address claim and of
+    the last message of any kind heard from it.
+    """
+
+    def __init__(self, sa, name, now):
+        self.sa = sa
+        self.name = name
+        self.claimed = now
+        self.seen = now
+
+
+class NetworkMonitor:
+    """Live map of the nodes on the bus, kept from the address claims going by
+
+    Every address claim seen on `dispatcher` adds its node, or updates its
+    NAME. A node is dropped when it cannot claim an address, when its NAME
+    moves to another address, when prune() is told it did not answer a
+    scan, or, with a `lifetime`, once nothing has been heard from it for
+    that many seconds. The monitor never sends anything itself.
+
+    Each change is passed to the listeners as callback(sa, name), with name
+    None for a node that went away; they run on the receive thread.
+    """
+
+    def __init__(self, dispatcher, sa, lifetime=None):
+        self.log = logging.getLogger("dpload.network")
+        self.lifetime = lifetime
+        self.listeners = []
+        self._changed = threading.Condition()
+        self._nodes = {}
+        self._claims = dispatcher.subscribe_callback(
+            self._on_address_claimed,
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | J1939_ADDR_GLOBAL),
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | sa),
+        )
+        # Hearing from nodes only matters if silence makes them go away
+        self._traffic = None
+        if lifetime is not None:
+            self._traffic = dispatcher.subscribe_callback(
+                self._on_message, (None, None)
+            )
+
+    def close(self):
+        self._claims.close()
+        if self._traffic is not None:
+            self._traffic.close()
+
+    def _on_message(self, msg):
+        node = self._nodes.get(msg.arbitration_id & 0xFF)
+        if node is not None:
+            node.seen = time.monotonic()
+
+    def _on_address_claimed(self, msg):
+        sa, name = msg.arbitration_id & 0xFF, bytes(msg.data)
+        now = time.monotonic()
+        changes = []
+        with self._changed:
+            # The NAME is no longer at any address it claimed before
+            for old in [n for n in self._nodes.values() if n.name == name]:
+                if old.sa != sa:
+                    del self._nodes[old.sa]
+                    changes.append((old.sa, None))
+            if sa != J1939_ADDR_NULL:
+                node = self._nodes.get(sa)
+                if node is None or node.name != name:
+                    self._nodes[sa] = Node(sa, name, now)
+                    changes.append((sa, name))
+                else:
+                    node.claimed = node.seen = now
+            self._changed.notify_all()
+        self._notify(changes)
+
+    def _notify(self, changes):
+        for sa, name in changes:
+            if name is None:
+                self.log.debug("Node %d is gone", sa)
+            else:
+                self.log.debug("Node %d claimed its address as %s", sa, name.hex())
+            for callback in self.listeners:
+                callback(sa, name)
+
+    def _expire(self):
+        if self.lifetime is None:
+            return
+        self.prune(seen=time.monotonic() - self.lifetime)
+
+    def prune(self, claimed=None, seen=None):
+        """Drop the nodes that went quiet
+
+        These are the nodes that have not claimed their address since
+        `claimed`, or have not been heard from since `seen`, both on the
+        monotonic clock.
+        """
+        with self._changed:
+            gone = [
+                sa
+                for sa, node in self._nodes.items()
+                if (claimed is not None and node.claimed < claimed)
+                or (seen is not None and node.seen < seen)
+            ]
+            for sa in gone:
+                del self._nodes[sa]
+        self._notify([(sa, None) for sa in gone])
+
+    def nodes(self):
+        """{sa: NAME} of every node on the bus"""
+        self._expire()
+        with self._changed:
+            return {sa: node.name for sa, node in self._nodes.items()}
+
+    def name(self, sa):
+        """NAME of the node at sa, or None if there is none"""
+        return self.nodes().get(sa)
+
+    def wait_for_claim(self, sa, timeout=60.0, since=None, tick=None):
+        """Wait for node sa to claim its address, returning its NAME or None
+
+        Claims from `since` on count, on the monotonic clock, so a node
+        that claimed between since and the call is not waited for. If given,
+        tick() is called while waiting and returns the seconds until it is
+        next due, or None.
+        """
+        start = time.monotonic()
+        since = start if since is None else since
+        expiry = start + timeout
+        while True:
+            # Not holding the lock, which the receive thread needs
+            until_tick = None if tick is None else tick()
+            with self._changed:
+                node = self._nodes.get(sa)
+                if node is not None and node.claimed >= since:
+                    return node.name
+                remaining = expiry - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if until_tick is not None:
+                    remaining = min(remaining, max(0, until_tick))
+                self._changed.wait(remaining)
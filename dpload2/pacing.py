@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import errno
+import logging
+import random
+import threading
+import time
+
+import can
+
+
+class TxPacer:
+    """Adaptive transmit pacing for a bus whose TX queue can fill up
+
+    Frames normally go out back to back. When the driver reports a full
+    queue (ENOBUFS), the frame is retried after an exponentially growing,
+    jittered backoff, and a gap is put between later frames. Each frame
+    that goes through shrinks the gap again, so the send rate follows what
+    the bus can take. A frame that cannot be queued for `max_stall`
+    seconds raises the last error.
+    """
+
+    def __init__(
+        self,
+        bus,
+        min_backoff=0.0005,
+        max_backoff=0.05,
+        max_gap=0.01,
+        decay=0.98,
+        max_stall=2.0,
+        seed=None,
+    ):
+        self.log = logging.getLogger("dpload.pacing")
+        self.bus = bus
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.max_gap = max_gap
+        self.decay = decay
+        self.max_stall = max_stall
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next = 0.0
+        self._backoff = 0.0
+        self._stall_start = None
+        self._recent = collections.deque()
+        self.gap = 0.0
+        self.frames = 0
+        self.stalls = 0
+        self.stalled_time = 0.0
+
+    def send(self, msg):
+        """Send msg, waiting out the pacing gap and any queue-full stalls"""
+        while True:
+            sent, wait = self._attempt(lambda: self.bus.send(msg) or 1)
+            if sent:
+                return
+            time.sleep(wait)
+
+    async def send_async(self, msg):
+        """Like send, but waits with asyncio.sleep"""
+        while True:
+            sent, wait = self._attempt(lambda: self.bus.send(msg) or 1)
+            if sent:
+                return
+            await asyncio.sleep(wait)
+
+    def send_frames(self, sender, arbitration_id, data):
+        """Send data as consecutive 8-byte frames through a BulkSender
+
+        The sender may take several frames per call; after a stall the rest
+        of data is sent again once the backoff is over.
+        """
+        offset = 0
+        while offset < len(data):
+            sent, wait = self._attempt(
+                lambda: sender.send(arbitration_id, data[offset:])
+            )
+            if sent:
+                offset += sent * 8
+            else:
+                time.sleep(wait)
+
+    def _attempt(self, send):
+        # Call send() once unless a gap is due. It returns the number of
+        # frames it sent; the result is (frames, seconds to wait before the
+        # next attempt).
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next:
+                return 0, self._next - now
+
+        try:
+            sent = send()
+        except can.CanOperationError as e:
+            if e.error_code != errno.ENOBUFS:
+                raise
+            return 0, self._stalled(now)
+
+        with self._lock:
+            now = time.monotonic()
+            self.frames += sent
+            self._recent.extend([now] * sent)
+            while self._recent and self._recent[0] < now - 1.0:
+                self._recent.popleft()
+            self._stall_start = None
+            self._backoff = 0.0
+            self.gap *= self.decay
+            if self.gap < self.min_backoff / 10:
+                self.gap = 0.0
+            self._next = now + self.gap
+        return sent, 0.0
+
+    def _stalled(self, now):
+        with self._lock:
+            self.stalls += 1
+            if self._stall_start is None:
+                self._stall_start = now
+            elif now - self._stall_start > self.max_stall:
+                self._stall_start = None
+                raise can.CanOperationError(
+                    f"Transmit queue full for more than {self.max_stall} seconds",
+                    error_code=errno.ENOBUFS,
+                )
+            self._backoff = min(
+                self.max_backoff, max(self.min_backoff, self._backoff * 2)
+            )
+            self.gap = min(self.max_gap, max(self.min_backoff, self.gap * 2))
+            wait = self._backoff * self._random.uniform(0.5, 1.5)
+            self.stalled_time += wait
+        self.log.debug("TX queue full; backing off %0.1f ms", wait * 1e3)
+        return wait
+
+    @property
+    def rate(self):
+        """Frames sent per second over the last second"""
+        with self._lock:
+            cutoff = time.monotonic() - 1.0
+            while self._recent and self._recent[0] < cutoff:
+                self._recent.popleft()
+            return float(len(self._recent))
+
+    def metrics(self):
+        """Snapshot of the pacing state and counters"""
+        rate = self.rate
+        with self._lock:
+            return {
+                "frames": self.frames,
+                "rate": rate,
+                "stalls": self.stalls,
+                "stalled_s": self.stalled_time,
+                "gap_s": self.gap,
+                "backoff_s": self._backoff,
+            }
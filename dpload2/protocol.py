@@ -1,4 +1,4 @@
-import io
+import binascii
 import struct
 
 SOH = b"\x01"
@@ -26,22 +26,97 @@ class CrcMismatchError(Exception):
     pass
 
 
+CRC16_POLY = 0x1021
+
+
 def crc16(data, start=0x0000):
-    crc = start
-    for b in data:
-        crc ^= b << 8
-        for _ in range(8):
-            if (crc & 0x8000) > 0:
-                crc = (crc << 1) ^ 0x1021
-            else:
-                crc = crc << 1
-    return crc & 0xFFFF
+    """CRC-16/CCITT (polynomial 0x1021, MSB first, no final XOR)
+
+    binascii.crc_hqx is the table-driven C implementation of exactly this CRC,
+    so it is used for every buffer size, from a single frame to a whole flash
+    segment.
+    """
+    return binascii.crc_hqx(data, start & 0xFFFF)
+
+
+def _gf2_mulmod16(a, b):
+    """Multiply two polynomials over GF(2), modulo the CRC-16 polynomial"""
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= 0x10000 | CRC16_POLY
+    return product
+
+
+# _X8N_SQUARES[k] is x^(8 * 2^k) mod P, filled in lazily by _x8n_mod()
+_X8N_SQUARES = [0x0100]
+
+
+def _x8n_mod(n):
+    """x^(8n) mod P, i.e. the effect of feeding n zero bytes through the CRC"""
+    result = 0x0001
+    k = 0
+    while n:
+        if k == len(_X8N_SQUARES):
+            _X8N_SQUARES.append(_gf2_mulmod16(_X8N_SQUARES[-1], _X8N_SQUARES[-1]))
+        if n & 1:
+            result = _gf2_mulmod16(result, _X8N_SQUARES[k])
+        n >>= 1
+        k += 1
+    return result
+
 
+def crc16_combine(crc_a, crc_b, len_b):
+    """CRC of A + B, given crc16(A), crc16(B) and len(B)
 
-def escape(b):
-    if b in (SOH, EOT, DLE):
-        return bytes(DLE + b)
-    return b
+    crc_b must have been calculated with the default start value of 0. crc_a
+    may have used any start value. Runs in O(log len_b) without touching the
+    data.
+    """
+    return _gf2_mulmod16(crc_a & 0xFFFF, _x8n_mod(len_b)) ^ (crc_b & 0xFFFF)
+
+
+class Crc16:
+    """Incremental CRC-16/CCITT, compatible with crc16()"""
+
+    def __init__(self, data=None, start=0x0000):
+        self.crc = start & 0xFFFF
+        self.length = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.crc = binascii.crc_hqx(data, self.crc)
+        self.length += len(data)
+        return self
+
+    def combine(self, crc, length):
+        """Append a block of data that is known only by its crc16() and length"""
+        self.crc = crc16_combine(self.crc, crc, length)
+        self.length += length
+        return self
+
+    def digest(self):
+        return self.crc
+
+    def copy(self):
+        other = Crc16(start=self.crc)
+        other.length = self.length
+        return other
+
+
+def escape(data):
+    """Prefix every SOH, EOT and DLE in data with a DLE"""
+    return (
+        bytes(data)
+        .replace(DLE, DLE + DLE)
+        .replace(SOH, DLE + SOH)
+        .replace(EOT, DLE + EOT)
+    )
 
 
 def decode(frame):
@@ -68,24 +143,126 @@ def decode(frame):
     return frame
 
 
-def encode(cmd, payload=None):
-    buf = io.BytesIO()
-    buf.write(SOH)
+class FrameDecoder:
+    """Incremental decoder for frames received in CAN-sized pieces
 
+    Bytes are unescaped into a preallocated buffer as they arrive and the CRC
+    is updated on everything except the two most recent bytes, which may turn
+    out to be the CRC itself. feed() returns the decoded frame (in the same
+    format as decode()) exactly once, when the terminating, unescaped EOT is
+    seen. Any bytes that follow the EOT are kept for the next frame.
+    """
+
+    def __init__(self, size=512):
+        self._buf = bytearray(size)
+        self._leftover = b""
+        self.reset()
+
+    def reset(self):
+        self._length = 0
+        self._crc = Crc16()
+        self._crc_pos = 1
+        self._escaped = False
+        self._leftover = b""
+
+    @property
+    def in_progress(self):
+        return self._length > 0 or len(self._leftover) > 0
+
+    def _append(self, b):
+        if self._length == len(self._buf):
+            self._buf.extend(bytes(len(self._buf)))
+        self._buf[self._length] = b
+        self._length += 1
+
+    def feed(self, data=b""):
+        if self._leftover:
+            data = self._leftover + bytes(data)
+            self._leftover = b""
+
+        for i, b in enumerate(data):
+            if self._length == 0:
+                if b != SOH[0]:
+                    self.reset()
+                    raise InvalidFrameError("Does not start with SOH")
+                self._append(b)
+            elif self._escaped:
+                self._escaped = False
+                self._append(b)
+            elif b == DLE[0]:
+                self._escaped = True
+            elif b == EOT[0]:
+                self._leftover = bytes(data[i + 1 :])
+                return self._finish()
+            elif b == SOH[0]:
+                self.reset()
+                raise InvalidFrameError("Unescaped SOH inside frame")
+            else:
+                self._append(b)
+
+        if self._length - 2 > self._crc_pos:
+            with memoryview(self._buf) as view:
+                self._crc.update(view[self._crc_pos : self._length - 2])
+            self._crc_pos = self._length - 2
+        return None
+
+    def _finish(self):
+        length = self._length
+        leftover = self._leftover
+        if length < 4:
+            self.reset()
+            raise InvalidFrameError("missing CRC")
+
+        with memoryview(self._buf) as view:
+            self._crc.update(view[self._crc_pos : length - 2])
+            frame = bytes(view[:length]) + EOT
+        crc = self._crc.digest()
+        crc_rx = self._buf[length - 2] + (self._buf[length - 1] << 8)
+        self.reset()
+        self._leftover = leftover
+
+        if crc_rx != crc:
+            raise CrcMismatchError(
+                f"Checksum failure: Expected {crc_rx:#06x}, but got {crc:#06x} {frame.hex()}"
+            )
+        return frame
+
+
+def max_encoded_size(payload_len):
+    """Worst-case size of an encoded frame, when every byte must be escaped"""
+    return 2 + 2 * (1 + payload_len + 2)
+
+
+def _escaped_parts(cmd, payload):
     if isinstance(cmd, int):
         cmd = bytes([cmd])
 
-    buf.write(escape(cmd))
-
     crc = crc16(cmd)
     if payload is not None:
         crc = crc16(payload, start=crc)
-        for b in payload:
-            buf.write(escape(bytes([b])))
+        return escape(cmd), escape(payload), escape(struct.pack("<H", crc))
+    return escape(cmd), b"", escape(struct.pack("<H", crc))
+
+
+def encode(cmd, payload=None):
+    return b"".join((SOH, *_escaped_parts(cmd, payload), EOT))
+
 
-    h, l = (crc >> 8), (crc & 0xFF)
+def encode_into(buffer, cmd, payload=None):
+    """Encode a frame into a caller-supplied writable buffer
 
-    buf.write(escape(bytes([l])))
-    buf.write(escape(bytes([h])))
-    buf.write(EOT)
-    return buf.getvalue()
+    Returns the number of bytes written. Raises ValueError if the buffer is
+    too small; max_encoded_size() gives a size that is always sufficient.
+    """
+    parts = _escaped_parts(cmd, payload)
+    length = 2 + sum(len(part) for part in parts)
+    with memoryview(buffer) as view:
+        if length > len(view):
+            raise ValueError(f"Buffer too small: need {length} bytes, got {len(view)}")
+        view[0] = SOH[0]
+        pos = 1
+        for part in parts:
+            view[pos : pos + len(part)] = part
+            pos += len(part)
+        view[pos] = EOT[0]
+    return length
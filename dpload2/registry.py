@@ -0,0 +1,171 @@
+import collections
+import logging
+import threading
+import time
+
+from dpload2.j1939 import J1939_PF_ADDRESS_CLAIMED, J1939_ADDR_GLOBAL
+
+
+class NodeRegistry:
+    """Cache of what each node reported, in front of a DPLoad
+
+    ECU identification, software versions, OEM info, application info and
+    the J1939 NAME are kept per address for `ttl` seconds. Everything known
+    about an address is dropped when it claims its address on its own, or
+    when the DPLoad erases, starts or resets it. Address claims answering
+    one of our own scans only refresh the NAME, unless it changed.
+    """
+
+    def __init__(self, dpload, ttl=30.0):
+        self.log = logging.getLogger("dpload.registry")
+        self.dpload = dpload
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Bumped on every invalidation so a fetch that raced it is not stored
+        self._generation = collections.Counter()
+        self._scanned = None
+        self._scanning = False
+        self._claims = dpload.dispatcher.subscribe_callback(
+            self._on_address_claimed,
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | J1939_ADDR_GLOBAL),
+            (None, (J1939_PF_ADDRESS_CLAIMED << 8) | dpload.sa),
+        )
+        dpload.node_changed.append(self.invalidate)
+        dpload.network.listeners.append(self._on_network_changed)
+
+    def close(self):
+        self._claims.close()
+        if self.invalidate in self.dpload.node_changed:
+            self.dpload.node_changed.remove(self.invalidate)
+        if self._on_network_changed in self.dpload.network.listeners:
+            self.dpload.network.listeners.remove(self._on_network_changed)
+
+    def _on_network_changed(self, sa, name):
+        if name is None:
+            self.invalidate(sa)
+
+    def invalidate(self, da=None):
+        """Forget what is known about node da, or about every node"""
+        with self._lock:
+            if da is None:
+                for address in self._entries:
+                    self._generation[address] += 1
+                self._entries.clear()
+                self._scanned = None
+            else:
+                self._generation[da] += 1
+                self._entries.pop(da, None)
+
+    def _on_address_claimed(self, msg):
+        sa, name = msg.arbitration_id & 0xFF, bytes(msg.data)
+        with self._lock:
+            known = self._entries.get(sa, {}).get("name")
+            if self._scanning and known is not None and known[1] == name:
+                return
+            self._generation[sa] += 1
+            self._entries[sa] = {"name": (time.monotonic(), name)}
+        self.log.debug("Node %d claimed its address", sa)
+
+    def _cached(self, da, field, fetch):
+        now = time.monotonic()
+        with self._lock:
+            if self._fresh(da, field, now):
+                return self._entries[da][field][1]
+            generation = self._generation[da]
+
+        value = fetch()
+        with self._lock:
+            if self._generation[da] == generation:
+                self._entries.setdefault(da, {})[field] = (now, value)
+        return value
+
+    def ecu_info(self, da):
+        return self._cached(da, "ecu_info", lambda: self.dpload.ecu_info(da))
+
+    def soft_info(self, da):
+        return self._cached(da, "soft_info", lambda: self.dpload.soft_info(da))
+
+    def oem_info(self, da, timeout=0.5):
+        return self._cached(
+            da, "oem_info", lambda: self.dpload.get_oem_info(da=da, timeout=timeout)
+        )
+
+    def app_info(self, da, timeout=0.5):
+        return self._cached(
+            da, "app_info", lambda: self.dpload.get_app_info(da=da, timeout=timeout)
+        )
+
+    def _fresh(self, da, field, now):
+        cached = self._entries.get(da, {}).get(field)
+        return cached is not None and now - cached[0] < self.ttl
+
+    def inventory(self, timeout=0.5, das=None):
+        """ECU identification and software versions of every node at once
+
+        Two global requests fill in ecu_info and soft_info for all nodes
+        that answer, instead of one pair of requests per node. If das is
+        given and all of them have both cached within `ttl`, the answer
+        comes from the cache without touching the bus. Returns
+        {sa: (ecu_info, soft_info)}, with None for an answer a node did not
+        send.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if das is not None and all(
+                self._fresh(da, field, now)
+                for da in das
+                for field in ("ecu_info", "soft_info")
+            ):
+                return {
+                    da: (
+                        self._entries[da]["ecu_info"][1],
+                        self._entries[da]["soft_info"][1],
+                    )
+                    for da in sorted(das)
+                }
+            generation = collections.Counter(self._generation)
+        ecu_info = self.dpload.ecu_info_all(timeout=timeout)
+        soft_info = self.dpload.soft_info_all(timeout=timeout)
+        with self._lock:
+            for field, answers in (("ecu_info", ecu_info), ("soft_info", soft_info)):
+                for sa, value in answers.items():
+                    if self._generation[sa] == generation[sa]:
+                        self._entries.setdefault(sa, {})[field] = (now, value)
+        return {
+            sa: (ecu_info.get(sa), soft_info.get(sa))
+            for sa in sorted(set(ecu_info) | set(soft_info))
+        }
+
+    def name(self, da):
+        """NAME from the last address claim seen from da, or None"""
+        with self._lock:
+            cached = self._entries.get(da, {}).get("name")
+        return None if cached is None else cached[1]
+
+    def scan(self, timeout=2.0, refresh=False):
+        """[(sa, name)] of the nodes on the bus, like DPLoad.scan
+
+        Within `ttl` of the last scan the answer is read from the DPLoad's
+        network map, which follows address claims as they happen, without
+        touching the bus, unless refresh is set. After that the nodes are
+        asked again, and those that do not answer drop out.
+        """
+        now = time.monotonic()
+        with self._lock:
+            fresh = self._scanned is not None and now - self._scanned < self.ttl
+            if refresh or not fresh:
+                self._scanning = True
+        if fresh and not refresh:
+            return sorted(self.dpload.network.nodes().items())
+        try:
+            nodes = self.dpload.scan(timeout=timeout)
+        finally:
+            with self._lock:
+                self._scanning = False
+        now = time.monotonic()
+        with self._lock:
+            self._scanned = now
+            for sa, name in nodes:
+                self._entries.setdefault(sa, {})["name"] = (now, bytes(name))
+        return nodes
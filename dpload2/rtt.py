@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# Gains and variance multiplier of RFC 6298
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+MAX_BACKOFF = 64
+
+# Statistics over every node, used for nodes not measured yet
+ALL_NODES = "*"
+
+
+class RttEstimator:
+    """Smoothed round-trip time and its mean deviation, as TCP keeps them"""
+
+    def __init__(self, srtt=None, rttvar=None, samples=0, timeouts=0):
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.samples = samples
+        self.timeouts = timeouts
+        # Doubled on every timeout, reset by the next answer
+        self.backoff = 1
+
+    def update(self, rtt):
+        if self.samples == 0:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += ALPHA * (rtt - self.srtt)
+        self.samples += 1
+        self.backoff = 1
+
+    @property
+    def rto(self):
+        """Retransmission timeout before backoff, or None without samples"""
+        if not self.samples:
+            return None
+        return self.srtt + K * self.rttvar
+
+    def to_dict(self):
+        return {
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "samples": self.samples,
+            "timeouts": self.timeouts,
+        }
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry["srtt"], entry["rttvar"], entry["samples"], entry["timeouts"])
+
+
+class RttTable:
+    """Round-trip time statistics per node and command, for adaptive timeouts
+
+    Each (node, command) pair has an RttEstimator; a timeout is the
+    smoothed RTT plus four mean deviations, doubled after each timeout until
+    the next answer, and clamped to [floor, ceiling]. limits maps a command
+    to its own (floor, ceiling); commands named "name/size" fall back to the
+    limits of "name". Nodes without samples for a command get the estimate
+    over all nodes, or the caller's default if there is none.
+
+    Nodes are known by address until bind() gives their J1939 NAME. With a
+    path, the statistics of named nodes and of all nodes together are
+    loaded from and saved to that JSON file, keeping the `max_nodes` most
+    recently used.
+    """
+
+    def __init__(
+        self, path=None, floor=0.05, ceiling=30.0, limits=None, max_nodes=256
+    ):
+        self.log = logging.getLogger("dpload.rtt")
+        self.path = path
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limits = dict(limits or {})
+        self.max_nodes = max_nodes
+        self._lock = threading.Lock()
+        self._names = {}
+        self._nodes = {}
+        self._used = {}
+        if path is None:
+            return
+        try:
+            with open(path, "r") as f:
+                nodes = json.load(f)
+            for key, entry in nodes.items():
+                self._used[key] = entry["used"]
+                self._nodes[key] = {
+                    command: RttEstimator.from_dict(stats)
+                    for command, stats in entry["commands"].items()
+                }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.log.warning("Ignoring unreadable RTT statistics %s: %s", path, e)
+            self._nodes.clear()
+            self._used.clear()
+
+    def _key(self, da):
+        return self._names.get(da, f"addr:{da}")
+
+    def bind(self, da, name):
+        """Keep the statistics of node da under its NAME from now on"""
+        key = bytes(name).hex()
+        with self._lock:
+            if self._names.get(da) == key:
+                return
+            measured = self._nodes.pop(f"addr:{da}", None)
+            if measured is not None and key not in self._nodes:
+                self._nodes[key] = measured
+            self._names[da] = key
+            self._used[key] = time.time()
+
+    def _limits(self, command):
+        base = command.split("/")[0]
+        default = self.limits.get(base, (self.floor, self.ceiling))
+        return self.limits.get(command, default)
+
+    def timeout(self, da, command, default):
+        """Seconds to wait for node da to answer command"""
+        floor, ceiling = self._limits(command)
+        with self._lock:
+            node = self._nodes.get(self._key(da), {}).get(command)
+            rto = None if node is None else node.rto
+            if rto is None:
+                rto = self._nodes.get(ALL_NODES, {}).get(command, RttEstimator()).rto
+            if rto is None:
+                rto = default
+            backoff = 1 if node is None else node.backoff
+        return min(ceiling, max(floor, rto * backoff))
+
+    def _estimator(self, key, command):
+        self._used[key] = time.time()
+        return self._nodes.setdefault(key, {}).setdefault(command, RttEstimator())
+
+    def sample(self, da, command, rtt):
+        """Record that node da answered command after rtt seconds"""
+        with self._lock:
+            self._estimator(self._key(da), command).update(rtt)
+            self._estimator(ALL_NODES, command).update(rtt)
+
+    def timed_out(self, da, command):
+        """Record that node da did not answer command in time"""
+        with self._lock:
+            estimator = self._estimator(self._key(da), command)
+            estimator.timeouts += 1
+            estimator.backoff = min(MAX_BACKOFF, estimator.backoff * 2)
+
+    def stats(self, da=None):
+        """{node: {command: statistics}}, or {command: statistics} for node da
+
+        Nodes are keyed by NAME in hex, "addr:<address>" while unnamed, or
+        "*" for all nodes together. The statistics are srtt, rttvar,
+        samples, timeouts and the timeout now in use for a node with its own
+        samples, in seconds.
+        """
+        with self._lock:
+            keys = list(self._nodes) if da is None else [self._key(da)]
+            stats = {}
+            for key in keys:
+                stats[key] = {}
+                for command, estimator in self._nodes.get(key, {}).items():
+                    floor, ceiling = self._limits(command)
+                    timeout = None
+                    if estimator.rto is not None:
+                        timeout = estimator.rto * estimator.backoff
+                        timeout = min(ceiling, max(floor, timeout))
+                    stats[key][command] = {**estimator.to_dict(), "timeout": timeout}
+        return stats if da is None else stats[keys[0]]
+
+    def save(self):
+        """Write the statistics of named nodes back to path, if there is one"""
+        if self.path is None:
+            return
+        with self._lock:
+            keys = [key for key in self._nodes if not key.startswith("addr:")]
+            keys = sorted(keys, key=lambda key: self._used.get(key, 0.0))
+            nodes = {
+                key: {
+                    "used": self._used.get(key, 0.0),
+                    "commands": {
+                        command: estimator.to_dict()
+                        for command, estimator in self._nodes[key].items()
+                    },
+                }
+                for key in keys[-self.max_nodes :]
+            }
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".rtt-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(nodes, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
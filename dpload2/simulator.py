@@ -0,0 +1,469 @@
+"""Simulated DataPanel bootloader node
+
+SimulatedBootloader answers the bootloader protocol from protocol.py and the
+J1939 requests DPLoad relies on (address claim, SOFT and ECUID, with TP.CM
+RTS/CTS or BAM for long responses) on any python-can bus, typically
+can.interface.Bus(interface="virtual") or a vcan interface. Flash is modelled
+as a bytearray, and command latency, flash timing and frame loss are
+configurable so throughput can be measured without hardware.
+
+Run a node on a (v)can interface with `python -m dpload2.simulator`.
+"""
+import logging
+import random
+import struct
+import threading
+import time
+
+import can
+import click
+
+from dpload2.dispatch import Dispatcher
+from dpload2.dpload import (
+    APP_START,
+    APP_SIZE,
+    PAGE_SIZE,
+    PF_BOOTLOADER,
+    BOOT_INFO_FORMAT,
+    OEM_INFO_FORMAT,
+    APP_INFO_FORMAT,
+    CRC_REQUEST_FORMAT,
+    CRC_RESPONSE_FORMAT,
+    ENTER_BOOTLOADER,
+)
+from dpload2.image import (
+    ERASED,
+    HEX_DATA,
+    HEX_EOF,
+    HEX_EXTENDED_LINEAR_ADDRESS,
+    HEX_EXTENDED_SEGMENT_ADDRESS,
+)
+from dpload2.j1939 import (
+    build_id,
+    J1939_PF_REQUEST,
+    J1939_PF_TP_CM,
+    J1939_PF_TP_DT,
+    J1939_PF_ADDRESS_CLAIMED,
+    J1939_TP_CM_RTS,
+    J1939_TP_CM_CTS,
+    J1939_TP_CM_EOM_ACK,
+    J1939_TP_CM_BAM,
+    J1939_TP_CM_ABORT,
+    J1939_ADDR_GLOBAL,
+    J1939_PGN_ECUID,
+    J1939_PGN_SOFT,
+)
+from dpload2.protocol import (
+    encode,
+    crc16,
+    FrameDecoder,
+    CMD_READ_BOOT_INFO,
+    CMD_ERASE_FLASH,
+    CMD_PROGRAM_FLASH,
+    CMD_READ_CRC,
+    CMD_JUMP_TO_APP,
+    CMD_READ_OEM_INFO,
+    CMD_READ_APP_INFO,
+    InvalidFrameError,
+    CrcMismatchError,
+)
+
+FLASH_START = 0x1D000000
+FLASH_SIZE = 0x80000
+
+PGN_ADDRESS_CLAIMED = J1939_PF_ADDRESS_CLAIMED << 8
+
+COMMANDS = (
+    CMD_READ_BOOT_INFO,
+    CMD_ERASE_FLASH,
+    CMD_PROGRAM_FLASH,
+    CMD_READ_CRC,
+    CMD_JUMP_TO_APP,
+    CMD_READ_OEM_INFO,
+    CMD_READ_APP_INFO,
+)
+
+
+def physical_address(address):
+    """Map a PIC32 KSEG0/KSEG1 virtual address onto its physical address"""
+    return address & 0x1FFFFFFF
+
+
+class Flash:
+    """Byte-addressable model of the program flash"""
+
+    def __init__(self, start=FLASH_START, size=FLASH_SIZE, page_size=PAGE_SIZE):
+        self.start = start
+        self.size = size
+        self.page_size = page_size
+        self.data = bytearray([ERASED]) * size
+        self.bytes_written = 0
+        self.pages_erased = 0
+
+    def _offset(self, address, size):
+        offset = physical_address(address) - self.start
+        if offset < 0 or offset + size > self.size:
+            return None
+        return offset
+
+    def erase(self, start, size):
+        """Erase every page touched by [start, start + size)"""
+        offset = self._offset(start, size)
+        if offset is None:
+            raise ValueError(f"Erase {start:#010x}+{size:#x} is outside flash")
+        first = offset - offset % self.page_size
+        end = offset + size
+        end += -end % self.page_size
+        self.data[first:end] = bytes([ERASED]) * (end - first)
+        pages = (end - first) // self.page_size
+        self.pages_erased += pages
+        return pages
+
+    def write(self, address, data):
+        """Program data, returning the number of bytes that landed in flash"""
+        offset = self._offset(address, len(data))
+        if offset is None:
+            return 0
+        # Programming can only clear bits
+        current = int.from_bytes(self.data[offset : offset + len(data)], "big")
+        programmed = current & int.from_bytes(data, "big")
+        self.data[offset : offset + len(data)] = programmed.to_bytes(len(data), "big")
+        self.bytes_written += len(data)
+        return len(data)
+
+    def read(self, address, size):
+        offset = self._offset(address, size)
+        if offset is None:
+            raise ValueError(f"Read {address:#010x}+{size:#x} is outside flash")
+        return bytes(self.data[offset : offset + size])
+
+
+class SimulatedBootloader:
+    """A bootloader node on a python-can bus
+
+    latency maps command numbers to the processing time before a response,
+    on top of write_time per programmed byte and erase_time per erased page.
+    frame_loss is the probability that any single CAN frame in either
+    direction is lost. With range_erase=False, ERASE_FLASH ignores its
+    arguments and erases the whole application, as older bootloaders do.
+    """
+
+    def __init__(
+        self,
+        bus,
+        sa=208,
+        name=None,
+        boot_version=(2, 5),
+        part_number="SIM00000000",
+        oem_version=(1, 0),
+        app_version=(0xFF, 0xFF),
+        ecuid="SIM-0001*000001*Cab*Display*Data Panel*A*",
+        soft="APP 1.0.0*BOOT 2.5*",
+        latency=None,
+        write_time=0.0,
+        erase_time=0.0,
+        frame_loss=0.0,
+        range_erase=True,
+        boot_delay=0.1,
+        seed=None,
+    ):
+        self.log = logging.getLogger("dpload.simulator")
+        self.bus = bus
+        self.sa = sa
+        self.name = name or struct.pack("<Q", 0x8000000000000000 | sa)
+        self.boot_version = boot_version
+        self.part_number = part_number
+        self.oem_version = oem_version
+        self.app_version = app_version
+        self.ecuid = ecuid
+        self.soft = soft
+        self.latency = latency or {}
+        self.write_time = write_time
+        self.erase_time = erase_time
+        self.frame_loss = frame_loss
+        self.range_erase = range_erase
+        self.boot_delay = boot_delay
+        self.random = random.Random(seed)
+
+        self.flash = Flash()
+        self.in_bootloader = True
+        self.frames_received = 0
+        self.frames_dropped = 0
+        self.requests_handled = 0
+
+        self._base_address = 0
+        self._busy_time = 0.0
+        self._running = False
+        self._threads = []
+        self.dispatcher = Dispatcher(bus)
+
+    def start(self):
+        self._running = True
+        self._bootloader_rx = self.dispatcher.subscribe(
+            (None, (PF_BOOTLOADER << 8) | self.sa)
+        )
+        self._j1939_rx = self.dispatcher.subscribe(
+            (None, (J1939_PF_REQUEST << 8) | self.sa),
+            (None, (J1939_PF_REQUEST << 8) | J1939_ADDR_GLOBAL),
+        )
+        self._threads = [
+            threading.Thread(target=self._serve_bootloader, daemon=True),
+            threading.Thread(target=self._serve_j1939, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self.claim_address()
+        return self
+
+    def stop(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._bootloader_rx.close()
+        self._j1939_rx.close()
+        self.dispatcher.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _lost(self):
+        if self.frame_loss and self.random.random() < self.frame_loss:
+            self.frames_dropped += 1
+            return True
+        return False
+
+    def send(self, can_id, data):
+        if self._lost():
+            return
+        self.bus.send(can.Message(arbitration_id=can_id, data=data, is_extended_id=True))
+
+    def send_pgn(self, pgn, data, pri=6):
+        self.send(build_id(pgn, self.sa, pri=pri), data)
+
+    def claim_address(self):
+        self.send_pgn(PGN_ADDRESS_CLAIMED | J1939_ADDR_GLOBAL, self.name)
+
+    # Bootloader protocol
+
+    def _serve_bootloader(self):
+        decoder = FrameDecoder()
+        while self._running:
+            msg = self._bootloader_rx.get(0.1)
+            if msg is None:
+                continue
+            self.frames_received += 1
+            if self._lost():
+                decoder.reset()
+                continue
+            if msg.data == ENTER_BOOTLOADER:
+                self.in_bootloader = True
+                decoder.reset()
+                continue
+            if not self.in_bootloader:
+                continue
+
+            data = msg.data
+            while True:
+                try:
+                    frame = decoder.feed(data)
+                except (InvalidFrameError, CrcMismatchError) as e:
+                    self.log.debug("Node %d dropped frame: %s", self.sa, e)
+                    break
+                if frame is None:
+                    break
+                self._handle(frame, msg.arbitration_id & 0xFF)
+                data = b""
+
+    def _handle(self, frame, host):
+        cmd, payload = frame[1], frame[2:-3]
+        handler = {
+            CMD_READ_BOOT_INFO: self._read_boot_info,
+            CMD_ERASE_FLASH: self._erase_flash,
+            CMD_PROGRAM_FLASH: self._program_flash,
+            CMD_READ_CRC: self._read_crc,
+            CMD_JUMP_TO_APP: self._jump_to_app,
+            CMD_READ_OEM_INFO: self._read_oem_info,
+            CMD_READ_APP_INFO: self._read_app_info,
+        }.get(cmd)
+        if handler is None:
+            self.log.debug("Node %d ignoring unknown command %d", self.sa, cmd)
+            return
+
+        started = time.time()
+        self._busy_time = 0.0
+        try:
+            response = handler(payload)
+        except Exception as e:
+            # A real bootloader drops a request it cannot carry out
+            self.log.warning("Node %d dropped command %d: %s", self.sa, cmd, e)
+            return
+        delay = self.latency.get(cmd, 0.0) + self._busy_time
+        remaining = started + delay - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        self.requests_handled += 1
+        txframe = encode(cmd, response)
+        tx_id = 0x18000000 | (PF_BOOTLOADER << 16) | (host << 8) | self.sa
+        for offset in range(0, len(txframe), 8):
+            self.send(tx_id, txframe[offset : offset + 8])
+
+        if cmd == CMD_JUMP_TO_APP:
+            self.in_bootloader = False
+            threading.Timer(self.boot_delay, self.claim_address).start()
+
+    def _read_boot_info(self, payload):
+        return struct.pack(BOOT_INFO_FORMAT, *self.boot_version)
+
+    def _read_oem_info(self, payload):
+        return struct.pack(
+            OEM_INFO_FORMAT,
+            self.sa,
+            self.part_number.encode("utf-8"),
+            *self.oem_version,
+        )
+
+    def _read_app_info(self, payload):
+        return struct.pack(APP_INFO_FORMAT, *self.app_version)
+
+    def _erase_flash(self, payload):
+        start, size = struct.unpack_from("<LL", payload)
+        if (start, size) == (0xFFFFFFFF, 0xFFFFFFFF) or not self.range_erase:
+            start, size = APP_START, APP_SIZE
+        pages = self.flash.erase(start, size)
+        self._base_address = 0
+        self._busy_time = pages * self.erase_time
+        return b""
+
+    def _program_flash(self, payload):
+        written = 0
+        offset = 0
+        while offset + 5 <= len(payload):
+            length, address, record_type = struct.unpack_from(">BHB", payload, offset)
+            data = bytes(payload[offset + 4 : offset + 4 + length])
+            offset += length + 5
+            if record_type == HEX_DATA:
+                written += self.flash.write(self._base_address + address, data)
+            elif record_type == HEX_EXTENDED_LINEAR_ADDRESS:
+                self._base_address = int.from_bytes(data, "big") << 16
+            elif record_type == HEX_EXTENDED_SEGMENT_ADDRESS:
+                self._base_address = int.from_bytes(data, "big") << 4
+            elif record_type == HEX_EOF:
+                self._base_address = 0
+        self._busy_time = written * self.write_time
+        return b""
+
+    def _read_crc(self, payload):
+        start, size, _, _ = struct.unpack(CRC_REQUEST_FORMAT, payload)
+        return struct.pack(CRC_RESPONSE_FORMAT, crc16(self.flash.read(start, size)))
+
+    def _jump_to_app(self, payload):
+        return b""
+
+    # J1939
+
+    def _serve_j1939(self):
+        while self._running:
+            msg = self._j1939_rx.get(0.1)
+            if msg is None or self._lost():
+                continue
+            requester = msg.arbitration_id & 0xFF
+            global_request = ((msg.arbitration_id >> 8) & 0xFF) == J1939_ADDR_GLOBAL
+            pgn = int.from_bytes(msg.data[:3], "little")
+            if pgn in (PGN_ADDRESS_CLAIMED, PGN_ADDRESS_CLAIMED | J1939_ADDR_GLOBAL):
+                self.claim_address()
+            elif pgn == J1939_PGN_SOFT:
+                self._send_multipacket(pgn, self.soft, requester, global_request)
+            elif pgn == J1939_PGN_ECUID:
+                self._send_multipacket(pgn, self.ecuid, requester, global_request)
+
+    def _send_multipacket(self, pgn, text, da, broadcast):
+        data = text.encode("utf-8")
+        if len(data) <= 8:
+            self.send_pgn(pgn, data)
+            return
+
+        packets = [data[i : i + 7].ljust(7, b"\xff") for i in range(0, len(data), 7)]
+        pgn_bytes = pgn.to_bytes(3, "little")
+        if broadcast:
+            bam = struct.pack(
+                "<BHBB3s", J1939_TP_CM_BAM, len(data), len(packets), 0xFF, pgn_bytes
+            )
+            self.send_pgn((J1939_PF_TP_CM << 8) | J1939_ADDR_GLOBAL, bam)
+            for seq, packet in enumerate(packets, 1):
+                time.sleep(0.05)
+                self.send_pgn((J1939_PF_TP_DT << 8) | J1939_ADDR_GLOBAL, bytes([seq]) + packet)
+            return
+
+        with self.dispatcher.subscribe((da, (J1939_PF_TP_CM << 8) | self.sa)) as cm:
+            rts = struct.pack(
+                "<BHBB3s", J1939_TP_CM_RTS, len(data), len(packets), 0xFF, pgn_bytes
+            )
+            self.send_pgn((J1939_PF_TP_CM << 8) | da, rts)
+            while True:
+                msg = cm.get(1.25)
+                if msg is None:
+                    return
+                control = msg.data[0]
+                if control == J1939_TP_CM_CTS:
+                    count, next_seq = msg.data[1], msg.data[2]
+                    for seq in range(next_seq, min(next_seq + count, len(packets) + 1)):
+                        self.send_pgn(
+                            (J1939_PF_TP_DT << 8) | da, bytes([seq]) + packets[seq - 1]
+                        )
+                elif control in (J1939_TP_CM_EOM_ACK, J1939_TP_CM_ABORT):
+                    return
+
+
+@click.command()
+@click.option("--interface", default="socketcan", show_default=True)
+@click.option("--channel", default="vcan0", show_default=True)
+@click.option("--bitrate", default=250000, show_default=True)
+@click.option("--sa", "addresses", multiple=True, type=int, help="Node address; may be repeated")
+@click.option("--latency", default=0.0, show_default=True, help="Seconds per command")
+@click.option("--write-time", default=0.0, show_default=True, help="Seconds per byte")
+@click.option("--erase-time", default=0.0, show_default=True, help="Seconds per page")
+@click.option("--frame-loss", default=0.0, show_default=True, help="Frame loss probability")
+@click.option("--no-range-erase", default=False, is_flag=True)
+def main(
+    interface,
+    channel,
+    bitrate,
+    addresses,
+    latency,
+    write_time,
+    erase_time,
+    frame_loss,
+    no_range_erase,
+):
+    """Run simulated bootloader nodes until interrupted"""
+    logging.basicConfig(level=logging.INFO)
+    nodes = []
+    for sa in addresses or (208,):
+        bus = can.interface.Bus(interface=interface, channel=channel, bitrate=bitrate)
+        node = SimulatedBootloader(
+            bus,
+            sa=sa,
+            latency={cmd: latency for cmd in COMMANDS},
+            write_time=write_time,
+            erase_time=erase_time,
+            frame_loss=frame_loss,
+            range_erase=not no_range_erase,
+        )
+        nodes.append(node.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for node in nodes:
+            node.stop()
+            node.bus.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import can
+import pytest
+
+from dpload2.aio import AsyncDPLoad
+from dpload2.protocol import CMD_READ_BOOT_INFO
+from dpload2.simulator import SimulatedBootloader
+
+LATENCY = 0.3
+
+
+@pytest.fixture
+def sims(request):
+    channel = request.node.name
+    sims = [
+        SimulatedBootloader(
+            can.interface.Bus(interface="virtual", channel=channel),
+            sa=sa,
+            latency={CMD_READ_BOOT_INFO: LATENCY},
+        ).start()
+        for sa in (5, 208)
+    ]
+    yield channel, sims
+    for sim in sims:
+        sim.stop()
+        sim.bus.shutdown()
+
+
+def run(channel, main):
+    """Run main(client) on a fresh event loop with an AsyncDPLoad on channel"""
+    bus = can.interface.Bus(interface="virtual", channel=channel)
+
+    async def session():
+        async with AsyncDPLoad(bus) as client:
+            return await main(client)
+
+    try:
+        return asyncio.run(session())
+    finally:
+        bus.shutdown()
+
+
+def test_requests_to_two_nodes_run_concurrently(sims):
+    channel, _ = sims
+
+    async def main(client):
+        start = time.monotonic()
+        answers = await asyncio.gather(
+            client.get_boot_info(da=5, timeout=1.0),
+            client.get_boot_info(da=208, timeout=1.0),
+        )
+        return answers, time.monotonic() - start
+
+    answers, elapsed = run(channel, main)
+    assert answers == [(2, 5), (2, 5)]
+    assert elapsed < 2 * LATENCY
+
+
+def test_cancelled_request_unsubscribes(sims):
+    channel, _ = sims
+
+    async def main(client):
+        task = asyncio.create_task(client.get_boot_info(da=5, timeout=5.0))
+        await asyncio.sleep(LATENCY / 3)
+        assert any(sa == 5 for sa, _ in client.dispatcher._subscriptions)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        subscriptions = dict(client.dispatcher._subscriptions)
+        # The node is free for the next request
+        answer = await client.get_boot_info(da=5, timeout=1.0)
+        return subscriptions, answer
+
+    subscriptions, answer = run(channel, main)
+    assert all(sa != 5 for sa, _ in subscriptions)
+    assert answer == (2, 5)
+
+
+def test_transport_protocol_answer(sims):
+    channel, nodes = sims
+
+    async def main(client):
+        return await client.ecu_info(da=208)
+
+    assert run(channel, main) == nodes[1].ecuid
@@ -0,0 +1,84 @@
+import ctypes
+import errno
+import os
+import socket
+
+import can
+import pytest
+
+from dpload2 import bulksend
+from dpload2.bulksend import MAX_FRAMES, BulkSender
+from dpload2.pacing import TxPacer
+
+CHANNEL = "vcan0"
+
+
+@pytest.mark.skipif(
+    not os.path.exists(f"/sys/class/net/{CHANNEL}"), reason=f"{CHANNEL} is missing"
+)
+def test_frames_arrive_in_order():
+    sender = can.interface.Bus(interface="socketcan", channel=CHANNEL)
+    receiver = can.interface.Bus(interface="socketcan", channel=CHANNEL)
+    try:
+        bulk = BulkSender(sender)
+        assert bulk.bulk
+        data = bytes(range(256)) * 2 + b"\x01\x02\x03"
+        TxPacer(sender).send_frames(bulk, 0x18D6D027, data)
+
+        count = (len(data) + 7) // 8
+        frames = []
+        while len(frames) < count and (msg := receiver.recv(1.0)) is not None:
+            frames.append(msg)
+    finally:
+        sender.shutdown()
+        receiver.shutdown()
+    assert count > MAX_FRAMES
+    assert all(msg.arbitration_id == 0x18D6D027 for msg in frames)
+    assert all(msg.is_extended_id for msg in frames)
+    assert b"".join(bytes(msg.data) for msg in frames) == data
+
+
+class RecordingBus:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+def test_full_socket_buffer_falls_back_to_bus_send(monkeypatch):
+    def socket_buffer_full(fd, headers, count, flags):
+        ctypes.set_errno(errno.EAGAIN)
+        return -1
+
+    monkeypatch.setattr(bulksend, "_sendmmsg", socket_buffer_full)
+    bus = RecordingBus()
+    sock, other = socket.socketpair()
+    try:
+        bulk = BulkSender(bus, sock=sock)
+        assert bulk.bulk
+        assert bulk.send(0x123, b"abcdefgh12345678") == 1
+    finally:
+        sock.close()
+        other.close()
+    assert [(msg.arbitration_id, bytes(msg.data)) for msg in bus.sent] == [
+        (0x123, b"abcdefgh")
+    ]
+
+
+def test_other_send_errors_are_raised(monkeypatch):
+    def queue_full(fd, headers, count, flags):
+        ctypes.set_errno(errno.ENOBUFS)
+        return -1
+
+    monkeypatch.setattr(bulksend, "_sendmmsg", queue_full)
+    bus = RecordingBus()
+    sock, other = socket.socketpair()
+    try:
+        with pytest.raises(can.CanOperationError) as e:
+            BulkSender(bus, sock=sock).send(0x123, b"abcdefgh")
+    finally:
+        sock.close()
+        other.close()
+    assert e.value.error_code == errno.ENOBUFS
+    assert bus.sent == []
@@ -0,0 +1,105 @@
+import itertools
+import json
+import os
+
+import pytest
+
+from dpload2 import cache as cache_module
+from dpload2.cache import ManifestCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Make every cache access one second later than the one before"""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(cache_module.time, "time", lambda: float(next(ticks)))
+
+
+def test_nodes_round_trip(tmp_path):
+    path = str(tmp_path / "cache" / "manifests.json")
+    cache = ManifestCache(path)
+    cache.set_node("ECU A", "aaaa", verified=True)
+    cache.set_node("ECU B", "aaaa")
+    cache.put_manifest("aaaa", 4096, {0x1D007000: 0x1234}, [(0x1D007000, 16, 0x55)])
+    cache.save()
+
+    cache = ManifestCache(path)
+    assert cache.is_verified("ECU A", "aaaa")
+    assert not cache.is_verified("ECU A", "bbbb")
+    assert not cache.is_verified("ECU B", "aaaa")
+    assert not cache.is_verified("ECU C", "aaaa")
+    assert cache.get_manifest("aaaa", 4096) == (
+        {0x1D007000: 0x1234},
+        [(0x1D007000, 16, 0x55)],
+    )
+    assert cache.get_manifest("aaaa", 2048) is None
+
+
+def test_forget_node(tmp_path):
+    path = str(tmp_path / "manifests.json")
+    cache = ManifestCache(path)
+    cache.set_node("ECU A", "aaaa", verified=True)
+    cache.set_node("ECU B", "aaaa", verified=True)
+    cache.save()
+
+    cache = ManifestCache(path)
+    cache.forget_node("ECU A")
+    cache.forget_node("ECU C")
+    cache.save()
+
+    cache = ManifestCache(path)
+    assert not cache.is_verified("ECU A", "aaaa")
+    assert cache.is_verified("ECU B", "aaaa")
+
+
+def test_save_drops_least_recently_used(tmp_path, clock):
+    path = str(tmp_path / "manifests.json")
+    cache = ManifestCache(path, max_nodes=2)
+    for node in ("ECU A", "ECU B", "ECU C"):
+        cache.set_node(node, "aaaa", verified=True)
+    # Looking a node up counts as using it
+    cache.is_verified("ECU A", "aaaa")
+    cache.save()
+
+    cache = ManifestCache(path)
+    assert sorted(cache.tables["nodes"]) == ["ECU A", "ECU C"]
+
+
+def test_save_replaces_the_file_whole(tmp_path, monkeypatch):
+    path = tmp_path / "manifests.json"
+    cache = ManifestCache(str(path))
+    cache.set_node("ECU A", "aaaa", verified=True)
+    cache.save()
+    saved = path.read_text()
+
+    def dump_half(tables, f):
+        f.write(json.dumps(tables)[:10])
+        raise OSError("Disk full")
+
+    monkeypatch.setattr(cache_module.json, "dump", dump_half)
+    cache.set_node("ECU B", "aaaa", verified=True)
+    with pytest.raises(OSError):
+        cache.save()
+    assert path.read_text() == saved
+    assert os.listdir(tmp_path) == ["manifests.json"]
+
+
+def test_unreadable_cache_is_ignored(tmp_path):
+    path = tmp_path / "manifests.json"
+    path.write_text("{not json")
+    cache = ManifestCache(str(path))
+    assert not cache.is_verified("ECU A", "aaaa")
+    cache.set_node("ECU A", "aaaa", verified=True)
+    cache.save()
+    assert ManifestCache(str(path)).is_verified("ECU A", "aaaa")
+
+
+def test_image_hash_follows_the_file(tmp_path):
+    image = tmp_path / "app.hex"
+    image.write_text(":00000001FF\n")
+    cache = ManifestCache(str(tmp_path / "manifests.json"))
+    first = cache.image_hash(str(image))
+    assert cache.image_hash(str(image)) == first
+
+    image.write_text(":0400000501020304ED\n:00000001FF\n")
+    assert cache.image_hash(str(image)) != first
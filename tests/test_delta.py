@@ -0,0 +1,68 @@
+import can
+import pytest
+
+from dpload2.dpload import APP_START, PAGE_SIZE, DPLoad
+from dpload2.image import (
+    HEX_DATA,
+    HEX_EOF,
+    HEX_EXTENDED_LINEAR_ADDRESS,
+    make_record,
+)
+from dpload2.simulator import SimulatedBootloader
+
+
+def image_records(pages):
+    """Records programming {page_index: byte} as whole pages of that byte"""
+    records = []
+    upper = None
+    for index, value in sorted(pages.items()):
+        page = APP_START + index * PAGE_SIZE
+        for address in range(page, page + PAGE_SIZE, 128):
+            if address >> 16 != upper:
+                upper = address >> 16
+                records.append(
+                    make_record(
+                        HEX_EXTENDED_LINEAR_ADDRESS, 0, upper.to_bytes(2, "big")
+                    )
+                )
+            data = bytes([value]) * 128
+            records.append(make_record(HEX_DATA, address & 0xFFFF, data))
+    records.append(make_record(HEX_EOF, 0))
+    return records
+
+
+@pytest.fixture
+def node(request):
+    channel = request.node.name
+    sim = SimulatedBootloader(
+        can.interface.Bus(interface="virtual", channel=channel),
+        range_erase=request.param,
+        boot_delay=0.0,
+    ).start()
+    bus = can.interface.Bus(interface="virtual", channel=channel)
+    dpload = DPLoad(bus, kernel_j1939=False)
+    yield dpload, sim
+    dpload.close()
+    bus.shutdown()
+    sim.stop()
+    sim.bus.shutdown()
+
+
+@pytest.mark.parametrize("node", [False, True], indirect=True)
+def test_delta_keeps_unchanged_pages_behind_a_gap(node):
+    # Pages 0-1 change, page 2 is a gap and pages 3-4 are unchanged, so the
+    # first unchanged page is blank and cannot tell a full erase apart
+    dpload, sim = node
+    old = {0: 0x11, 1: 0x22, 3: 0x33, 4: 0x44}
+    new = {0: 0x55, 1: 0x66, 3: 0x33, 4: 0x44}
+    for index, value in old.items():
+        sim.flash.write(APP_START + index * PAGE_SIZE, bytes([value]) * PAGE_SIZE)
+
+    results = dpload.program_many(image_records(new), [sim.sa], delta=True, jump=False)
+    result = results[sim.sa]
+
+    assert result.ok
+    assert result.full_erase is not sim.range_erase
+    for index, value in new.items():
+        page = sim.flash.read(APP_START + index * PAGE_SIZE, PAGE_SIZE)
+        assert page == bytes([value]) * PAGE_SIZE
@@ -0,0 +1,98 @@
+import can
+
+from dpload2.dispatch import Dispatcher, key_from_id
+from dpload2.j1939 import build_id
+
+PGN = 0xEF27
+
+
+def message(pgn=PGN, sa=5, **kwargs):
+    kwargs.setdefault("is_extended_id", True)
+    return can.Message(arbitration_id=build_id(pgn, sa), data=b"\x01", **kwargs)
+
+
+def test_key_from_id():
+    assert key_from_id(build_id(PGN, 5)) == (5, PGN)
+    # The data page bit is part of the PGN
+    assert key_from_id(build_id(0x1EF27, 5, pri=7)) == (5, 0x1EF27)
+
+
+def test_routes_by_source_and_pgn():
+    dispatcher = Dispatcher(None)
+    exact = dispatcher.subscribe((5, PGN))
+    any_source = dispatcher.subscribe((None, PGN))
+    any_pgn = dispatcher.subscribe((5, None))
+    everything = dispatcher.subscribe((None, None))
+    other = dispatcher.subscribe((6, PGN), (5, PGN + 1))
+
+    msg = message()
+    dispatcher.on_message_received(msg)
+    for subscription in (exact, any_source, any_pgn, everything):
+        assert subscription.get(0) is msg
+        assert subscription.get(0) is None
+    assert other.get(0) is None
+
+    dispatcher.on_message_received(message(sa=6))
+    assert exact.get(0) is None and any_pgn.get(0) is None
+    assert any_source.get(0) is not None and other.get(0) is not None
+
+
+def test_delivers_once_to_a_subscription_with_several_matching_keys():
+    dispatcher = Dispatcher(None)
+    subscription = dispatcher.subscribe((5, PGN), (None, PGN), (None, None))
+    dispatcher.on_message_received(message())
+    assert subscription.get(0) is not None
+    assert subscription.get(0) is None
+
+
+def test_ignores_own_error_and_standard_frames():
+    dispatcher = Dispatcher(None)
+    subscription = dispatcher.subscribe((None, None))
+    dispatcher.on_message_received(message(is_rx=False))
+    dispatcher.on_message_received(message(is_error_frame=True))
+    dispatcher.on_message_received(
+        can.Message(arbitration_id=0x123, data=b"\x01", is_extended_id=False)
+    )
+    assert subscription.get(0) is None
+
+
+def test_unsubscribes_on_context_exit():
+    dispatcher = Dispatcher(None)
+    with dispatcher.subscribe((5, PGN), (None, None)) as subscription:
+        pass
+    assert dispatcher._subscriptions == {}
+    dispatcher.on_message_received(message())
+    assert subscription.get(0) is None
+
+    # The other subscribers of a key keep it
+    kept = dispatcher.subscribe((5, PGN))
+    with dispatcher.subscribe((5, PGN)):
+        pass
+    dispatcher.on_message_received(message())
+    assert kept.get(0) is not None
+
+
+def test_callback_runs_for_matching_messages():
+    dispatcher = Dispatcher(None)
+    received = []
+    subscription = dispatcher.subscribe_callback(received.append, (5, None))
+    dispatcher.on_message_received(message())
+    dispatcher.on_message_received(message(sa=6))
+    subscription.close()
+    dispatcher.on_message_received(message())
+    assert [msg.arbitration_id & 0xFF for msg in received] == [5]
+
+
+def test_routes_frames_from_a_bus(request):
+    sender = can.interface.Bus(interface="virtual", channel=request.node.name)
+    bus = can.interface.Bus(interface="virtual", channel=request.node.name)
+    dispatcher = Dispatcher(bus)
+    try:
+        with dispatcher.subscribe((5, PGN)) as subscription:
+            sender.send(message())
+            msg = subscription.get(1.0)
+        assert msg is not None and bytes(msg.data) == b"\x01"
+    finally:
+        dispatcher.shutdown()
+        bus.shutdown()
+        sender.shutdown()
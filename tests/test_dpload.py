@@ -0,0 +1,101 @@
+import time
+
+import can
+import pytest
+
+from dpload2.dpload import APP_START, DPLoad, ProgrammingError
+from dpload2.image import HEX_DATA, HEX_EXTENDED_LINEAR_ADDRESS, make_record
+from dpload2.simulator import SimulatedBootloader
+
+
+@pytest.fixture
+def node(request):
+    channel = request.node.name
+    sim = SimulatedBootloader(can.interface.Bus(interface="virtual", channel=channel))
+    sim.start()
+    bus = can.interface.Bus(interface="virtual", channel=channel)
+    dpload = DPLoad(bus, da=sim.sa)
+    yield dpload, sim
+    dpload.close()
+    bus.shutdown()
+    sim.stop()
+    sim.bus.shutdown()
+
+
+def test_program_stream_confirms_only_answered_requests(node):
+    dpload, sim = node
+    records = [make_record(HEX_EXTENDED_LINEAR_ADDRESS, 0, b"\x1d\x00")]
+    records += [
+        make_record(HEX_DATA, (APP_START & 0xFFFF) + 16 * i, bytes([i]) * 16)
+        for i in range(8)
+    ]
+    # The node stops answering after its third request, with more in flight
+    program_flash = sim._program_flash
+    handled = []
+
+    def stall(payload):
+        handled.append(payload)
+        if len(handled) > 3:
+            raise RuntimeError("stalled")
+        return program_flash(payload)
+
+    sim._program_flash = stall
+
+    with pytest.raises(ProgrammingError) as e:
+        dpload.program_stream(records, window=4, records_per_request=1, timeout=0.2)
+    assert e.value.confirmed == sum(map(len, records[:3]))
+    # Nothing more is sent once a request is late
+    assert len(handled) == 3 + 4
+
+
+@pytest.fixture
+def nodes(request):
+    channel = request.node.name
+    sims = [
+        SimulatedBootloader(
+            can.interface.Bus(interface="virtual", channel=channel),
+            sa=sa,
+            part_number=f"SIM{sa:08d}",
+            app_version=(1, sa),
+        ).start()
+        for sa in (5, 208)
+    ]
+    bus = can.interface.Bus(interface="virtual", channel=channel)
+    dpload = DPLoad(bus)
+    yield dpload, sims
+    dpload.close()
+    bus.shutdown()
+    for sim in sims:
+        sim.stop()
+        sim.bus.shutdown()
+
+
+def test_probe_finds_every_node(nodes, monkeypatch):
+    dpload, sims = nodes
+    send_frame = dpload._send_frame
+    sent = []
+
+    def record(cmd, payload, da):
+        sent.append(da)
+        return send_frame(cmd, payload, da)
+
+    monkeypatch.setattr(dpload, "_send_frame", record)
+    assert dpload.probe(timeout=0.5) == {5: (2, 5), 208: (2, 5)}
+    assert len(sent) == 253 and dpload.sa not in sent
+
+
+def test_probe_without_nodes_returns_at_once(nodes):
+    dpload, _ = nodes
+    start = time.monotonic()
+    assert dpload.probe(das=[]) == {}
+    assert dpload.probe(das=[dpload.sa]) == {}
+    assert time.monotonic() - start < 0.1
+
+
+def test_get_info_many(nodes):
+    dpload, _ = nodes
+    assert dpload.get_info_many([5, 208, 100], timeout=0.5) == {
+        5: ((5, "SIM00000005", 1, 0), (1, 5)),
+        208: ((208, "SIM00000208", 1, 0), (1, 208)),
+        100: (None, None),
+    }
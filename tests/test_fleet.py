@@ -0,0 +1,67 @@
+from dpload2 import fleet
+from dpload2.dpload import APP_START
+from dpload2.fleet import FleetJob, FleetResult, run_fleet
+from dpload2.image import (
+    HEX_DATA,
+    HEX_EOF,
+    HEX_EXTENDED_LINEAR_ADDRESS,
+    make_record,
+)
+
+
+def stub_channel(interface, channel, bitrate, sa, jobs, window):
+    """Runs in the worker processes in place of fleet._run_channel"""
+    if channel == "down":
+        raise OSError(f"No such interface {channel}")
+    results = []
+    for job in jobs:
+        records, requests = fleet._images[job.path]
+        size = sum(map(len, records))
+        # Encoded once in the parent, as the workers received them
+        assert sum(length for _, length in requests) == size
+        fleet._events.put((channel, job.da, "program", size))
+        if job.da == 13:
+            results.append(FleetResult(job, False, "program", 0, 0.1, "stuck"))
+        else:
+            results.append(FleetResult(job, True, "done", size, 0.1))
+    return results
+
+
+def write_image(path):
+    records = [
+        make_record(HEX_EXTENDED_LINEAR_ADDRESS, 0, b"\x1d\x00"),
+        make_record(HEX_DATA, APP_START & 0xFFFF, bytes(range(16))),
+        make_record(HEX_EOF, 0),
+    ]
+    path.write_text("".join(f":{record.hex().upper()}\n" for record in records))
+    return str(path)
+
+
+def test_failing_channel_does_not_hide_other_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(fleet, "_run_channel", stub_channel)
+    image = write_image(tmp_path / "app.hex")
+    jobs = [
+        FleetJob("can0", 5, image),
+        FleetJob("down", 6, image),
+        FleetJob("can1", 13, image),
+        FleetJob("can1", 208, image),
+    ]
+    events = []
+
+    results = run_fleet(jobs, progress=lambda *event: events.append(event))
+
+    assert [(r.job.channel, r.job.da) for r in results] == [
+        (job.channel, job.da) for job in jobs
+    ]
+    assert [result.ok for result in results] == [True, False, False, True]
+    assert results[1].stage == "connect"
+    assert "No such interface" in results[1].error
+    assert results[2].error == "stuck"
+    # The data record, with the address and EOF records
+    size = 21 + 7 + 5
+    assert results[0].confirmed == size
+    assert sorted(events) == [
+        ("can0", 5, "program", size),
+        ("can1", 13, "program", size),
+        ("can1", 208, "program", size),
+    ]
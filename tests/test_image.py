@@ -0,0 +1,135 @@
+import io
+
+import pytest
+from intelhex import IntelHex
+
+from dpload2.dpload import PAGE_SIZE
+from dpload2.image import (
+    HEX_DATA,
+    HEX_EOF,
+    HEX_EXTENDED_LINEAR_ADDRESS,
+    HEX_EXTENDED_SEGMENT_ADDRESS,
+    compact_records,
+    make_record,
+    page_map,
+    select_pages,
+)
+from dpload2.simulator import Flash, SimulatedBootloader
+
+
+def data(address, payload):
+    return make_record(HEX_DATA, address, payload)
+
+
+def linear(upper):
+    return make_record(HEX_EXTENDED_LINEAR_ADDRESS, 0, upper.to_bytes(2, "big"))
+
+
+def segment(base):
+    paragraph = (base >> 4).to_bytes(2, "big")
+    return make_record(HEX_EXTENDED_SEGMENT_ADDRESS, 0, paragraph)
+
+
+# (records, flash start, flash size)
+IMAGES = {
+    "gapped": (
+        [
+            linear(0x1D00),
+            data(0x7000, bytes(range(16))),
+            data(0x7010, b"\xff" * 16),
+            data(0x7020, b"\x01\x02\xff\xff\xff\xff\xff\xff\x03\x04"),
+            # Page 0x1D008000 is a gap
+            data(0x9000, bytes(range(100, 116))),
+            data(0xFFF0, bytes(range(16))),
+            linear(0x1D01),
+            data(0x0000, b"\x10\x01\x04"),
+            make_record(HEX_EOF, 0),
+        ],
+        0x1D007000,
+        0xA000,
+    ),
+    "unaligned": (
+        [
+            linear(0x1D00),
+            data(0x7003, bytes(range(1, 14))),
+            data(0x7011, b"\xaa\xbb\xcc"),
+            data(0x7016, b"\xff"),
+            data(0x701F, bytes(range(20, 29))),
+            data(0x7FFE, b"\x00\xff\x00\xff\x00"),
+            make_record(HEX_EOF, 0),
+        ],
+        0x1D007000,
+        0x2000,
+    ),
+    "segment and linear": (
+        [
+            segment(0x10000),
+            data(0x0000, bytes(range(16))),
+            data(0x0FF5, bytes(range(20))),
+            segment(0x20000),
+            data(0x0003, b"\x01\x02\x03\x04\x05\x06\x07"),
+            data(0x0100, b"\xff" * 8),
+            linear(0x0002),
+            data(0x8001, b"\x55" * 30),
+            make_record(HEX_EOF, 0),
+        ],
+        0x10000,
+        0x20000,
+    ),
+}
+
+
+def program(records, start, size):
+    """Flash of [start, start + size) after programming records when erased"""
+    node = SimulatedBootloader(None)
+    node.flash = Flash(start=start, size=size)
+    for record in records:
+        node._program_flash(record)
+    return bytes(node.flash.data)
+
+
+def expected(records, start, size):
+    """What records hold in [start, start + size), read by intelhex"""
+    text = "".join(f":{record.hex().upper()}\n" for record in records)
+    ih = IntelHex(io.StringIO(text))
+    ih.padding = 0xFF
+    return ih.tobinstr(start=start, size=size)
+
+
+@pytest.mark.parametrize("record_size", [16, 64])
+@pytest.mark.parametrize("name", IMAGES)
+def test_compact_records_programs_the_same_flash(name, record_size):
+    records, start, size = IMAGES[name]
+    compacted, _ = compact_records(records, record_size=record_size)
+    assert program(compacted, start, size) == expected(records, start, size)
+    assert program(records, start, size) == expected(records, start, size)
+
+
+@pytest.mark.parametrize("name", IMAGES)
+def test_select_pages_programs_only_those_pages(name):
+    records, start, size = IMAGES[name]
+    want = expected(records, start, size)
+    touched = [
+        page
+        for page in range(start, start + size, PAGE_SIZE)
+        if want[page - start : page - start + PAGE_SIZE] != b"\xff" * PAGE_SIZE
+    ]
+    pages = touched[::2]
+    flash = program(select_pages(records, pages, PAGE_SIZE), start, size)
+    for page in range(start, start + size, PAGE_SIZE):
+        offset = page - start
+        if page in pages:
+            page_data = want[offset : offset + PAGE_SIZE]
+        else:
+            page_data = b"\xff" * PAGE_SIZE
+        assert flash[offset : offset + PAGE_SIZE] == page_data
+
+
+@pytest.mark.parametrize("name", IMAGES)
+def test_page_map(name):
+    records, start, size = IMAGES[name]
+    want = expected(records, start, size)
+    assert page_map(records, start, size, PAGE_SIZE) == {
+        page: want[page - start : page - start + PAGE_SIZE]
+        for page in range(start, start + size, PAGE_SIZE)
+    }
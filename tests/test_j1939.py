@@ -0,0 +1,267 @@
+import struct
+import threading
+import time
+
+import can
+import pytest
+
+from dpload2.dispatch import Dispatcher
+from dpload2.j1939 import (
+    J1939,
+    J1939_PF_TP_CM,
+    J1939_PF_TP_DT,
+    J1939_PGN_ECUID,
+    J1939_PGN_SOFT,
+    J1939_TP_ABORT_BAD_SEQUENCE,
+    J1939_TP_ABORT_RESOURCES,
+    J1939_TP_ABORT_TIMEOUT,
+    J1939_TP_CM_ABORT,
+    J1939_TP_CM_BAM,
+    J1939_TP_CM_CTS,
+    J1939_TP_CM_EOM_ACK,
+    J1939_TP_CM_RTS,
+    J1939_TP_T1,
+    J1939_TP_T2,
+    TransportProtocol,
+    build_id,
+)
+from dpload2.simulator import SimulatedBootloader
+
+SA = 0x27
+NODE = 5
+TEXT = b"0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+class FakePacer:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def controls(self):
+        """(control byte, destination) of the TP.CM frames sent"""
+        return [
+            (msg.data[0], msg.arbitration_id >> 8 & 0xFF)
+            for msg in self.sent
+            if msg.arbitration_id >> 16 & 0xFF == J1939_PF_TP_CM
+        ]
+
+
+def frame(pf, data, da=SA, sa=NODE):
+    return can.Message(
+        arbitration_id=build_id((pf << 8) | da, sa, pri=7),
+        data=data,
+        is_extended_id=True,
+    )
+
+
+def connection(control, size, packets, pgn=J1939_PGN_ECUID, max_packets=0xFF):
+    data = struct.pack(
+        "<BHBB3s", control, size, packets, max_packets, pgn.to_bytes(3, "little")
+    )
+    return frame(J1939_PF_TP_CM, data, da=SA if control == J1939_TP_CM_RTS else 255)
+
+
+def data_packet(seq, data=TEXT, da=SA):
+    packet = bytes([seq]) + data[(seq - 1) * 7 : seq * 7].ljust(7, b"\xff")
+    return frame(J1939_PF_TP_DT, packet, da=da)
+
+
+@pytest.fixture
+def tp():
+    dispatcher = Dispatcher(None)
+    pacer = FakePacer()
+    tp = TransportProtocol(dispatcher, pacer, SA, window=2)
+    yield tp, dispatcher, pacer
+    tp.close()
+
+
+def test_window_advances_with_each_cts(tp):
+    tp, dispatcher, pacer = tp
+    with dispatcher.subscribe((NODE, J1939_PGN_ECUID)) as subscription:
+        dispatcher.on_message_received(connection(J1939_TP_CM_RTS, len(TEXT), 6))
+        for seq in range(1, 7):
+            dispatcher.on_message_received(data_packet(seq))
+        msg = subscription.get(0)
+
+    assert bytes(msg.data) == TEXT
+    ctses = [
+        tuple(msg.data[1:3]) for msg in pacer.sent if msg.data[0] == J1939_TP_CM_CTS
+    ]
+    assert ctses == [(2, 1), (2, 3), (2, 5)]
+    assert pacer.controls()[-1] == (J1939_TP_CM_EOM_ACK, NODE)
+    assert tp.pending(J1939_PGN_ECUID) is None
+
+
+def test_sender_can_ask_for_a_smaller_window(tp):
+    tp, dispatcher, pacer = tp
+    rts = connection(J1939_TP_CM_RTS, len(TEXT), 6, max_packets=1)
+    dispatcher.on_message_received(rts)
+    dispatcher.on_message_received(data_packet(1))
+    assert [tuple(msg.data[1:3]) for msg in pacer.sent] == [(1, 1), (1, 2)]
+
+
+def test_bam_is_received_without_cts(tp):
+    tp, dispatcher, pacer = tp
+    with dispatcher.subscribe((NODE, J1939_PGN_ECUID)) as subscription:
+        dispatcher.on_message_received(connection(J1939_TP_CM_BAM, len(TEXT), 6))
+        for seq in range(1, 7):
+            dispatcher.on_message_received(data_packet(seq, da=255))
+        assert bytes(subscription.get(0).data) == TEXT
+    assert pacer.sent == []
+
+
+def test_session_times_out_after_t2_then_t1(tp):
+    tp, dispatcher, pacer = tp
+    dispatcher.on_message_received(connection(J1939_TP_CM_RTS, len(TEXT), 6))
+    start = time.monotonic()
+    assert tp.pending(J1939_PGN_ECUID, NODE) >= start + J1939_TP_T2 - 0.1
+    assert tp.pending(J1939_PGN_ECUID, NODE + 1) is None
+    # The first packet may take T2 after a CTS
+    tp.expire(start + J1939_TP_T1 + 0.1)
+    assert tp.pending(J1939_PGN_ECUID) is not None
+
+    dispatcher.on_message_received(data_packet(1))
+    tp.expire(time.monotonic() + J1939_TP_T1 + 0.1)
+    assert tp.pending(J1939_PGN_ECUID) is None
+    abort = pacer.sent[-1]
+    assert pacer.controls()[-1] == (J1939_TP_CM_ABORT, NODE)
+    assert abort.data[1] == J1939_TP_ABORT_TIMEOUT
+
+    # Packets of the dropped session are ignored
+    dispatcher.on_message_received(data_packet(2))
+    assert pacer.sent[-1] is abort
+
+
+def test_cts_times_out_after_t2(tp):
+    tp, dispatcher, pacer = tp
+    dispatcher.on_message_received(connection(J1939_TP_CM_RTS, len(TEXT), 6))
+    tp.expire(time.monotonic() + J1939_TP_T2 + 0.1)
+    assert pacer.controls() == [(J1939_TP_CM_CTS, NODE), (J1939_TP_CM_ABORT, NODE)]
+
+
+def test_sequence_gap_aborts(tp):
+    tp, dispatcher, pacer = tp
+    with dispatcher.subscribe((NODE, J1939_PGN_ECUID)) as subscription:
+        dispatcher.on_message_received(connection(J1939_TP_CM_RTS, len(TEXT), 6))
+        dispatcher.on_message_received(data_packet(2))
+        assert subscription.get(0) is None
+    assert pacer.controls()[-1] == (J1939_TP_CM_ABORT, NODE)
+    assert pacer.sent[-1].data[1] == J1939_TP_ABORT_BAD_SEQUENCE
+    assert tp.pending(J1939_PGN_ECUID) is None
+
+
+@pytest.mark.parametrize("size, packets", [(len(TEXT), 5), (len(TEXT), 7), (8, 2)])
+def test_rts_with_a_bad_packet_count_is_refused(tp, size, packets):
+    tp, dispatcher, pacer = tp
+    dispatcher.on_message_received(connection(J1939_TP_CM_RTS, size, packets))
+    assert pacer.controls() == [(J1939_TP_CM_ABORT, NODE)]
+    assert pacer.sent[0].data[1] == J1939_TP_ABORT_RESOURCES
+    assert tp.pending(J1939_PGN_ECUID) is None
+
+    # Nobody is told about a broadcast
+    dispatcher.on_message_received(connection(J1939_TP_CM_BAM, size, packets))
+    assert len(pacer.sent) == 1
+    assert tp.pending(J1939_PGN_ECUID) is None
+
+
+def test_pdu1_message_on_data_page_1(tp):
+    tp, dispatcher, pacer = tp
+    pgn = 0x1EF00
+    page_0 = dispatcher.subscribe((NODE, 0xEF00 | SA))
+    with dispatcher.subscribe((NODE, pgn | SA)) as subscription:
+        dispatcher.on_message_received(connection(J1939_TP_CM_RTS, 9, 2, pgn=pgn))
+        assert tp.pending(pgn | SA, NODE) is not None
+        dispatcher.on_message_received(data_packet(1))
+        dispatcher.on_message_received(data_packet(2))
+        msg = subscription.get(0)
+    assert page_0.get(0) is None
+    assert msg.arbitration_id >> 8 & 0x3FFFF == pgn | SA
+    assert bytes(msg.data) == TEXT[:9]
+
+
+def test_request_pgn_waits_for_a_transfer_in_progress():
+    dispatcher = Dispatcher(None)
+    pacer = FakePacer()
+    j1939 = J1939(None, sa=SA, dispatcher=dispatcher, pacer=pacer)
+
+    def answer():
+        # Slower than the request timeout, but in time for T1
+        dispatcher.on_message_received(connection(J1939_TP_CM_RTS, len(TEXT), 6))
+        for seq in range(1, 7):
+            time.sleep(0.1)
+            dispatcher.on_message_received(data_packet(seq))
+
+    thread = threading.Timer(0.05, answer)
+    thread.start()
+    try:
+        assert j1939.request_pgn(J1939_PGN_ECUID, da=NODE, timeout=0.2) == TEXT.decode()
+    finally:
+        thread.join()
+        j1939.close()
+
+
+@pytest.fixture
+def nodes(request):
+    channel = request.node.name
+    sims = [
+        SimulatedBootloader(
+            can.interface.Bus(interface="virtual", channel=channel), sa=sa
+        ).start()
+        for sa in (NODE, 208)
+    ]
+    bus = can.interface.Bus(interface="virtual", channel=channel)
+    j1939 = J1939(bus, sa=SA, tp_window=2)
+    yield j1939, sims
+    j1939.close()
+    j1939.dispatcher.shutdown()
+    bus.shutdown()
+    for sim in sims:
+        sim.stop()
+        sim.bus.shutdown()
+
+
+def test_rts_cts_from_a_node(nodes):
+    j1939, sims = nodes
+    assert j1939.request_pgn(J1939_PGN_ECUID, da=208) == sims[1].ecuid
+
+
+def test_bam_from_every_node(nodes):
+    j1939, sims = nodes
+    # Each broadcast takes longer than the timeout
+    assert j1939.request_pgn_all(J1939_PGN_SOFT, timeout=0.1) == {
+        NODE: sims[0].soft,
+        208: sims[1].soft,
+    }
+
+
+@pytest.mark.parametrize(
+    "seq, reason",
+    # The last packet of a window is missed on T1, others when the next arrives
+    [(2, J1939_TP_ABORT_TIMEOUT), (3, J1939_TP_ABORT_BAD_SEQUENCE)],
+)
+def test_dropped_data_packet(nodes, seq, reason):
+    j1939, sims = nodes
+    sim = sims[1]
+    send_pgn = sim.send_pgn
+    dropped = []
+
+    def drop_packet(pgn, data, pri=6):
+        if pgn >> 8 == J1939_PF_TP_DT and data[0] == seq and not dropped:
+            dropped.append(data)
+            return
+        send_pgn(pgn, data, pri)
+
+    sim.send_pgn = drop_packet
+    with sim.dispatcher.subscribe((SA, (J1939_PF_TP_CM << 8) | 208)) as replies:
+        with pytest.raises(TimeoutError):
+            j1939.request_pgn(J1939_PGN_ECUID, da=208, timeout=0.3)
+        while (msg := replies.get(1.0)) is not None:
+            if msg.data[0] == J1939_TP_CM_ABORT:
+                break
+    assert dropped
+    assert tuple(msg.data[:2]) == (J1939_TP_CM_ABORT, reason)
+
+    # The node gave up on the session and answers again
+    assert j1939.request_pgn(J1939_PGN_ECUID, da=208) == sim.ecuid
@@ -0,0 +1,108 @@
+import errno
+import time
+
+import can
+import pytest
+
+from dpload2.pacing import TxPacer
+
+
+class FakeBus:
+    """Bus whose TX queue is full for the first `full` sends"""
+
+    def __init__(self, full=0, error_code=errno.ENOBUFS):
+        self.full = full
+        self.error_code = error_code
+        self.sent = []
+
+    def send(self, msg):
+        if self.full:
+            self.full -= 1
+            raise can.CanOperationError("Queue full", error_code=self.error_code)
+        self.sent.append(msg)
+
+
+def message(i=0):
+    return can.Message(arbitration_id=i, data=bytes([i]), is_extended_id=True)
+
+
+def queue_full():
+    raise can.CanOperationError("Queue full", error_code=errno.ENOBUFS)
+
+
+def test_backoff_doubles_up_to_the_limit_and_resets():
+    pacer = TxPacer(FakeBus(), min_backoff=0.001, max_backoff=0.004, seed=1)
+    backoffs = []
+    for _ in range(5):
+        sent, wait = pacer._attempt(queue_full)
+        assert sent == 0
+        backoffs.append(pacer._backoff)
+        assert 0.5 * pacer._backoff <= wait <= 1.5 * pacer._backoff
+    assert backoffs == [0.001, 0.002, 0.004, 0.004, 0.004]
+    assert pacer.stalls == 5
+
+    pacer._next = 0.0
+    assert pacer._attempt(lambda: 1) == (1, 0.0)
+    assert pacer._backoff == 0.0
+
+
+def test_send_retries_through_a_full_queue():
+    bus = FakeBus(full=3)
+    pacer = TxPacer(bus, seed=1)
+    pacer.send(message())
+    assert len(bus.sent) == 1
+    assert pacer.stalls == 3
+    assert pacer.stalled_time > 0
+    assert pacer.gap > 0
+
+
+def test_gap_decays_as_frames_go_through():
+    bus = FakeBus(full=2)
+    pacer = TxPacer(bus, min_backoff=0.001, max_gap=0.004, decay=0.5, seed=1)
+    pacer.send(message())
+    gaps = [pacer.gap]
+    for i in range(1, 6):
+        pacer.send(message(i))
+        gaps.append(pacer.gap)
+    assert gaps[0] > 0
+    assert all(later <= earlier / 2 for earlier, later in zip(gaps, gaps[1:]))
+    # Small gaps go to 0 rather than on for ever
+    assert gaps[-1] == 0.0
+    assert [msg.arbitration_id for msg in bus.sent] == list(range(6))
+
+
+def test_stall_gives_up_after_max_stall():
+    pacer = TxPacer(FakeBus(full=10**6), max_stall=0.02, seed=1)
+    with pytest.raises(can.CanOperationError) as e:
+        pacer.send(message())
+    assert e.value.error_code == errno.ENOBUFS
+
+
+def test_other_errors_are_not_retried():
+    bus = FakeBus(full=1, error_code=errno.ENETDOWN)
+    pacer = TxPacer(bus)
+    with pytest.raises(can.CanOperationError):
+        pacer.send(message())
+    assert pacer.stalls == 0
+
+
+def test_nothing_sent():
+    pacer = TxPacer(FakeBus())
+    pacer.send_frames(None, 0x123, b"")
+    # A bulk sender may take no frames without a full queue
+    assert pacer._attempt(lambda: 0) == (0, 0.0)
+    assert pacer.metrics()["frames"] == 0
+
+
+def test_rate_counts_the_last_second(monkeypatch):
+    pacer = TxPacer(FakeBus())
+    for i in range(10):
+        pacer.send(message(i))
+    metrics = pacer.metrics()
+    assert metrics["frames"] == 10
+    assert metrics["rate"] == 10.0
+
+    later = time.monotonic() + 1.5
+    monkeypatch.setattr(time, "monotonic", lambda: later)
+    assert pacer.rate == 0.0
+    assert pacer.metrics()["frames"] == 10
@@ -0,0 +1,142 @@
+import itertools
+import os
+import struct
+
+import pytest
+
+from dpload2.protocol import (
+    CMD_PROGRAM_FLASH,
+    CMD_READ_BOOT_INFO,
+    Crc16,
+    CrcMismatchError,
+    FrameDecoder,
+    crc16,
+    crc16_combine,
+    decode,
+    encode,
+    encode_into,
+    max_encoded_size,
+)
+
+A = bytes(range(256)) * 3 + b"\x01\x04\x10"
+
+
+@pytest.mark.parametrize("size", [0, 1, 4096])
+def test_crc16_combine(size):
+    b = os.urandom(size)
+    assert crc16_combine(crc16(A), crc16(b), len(b)) == crc16(A + b)
+
+
+@pytest.mark.parametrize("size", [0, 1, 4096])
+def test_crc16_combine_after_start_value(size):
+    b = os.urandom(size)
+    assert crc16_combine(crc16(A, 0xFFFF), crc16(b), len(b)) == crc16(A + b, 0xFFFF)
+
+
+def test_crc16_incremental_combine():
+    pages = [os.urandom(4096), bytes(4096), b"\xff" * 4096, b"\x10"]
+    crc = Crc16()
+    for page in pages:
+        crc.combine(crc16(page), len(page))
+    assert crc.digest() == crc16(b"".join(pages))
+    assert crc.length == sum(len(page) for page in pages)
+
+
+def payload_with_crc_byte(value):
+    """A payload whose CRC has value in one of its bytes, so it is escaped"""
+    for last in range(256):
+        payload = b"\x00" + bytes([last])
+        if value in struct.pack("<H", crc16(bytes([CMD_PROGRAM_FLASH]) + payload)):
+            return payload
+
+
+FRAMES = {
+    "plain": encode(CMD_READ_BOOT_INFO),
+    "escaped payload": encode(CMD_PROGRAM_FLASH, b"\x01\x04\x10\x10\x01a\x04"),
+    "all DLE": encode(CMD_PROGRAM_FLASH, b"\x10" * 300),
+    "escaped SOH in CRC": encode(CMD_PROGRAM_FLASH, payload_with_crc_byte(0x01)),
+    "escaped EOT in CRC": encode(CMD_PROGRAM_FLASH, payload_with_crc_byte(0x04)),
+    "escaped DLE in CRC": encode(CMD_PROGRAM_FLASH, payload_with_crc_byte(0x10)),
+    "long": encode(CMD_PROGRAM_FLASH, os.urandom(1000)),
+}
+
+
+def feed_chunks(decoder, data, size):
+    """Every frame decoder returns for data fed in pieces of size bytes"""
+    frames = []
+    for i in range(0, len(data), size):
+        frame = decoder.feed(data[i : i + size])
+        while frame is not None:
+            frames.append(frame)
+            frame = decoder.feed()
+    return frames
+
+
+@pytest.mark.parametrize("size", [1, 3, 8])
+@pytest.mark.parametrize("name", FRAMES)
+def test_frame_decoder_matches_decode(name, size):
+    frame = FRAMES[name]
+    decoder = FrameDecoder(size=16)
+    assert feed_chunks(decoder, frame, size) == [decode(frame)]
+    assert not decoder.in_progress
+
+
+@pytest.mark.parametrize("size", [1, 3, 8])
+def test_frame_decoder_back_to_back(size):
+    first, second = FRAMES["escaped EOT in CRC"], FRAMES["escaped payload"]
+    decoder = FrameDecoder()
+    # Both frames in one piece, then in pieces that straddle them
+    assert decoder.feed(first + second) == decode(first)
+    assert decoder.feed() == decode(second)
+    assert feed_chunks(decoder, first + second, size) == [
+        decode(first),
+        decode(second),
+    ]
+    assert not decoder.in_progress
+
+
+@pytest.mark.parametrize("size", [1, 3, 8])
+def test_frame_decoder_bad_crc(size):
+    good = encode(CMD_PROGRAM_FLASH, b"abc")
+    bad = good.replace(b"abc", b"abd")
+    with pytest.raises(CrcMismatchError):
+        decode(bad)
+    decoder = FrameDecoder()
+    with pytest.raises(CrcMismatchError):
+        feed_chunks(decoder, bad, size)
+    # The decoder starts over with the next frame
+    assert feed_chunks(decoder, good, size) == [decode(good)]
+
+
+@pytest.mark.parametrize("name", ["none", "empty", "plain", "all DLE", "all SOH"])
+def test_encode_into_matches_encode(name):
+    payload = {
+        "none": None,
+        "empty": b"",
+        "plain": b"abc",
+        "all DLE": b"\x10" * 300,
+        "all SOH": b"\x01" * 300,
+    }[name]
+    size = 0 if payload is None else len(payload)
+    buffer = bytearray(max_encoded_size(size))
+    length = encode_into(buffer, CMD_PROGRAM_FLASH, payload)
+    assert bytes(buffer[:length]) == encode(CMD_PROGRAM_FLASH, payload)
+
+
+def test_max_encoded_size_holds_for_all_escaped_frames():
+    # Command, payload and both CRC bytes all escaped. The CRC has the parity
+    # of the bits it covers, and SOH, EOT and DLE have one bit set each, so
+    # this takes an even number of bytes before the CRC.
+    cmd = 0x10
+    for tail in itertools.product(b"\x01\x04\x10", repeat=10):
+        payload = b"\x10" * 99 + bytes(tail)
+        frame = encode(cmd, payload)
+        if len(frame) == max_encoded_size(len(payload)):
+            break
+    else:
+        pytest.fail("No payload with both CRC bytes escaped")
+    buffer = bytearray(len(frame))
+    assert encode_into(buffer, cmd, payload) == len(frame)
+    assert bytes(buffer) == frame
+    with pytest.raises(ValueError):
+        encode_into(bytearray(len(frame) - 1), cmd, payload)
@@ -0,0 +1,77 @@
+import time
+
+import can
+import pytest
+
+from dpload2.dpload import DPLoad
+from dpload2.registry import NodeRegistry
+from dpload2.simulator import SimulatedBootloader
+
+
+@pytest.fixture
+def bus(request):
+    channel = request.node.name
+    buses = []
+
+    def open_bus():
+        buses.append(can.interface.Bus(interface="virtual", channel=channel))
+        return buses[-1]
+
+    yield open_bus
+    for opened in buses:
+        opened.shutdown()
+
+
+def test_scan_drops_nodes_that_stop_claiming(bus):
+    sims = [SimulatedBootloader(bus(), sa=sa).start() for sa in (5, 208)]
+    dpload = DPLoad(bus())
+    registry = NodeRegistry(dpload, ttl=1.5)
+    try:
+        assert sorted(sa for sa, _ in registry.scan(timeout=0.2)) == [5, 208]
+        scanned = time.monotonic()
+        sims[0].stop()
+
+        # Within the TTL the map is read without asking the bus again
+        assert [sa for sa, _ in registry.scan(timeout=0.2)] == [5, 208]
+
+        time.sleep(max(0, scanned + 1.5 - time.monotonic()))
+        assert [sa for sa, _ in registry.scan(timeout=0.2)] == [208]
+        assert registry.name(5) is None
+    finally:
+        registry.close()
+        dpload.close()
+        sims[1].stop()
+
+
+def test_scan_sees_claims_between_scans(bus):
+    sims = [SimulatedBootloader(bus(), sa=5).start()]
+    dpload = DPLoad(bus())
+    registry = NodeRegistry(dpload)
+    try:
+        assert [sa for sa, _ in registry.scan(timeout=0.2)] == [5]
+        sims.append(SimulatedBootloader(bus(), sa=208).start())
+        assert dpload.wait_for_claim(208, timeout=1.0, since=0.0) is not None
+        assert [sa for sa, _ in registry.scan(timeout=0.2)] == [5, 208]
+    finally:
+        registry.close()
+        dpload.close()
+        for sim in sims:
+            sim.stop()
+
+
+def test_inventory_uses_fresh_cache(bus):
+    dpload = DPLoad(bus())
+    registry = NodeRegistry(dpload)
+    requests = []
+    dpload.ecu_info_all = lambda timeout: requests.append(timeout) or {5: "ECU"}
+    dpload.soft_info_all = lambda timeout: requests.append(timeout) or {5: "SOFT"}
+    try:
+        assert registry.inventory(das=[5]) == {5: ("ECU", "SOFT")}
+        assert registry.inventory(das=[5]) == {5: ("ECU", "SOFT")}
+        assert len(requests) == 2
+        registry.invalidate(5)
+        registry.inventory(das=[5])
+        assert len(requests) == 4
+    finally:
+        registry.close()
+        dpload.close()
@@ -0,0 +1,102 @@
+import pytest
+
+from dpload2.rtt import ALL_NODES, MAX_BACKOFF, RttEstimator, RttTable
+
+NAME = bytes.fromhex("d000000000000080")
+
+
+def test_estimator_follows_rfc_6298():
+    estimator = RttEstimator()
+    assert estimator.rto is None
+
+    estimator.update(0.1)
+    assert estimator.srtt == pytest.approx(0.1)
+    assert estimator.rttvar == pytest.approx(0.05)
+    assert estimator.rto == pytest.approx(0.1 + 4 * 0.05)
+
+    # RTTVAR is updated with the SRTT from before this sample
+    estimator.update(0.2)
+    assert estimator.rttvar == pytest.approx(0.05 + (0.1 - 0.05) / 4)
+    assert estimator.srtt == pytest.approx(0.1 + (0.2 - 0.1) / 8)
+    assert estimator.rto == pytest.approx(0.1125 + 4 * 0.0625)
+    assert estimator.samples == 2
+
+
+def test_timeout_backs_off_and_resets_on_a_sample():
+    table = RttTable(floor=0.0, ceiling=1000.0)
+    assert table.timeout(5, "boot", 0.5) == 0.5
+    table.sample(5, "boot", 0.1)
+    rto = table.timeout(5, "boot", 0.5)
+    assert rto == pytest.approx(0.3)
+
+    for backoff in (2, 4, 8):
+        table.timed_out(5, "boot")
+        assert table.timeout(5, "boot", 0.5) == pytest.approx(rto * backoff)
+    for _ in range(10):
+        table.timed_out(5, "boot")
+    assert table.timeout(5, "boot", 0.5) == pytest.approx(rto * MAX_BACKOFF)
+    assert table.stats(5)["boot"]["timeouts"] == 13
+
+    table.sample(5, "boot", 0.1)
+    assert table.timeout(5, "boot", 0.5) < rto
+
+
+def test_timeout_is_clamped():
+    table = RttTable(floor=0.05, ceiling=2.0, limits={"crc": (0.5, 10.0)})
+    assert table.timeout(5, "boot", 0.001) == 0.05
+    assert table.timeout(5, "boot", 100.0) == 2.0
+    table.sample(5, "boot", 0.001)
+    assert table.timeout(5, "boot", 1.0) == 0.05
+    table.sample(5, "erase", 60.0)
+    assert table.timeout(5, "erase", 1.0) == 2.0
+
+    # Commands named name/size use the limits of name unless they have their own
+    assert table.timeout(5, "crc/4096", 0.001) == 0.5
+    assert table.timeout(5, "crc/4096", 100.0) == 10.0
+
+
+def test_unmeasured_nodes_use_all_nodes():
+    table = RttTable(floor=0.0)
+    table.sample(5, "boot", 0.1)
+    assert table.timeout(6, "boot", 5.0) == pytest.approx(0.3)
+    assert table.stats()[ALL_NODES]["boot"]["samples"] == 1
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "rtt" / "rtt.json")
+    table = RttTable(path, floor=0.0)
+    table.sample(5, "boot", 0.1)
+    table.bind(5, NAME)
+    table.sample(5, "boot", 0.2)
+    table.timed_out(5, "crc/4096")
+    table.sample(6, "boot", 0.3)
+    table.save()
+
+    loaded = RttTable(path, floor=0.0)
+    # Nodes only known by address are not kept
+    assert sorted(loaded.stats()) == sorted([NAME.hex(), ALL_NODES])
+    loaded.bind(5, NAME)
+    assert loaded.stats(5) == table.stats(5)
+    assert loaded.stats()[ALL_NODES] == table.stats()[ALL_NODES]
+    # Backoff is not saved
+    assert loaded.stats(5)["crc/4096"]["timeouts"] == 1
+
+
+def test_save_keeps_most_recently_used(tmp_path):
+    path = str(tmp_path / "rtt.json")
+    table = RttTable(path, max_nodes=2)
+    for da in (5, 6, 7):
+        table.bind(da, bytes([da]) * 8)
+        table.sample(da, "boot", 0.1)
+    table.save()
+    assert sorted(RttTable(path).stats()) == sorted(
+        [(bytes([7]) * 8).hex(), ALL_NODES]
+    )
+
+
+def test_unreadable_statistics_are_ignored(tmp_path):
+    path = tmp_path / "rtt.json"
+    path.write_text('{"node": {"used": 1}}')
+    table = RttTable(str(path))
+    assert table.stats() == {}
+    assert table.timeout(5, "boot", 0.5) == 0.5
@@ -0,0 +1,22 @@
+import can
+import pytest
+
+from dpload2.dpload import DPLoad
+from dpload2.simulator import SimulatedBootloader
+
+
+def test_bad_request_does_not_stop_the_node(request):
+    channel = request.node.name
+    sim = SimulatedBootloader(can.interface.Bus(interface="virtual", channel=channel))
+    sim.start()
+    bus = can.interface.Bus(interface="virtual", channel=channel)
+    dpload = DPLoad(bus)
+    try:
+        with pytest.raises(TimeoutError):
+            dpload.get_crc(da=sim.sa, timeout=0.2, start=0xFFFF0000, size=0x1000)
+        assert dpload.get_boot_info(da=sim.sa, timeout=0.5) is not None
+    finally:
+        dpload.close()
+        bus.shutdown()
+        sim.stop()
+        sim.bus.shutdown()